@@ -0,0 +1,141 @@
+# -*- coding: utf8 -*-
+#!/usr/bin/python3
+
+# Copyright 2012 Norman Krämer
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#     http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Kerberos authentication for aiohttp (python 3 only, aiohttp >= 3.12), as client middleware:
+
+    auth = KerberosAuthMiddleware(as_user="otheruser")
+    async with aiohttp.ClientSession(middlewares=(auth,)) as session:
+        async with session.get(url) as r:
+            ...
+
+or per request with session.get(url, middlewares=(auth,)). The calls that may talk to the KDC
+run on a thread pool (see s4u2p_async), the event loop goes on serving other tasks meanwhile.
+"""
+
+import logging
+
+import kerberos as k
+import www_authenticate
+from s4u2p_async import Negotiator
+
+log = logging.getLogger("aiohttp_kerberosauth")
+
+class KerberosAuthMiddleware(object):
+    """
+    Negotiate authentication as as_user, or as the current kerberos principal if that's None.
+    One instance can be used by any number of sessions and tasks at once.
+    """
+
+    auth_header = "WWW-Authenticate"
+
+    def __init__(self, as_user=None, spn=None, gssflags=k.GSS_C_MUTUAL_FLAG|k.GSS_C_SEQUENCE_FLAG,
+                 preemptive=False, executor=None, context_pool=None):
+        """
+        preemptive: once a host answered with a Negotiate challenge, send the Authorization header
+        along with the first request to that host instead of waiting for the 401 again.
+        executor and context_pool: see s4u2p_async.Negotiator.
+        """
+        self.negotiator = Negotiator(as_user, spn, gssflags, executor, context_pool)
+        self.preemptive = preemptive
+        self.negotiate_hosts = set() # hosts known to require Negotiate
+
+    def negotiate_value(self, response):
+        return www_authenticate.negotiate_value(response.headers.getall(self.auth_header, []))
+
+    async def __call__(self, request, handler):
+        negotiator = self.negotiator
+        key = (request.url.host, request.url.port)
+        state, reuse = None, False
+        try:
+            if self.preemptive and key in self.negotiate_hosts:
+                state, request.headers["Authorization"] = await negotiator.async_first_token(*key)
+            response = await handler(request)
+
+            if state is not None and response.status != 401:
+                await negotiator.async_check(state, self.negotiate_value(response))
+                reuse = True
+                return response
+            neg_value = self.negotiate_value(response) if response.status == 401 else None
+            if state is not None:
+                negotiator.clean(state, reuse=False)
+                state = None
+                if neg_value is None and response.status == 401:
+                    log.debug("%s:%s stopped asking for Negotiate" % key)
+                    self.negotiate_hosts.discard(key)
+            if neg_value is None:
+                return response
+            self.negotiate_hosts.add(key)
+
+            state, request.headers["Authorization"] = await negotiator.async_first_token(*key)
+            response.release()
+            response = await handler(request)
+            if response.status != 401:
+                await negotiator.async_check(state, self.negotiate_value(response))
+                reuse = True
+            return response
+        finally:
+            if state is not None:
+                negotiator.clean(state, reuse)
+
+def test(args):
+    import asyncio
+    import aiohttp
+    import s4u2p
+    from concurrent.futures import ThreadPoolExecutor
+    from s4u2p_async import load_test
+    from s4u2p_util import ContextPool
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(levelname)s %(message)s')
+    if args.keytab:
+        s4u2p.authGSSKeytab(args.keytab)
+    users = args.user or [None]
+    executor = ThreadPoolExecutor(max_workers=args.workers)
+    context_pool = ContextPool()
+    auths = dict((user, KerberosAuthMiddleware(as_user=user, spn=args.spn, preemptive=args.preemptive,
+                                               executor=executor, context_pool=context_pool)) for user in users)
+
+    async def run():
+        connector = aiohttp.TCPConnector(limit=args.concurrency)
+        async with aiohttp.ClientSession(connector=connector) as session:
+            async with session.get(args.url, middlewares=(auths[users[0]],)) as r:
+                print(r.status, (await r.text())[:200])
+
+            async def fetch(as_user):
+                async with session.get(args.url, middlewares=(auths[as_user],)) as r:
+                    await r.read()
+                    return r.status
+            if args.count:
+                await load_test(fetch, users, args.concurrency, args.count)
+
+    asyncio.run(run())
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Kerberos authentication middleware for aiohttp, with a load test.")
+    parser.add_argument("--user", dest="user", action="append", help="user to impersonate (repeat for several users), otherwise the current kerberos principal will be used")
+    parser.add_argument("--url", dest="url", help="kerberos protected site", required=True)
+    parser.add_argument("--spn", dest="spn", help="spn to use, if not given s4u2p_util.spn_resolver works it out (HTTP@domain by default)")
+    parser.add_argument("--keytab", dest="keytab", help="path to keytab if you won't use system's default one (only needed for impersonation)", default=None)
+    parser.add_argument("--preemptive", dest="preemptive", action="store_true", help="send the Negotiate header without waiting for a 401 once a host is known to require it")
+    parser.add_argument("--concurrency", dest="concurrency", type=int, help="concurrent requests of the load test", default=200)
+    parser.add_argument("--count", dest="count", type=int, help="number of requests of the load test, 0 skips it", default=1000)
+    parser.add_argument("--workers", dest="workers", type=int, help="threads doing the GSS calls", default=16)
+    args = parser.parse_args()
+
+    test(args)
@@ -0,0 +1,177 @@
+# -*- coding: utf8 -*-
+#!/usr/bin/python
+
+# Copyright 2012 Norman Krämer
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#     http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Timings of the s4u2p operations against a real KDC.
+
+Like test.py this needs a working setup (see README.txt), e.g.:
+
+    kinit -kt ./server.keytab host/server.fqdn
+    python benchmark.py --user otheruser --servicename HTTP@webserver --keytab ./server.keytab s4umode
+"""
+
+import time
+import argparse
+
+import s4u2p
+import s4u2p_util
+import www_authenticate
+
+def timed(fn, count):
+    """calls fn count times, returns the list of durations in seconds"""
+    durations = []
+    for i in range(count):
+        start = time.time()
+        fn()
+        durations.append(time.time() - start)
+    return durations
+
+def percentile(durations, p):
+    """p-th percentile of sorted durations"""
+    return durations[min(len(durations) - 1, int(len(durations) * p / 100.0))]
+
+def report(name, durations):
+    durations = sorted(durations)
+    mean = sum(durations) / len(durations)
+    print "%-12s n=%-5d mean=%8.3fms min=%8.3fms max=%8.3fms" % (name, len(durations), mean * 1000, durations[0] * 1000, durations[-1] * 1000)
+    print "%-12s p50=%8.3fms p90=%8.3fms p99=%8.3fms" % ("", percentile(durations, 50) * 1000, percentile(durations, 90) * 1000, percentile(durations, 99) * 1000)
+    return mean
+
+def s4umode(args):
+    """
+    Per init cost of S4U_MODE_LOOPBACK vs. S4U_MODE_DIRECT.
+    The delegated credential cache is disabled, so every init does the full S4U exchange. The first step
+    is included since in direct mode S4U2Proxy happens there.
+    """
+    def init_step(mode):
+        _ignore, ctx = s4u2p.authGSSImpersonationInit(args.user, args.servicename, mode=mode)
+        s4u2p.authGSSImpersonationStep(ctx, "")
+        s4u2p.authGSSImpersonationClean(ctx)
+
+    cachestats = s4u2p.authGSSCredCacheStats()
+    s4u2p.authGSSCredCacheConfig(maxentries=0)
+    try:
+        init_step(s4u2p.S4U_MODE_LOOPBACK) # warm up the impersonator's credentials
+        loopback = report("loopback", timed(lambda: init_step(s4u2p.S4U_MODE_LOOPBACK), args.count))
+        direct = report("direct", timed(lambda: init_step(s4u2p.S4U_MODE_DIRECT), args.count))
+        print "direct saves %.3fms (%.1f%%) per init" % ((loopback - direct) * 1000, 100 * (loopback - direct) / loopback)
+    finally:
+        s4u2p.authGSSCredCacheConfig(maxentries=cachestats["maxentries"])
+
+def tokenpool(args):
+    """
+    Time to get a Negotiate header on the request thread, minting it there vs. taking it from a
+    s4u2p_util.TokenPool. The delegated credentials are cached in both cases. Requests come in
+    every 10ms, which gives the pool's producer time to refill.
+    """
+    def mint():
+        _ignore, ctx = s4u2p.authGSSImpersonationInit(args.user, args.servicename)
+        s4u2p.authGSSImpersonationStep(ctx, "")
+        header = "Negotiate %s" % s4u2p.authGSSImpersonationResponse(ctx)
+        s4u2p.authGSSImpersonationClean(ctx)
+        return header
+
+    def take():
+        token = pool.get(args.user, args.servicename)
+        if token is None:
+            mint()
+        else:
+            s4u2p.authGSSImpersonationClean(token[1])
+
+    mint() # warm up the credential cache
+    report("inline", timed(mint, args.count))
+
+    pool = s4u2p_util.TokenPool(size=8)
+    pool.watch(args.user, args.servicename)
+    pool.start()
+    try:
+        time.sleep(1)
+        durations = []
+        for i in range(args.count):
+            time.sleep(0.01)
+            durations.extend(timed(take, 1))
+        report("pool", durations)
+        print pool.stats()
+    finally:
+        pool.stop()
+
+def coldstart(args):
+    """
+    First init and step after a restart, with an empty credential cache, without and with a
+    credential store (see authGSSCredStoreConfig) written before the restart.
+    """
+    import tempfile, shutil
+
+    def restart_init_step():
+        s4u2p.authGSSCredCacheFlush() # as good as a restart
+        _ignore, ctx = s4u2p.authGSSImpersonationInit(args.user, args.servicename)
+        s4u2p.authGSSImpersonationStep(ctx, "")
+        s4u2p.authGSSImpersonationClean(ctx)
+
+    store = tempfile.mkdtemp(prefix="s4u2p-store-")
+    try:
+        restart_init_step() # warm up the kerberos library
+        cold = report("kdc", timed(restart_init_step, args.count))
+        s4u2p.authGSSCredStoreConfig(store)
+        restart_init_step() # fills the store
+        warm = report("store", timed(restart_init_step, args.count))
+        print "the store saves %.3fms (%.1f%%) on the first request of a user" % ((cold - warm) * 1000, 100 * (cold - warm) / cold)
+    finally:
+        s4u2p.authGSSCredStoreConfig(None)
+        shutil.rmtree(store)
+
+def authheader(args):
+    """
+    Finding the Negotiate token in WWW-Authenticate headers, with the regex the adapters used
+    before and with www_authenticate. Doesn't need a KDC. The regex backtracks exponentially on
+    headers with many commas, the last header is kept short enough for it to finish.
+    """
+    import re
+    rx = re.compile('(?:.*,)*\s*Negotiate\s*([^,]*),?', re.I)
+    token = "YII" + "A" * 1500 + "=="
+    headers = [
+        ("one", "Negotiate " + token),
+        ("multi", 'Basic realm="intranet", NTLM, Bearer realm="api", error="invalid_token", Negotiate ' + token),
+        ("comma", ", " * 14 + "Negotiat"),
+    ]
+    for name, header in headers:
+        regex = report("%s/regex" % name, timed(lambda: rx.search(header), args.count))
+        parser = report("%s/parser" % name, timed(lambda: www_authenticate.negotiate_value(header), args.count))
+        print "parser takes %.1f%% of the regex' time" % (100 * parser / regex)
+
+benchmarks = {
+    "authheader": authheader,
+    "coldstart": coldstart,
+    "s4umode": s4umode,
+    "tokenpool": tokenpool,
+}
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Benchmarks for the s4u2p extension.")
+    parser.add_argument("--user", dest="user", help="user to impersonate")
+    parser.add_argument("--servicename", dest="servicename", help="service with which a kerberos session is to be initiated.")
+    parser.add_argument("--keytab", dest="keytab", help="path to keytab if you won't use system's default one", default=None)
+    parser.add_argument("--count", dest="count", help="number of iterations", default=100, type=int)
+    parser.add_argument("benchmark", nargs="*", help="benchmarks to run (%s), default: all" % ", ".join(sorted(benchmarks)))
+    args = parser.parse_args()
+
+    if args.keytab:
+        s4u2p.authGSSKeytab(args.keytab)
+
+    for name in args.benchmark or sorted(benchmarks):
+        print "\n%s" % name
+        benchmarks[name](args)
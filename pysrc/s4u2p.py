@@ -21,6 +21,15 @@
 
 """
 PyKerberos Function Description.
+
+Threading:
+    authGSSImpersonationInit and authGSSImpersonationStep release the GIL while doing the GSSAPI work
+    (KDC round trips, ccache and keytab access), so other Python threads keep running.
+    Calls on separate contexts may run concurrently from any number of threads.
+    authGSSImpersonationInitMany does the same for a whole list of users on its own native threads.
+    A single context must only be used by one thread at a time: any call on a context while another
+    thread is inside authGSSImpersonationStep with that context raises a KrbError.
+    authGSSKeytab and the authGSSCredCache* functions may be called at any time.
 """
 
 class KrbError(Exception):
@@ -29,6 +38,13 @@ class KrbError(Exception):
 class GSSError(KrbError):
     pass
 
+class ImpersonationContext(object):
+    """
+    Opaque context returned by authGSSImpersonationInit. All GSS resources held by the context
+    (security context, names, delegated credentials) are released when authGSSImpersonationClean
+    is called or, at the latest, when the object is garbage collected.
+    """
+
 """
 GSSAPI Function Result Codes:
     
@@ -42,6 +58,15 @@ GSSAPI Function Result Codes:
 AUTH_GSS_CONTINUE     = 0 
 AUTH_GSS_COMPLETE     = 1 
      
+# How authGSSImpersonationInit obtains the credentials to talk to the service as the user
+S4U_MODE_LOOPBACK     = 0  # S4U2Self, then accept a ticket to ourselves to get delegated credentials
+S4U_MODE_DIRECT       = 1  # use the S4U2Self credentials directly, S4U2Proxy is done by the first step
+S4U_MODE_AUTO         = 2  # direct, falling back to loopback if the kerberos library can't do that
+
+# How an impersonator identity is picked, see authGSSImpersonatorPolicy
+IMPERSONATOR_POLICY_HASH         = 0  # by the user
+IMPERSONATOR_POLICY_LEAST_LOADED = 1  # the one with the fewest impersonations in progress
+
 # Some useful gss flags 
 GSS_C_DELEG_FLAG      = 1 
 GSS_C_MUTUAL_FLAG     = 2 
@@ -53,27 +78,87 @@ GSS_C_ANON_FLAG       = 64
 GSS_C_PROT_READY_FLAG = 128 
 GSS_C_TRANS_FLAG      = 256 
      
-def authGSSKeytab(keytabfile):
+def authGSSKeytab(keytabfile, principal=None):
     """
     Set the keytab file to use in gss operations.
+    The impersonator's credentials are kept between calls to authGSSImpersonationInit and
+    only reacquired once their tickets near expiry or after the keytab was changed by this function.
+
+    @param keytabfile: path of the keytab.
+    @param principal: optional principal of the impersonator in the keytab (e.g. 'host/server.fqdn').
+        If given, the impersonator's TGT is obtained from the keytab into an in-memory ccache
+        and renewed from there when it nears expiry, so no kinit (and no ccache file) is needed.
+        Needs MIT krb5 >= 1.11.
     """
          
-def authGSSImpersonationInit(as_user, service, gssflags=GSS_C_MUTUAL_FLAG|GSS_C_SEQUENCE_FLAG):
+def authGSSImpersonationInit(as_user, service, gssflags=GSS_C_MUTUAL_FLAG|GSS_C_SEQUENCE_FLAG, mode=S4U_MODE_LOOPBACK, refresh=False, impersonator=None):
     """
     Initializes a context for GSSAPI client-side authentication with the given service principal.
-    authGSSImpersonationClean must be called after this function returns an OK result to dispose of
-    the context once all GSSAPI operations are complete.
+    authGSSImpersonationClean should be called after this function returns an OK result to dispose of
+    the context once all GSSAPI operations are complete, otherwise the context is disposed of when
+    it is garbage collected.
+    The delegated credentials of as_user are kept in a cache (see authGSSCredCacheConfig), so
+    subsequent calls for the same user don't need to contact the KDC until the tickets near expiry.
 
     @param as_user: a string containing the user to impersonaate 'username@REALM' or just 'username' if you have a default realm set.
     @param service: a string containing the service principal in the form 'type@fqdn'
-        (e.g. 'imap@mail.apple.com').
+        (e.g. 'imap@mail.apple.com'), the host is canonicalized by the kerberos library (DNS). The
+        canonicalized names are cached for 5 minutes, and dropped by authGSSKeytab and authGSSCredCacheFlush.
+        A principal name 'type/fqdn' or 'type/fqdn@REALM' (e.g. 'HTTP/www.example.com@EXAMPLE.COM')
+        is used as it is, without any DNS lookup, see s4u2p_util.SpnResolver.
     @param gssflags: optional integer used to set GSS flags.
         (e.g.  GSS_C_DELEG_FLAG|GSS_C_MUTUAL_FLAG|GSS_C_SEQUENCE_FLAG will allow 
         for forwarding credentials to the remote host)
+    @param mode: optional S4U_MODE_* value. S4U_MODE_LOOPBACK turns the S4U2Self credentials into
+        delegated credentials by accepting a ticket to ourselves, which costs an extra AP-REQ
+        and a replay cache write. S4U_MODE_DIRECT skips that and needs a kerberos library able to do
+        S4U2Proxy with S4U2Self credentials (MIT krb5 >= 1.8, Heimdal). S4U_MODE_AUTO tries direct first
+        and falls back to loopback on the first step if the kerberos library or the KDC can't do direct,
+        inits within the next 10 minutes then use loopback right away. Other errors are raised as they are.
+    @param refresh: if true, don't use cached credentials but get new ones from the KDC. They replace
+        the cached ones, so later inits get them too.
+    @param impersonator: optional name of the identity (see authGSSImpersonatorAdd) to impersonate
+        with. If not given, one is picked by the policy set with authGSSImpersonatorPolicy.
     @return: a tuple of (result, context) where result is the result code (see above) and
         context is an opaque value that will need to be passed to subsequent functions.
     """
 
+def authGSSImpersonationInitMany(users, service, gssflags=GSS_C_MUTUAL_FLAG|GSS_C_SEQUENCE_FLAG, max_workers=8, mode=S4U_MODE_LOOPBACK):
+    """
+    Initializes contexts for many users at once. The impersonations run on up to max_workers native
+    threads without holding the GIL, so the KDC round trips of the users overlap. A failure for one
+    user doesn't affect the others.
+    Every returned context should be disposed of with authGSSImpersonationClean.
+
+    @param users: a sequence of strings containing the users to impersonate (see authGSSImpersonationInit).
+    @param service: a string containing the service principal in the form 'type@fqdn' or 'type/fqdn[@REALM]'.
+    @param gssflags: optional integer used to set GSS flags.
+    @param max_workers: maximum number of threads working on the batch.
+    @param mode: optional S4U_MODE_* value (see authGSSImpersonationInit).
+    @return: a list with one entry per user, in the order of users. An entry is either a tuple of
+        (result, context) as returned by authGSSImpersonationInit or the GSSError raised for that user.
+    """
+
+def authGSSImpersonationInitFromCred(token, service, gssflags=GSS_C_MUTUAL_FLAG|GSS_C_SEQUENCE_FLAG):
+    """
+    Initializes a context like authGSSImpersonationInit, but with credentials exported by
+    authGSSImpersonationExportCred, e.g. in another process, instead of doing the S4U exchange.
+
+    @param token: the exported credentials.
+    @param service: a string containing the service principal in the form 'type@fqdn' or 'type/fqdn[@REALM]'.
+    @param gssflags: optional integer used to set GSS flags.
+    @return: a tuple of (result, context) (see authGSSImpersonationInit).
+    """
+
+def authGSSImpersonationExportCred(context):
+    """
+    Exports the credentials a context talks to the service with. The result may contain
+    tickets and session keys, so only hand it to trusted parties.
+
+    @param context: the context object returned from authGSSImpersonationInit.
+    @return: a string to pass to authGSSImpersonationInitFromCred.
+    """
+
 def authGSSImpersonationClean(context):
     """
     Destroys the context for GSSAPI client-side authentication. After this call the context
@@ -101,6 +186,67 @@ def authGSSImpersonationResponse(context):
     @return: a string containing the base64-encoded client data to be sent to the server.
     """
 
+def authGSSImpersonationStepRaw(context, token):
+    """
+    Like authGSSImpersonationStep, but for protocols that carry binary tokens (e.g. SASL/LDAP).
+
+    @param context: the context object returned from authGSSImpersonationInit.
+    @param token: the raw server data, any object supporting the buffer protocol (str, bytearray,
+        memoryview, buffer). It is passed to GSSAPI without copying and may be empty for the first step.
+    @return: a result code (see above).
+    """
+
+def authGSSImpersonationResponseRaw(context):
+    """
+    Like authGSSImpersonationResponse, but returns the client data without base64 encoding.
+
+    @param context: the context object returned from authGSSImpersonationInit.
+    @return: a string containing the raw client data to be sent to the server, or None if the
+        last step produced no data.
+    """
+
+def authGSSImpersonationWrap(context, data, conf=True):
+    """
+    Protects a message with an established context (i.e. after authGSSImpersonationStep returned
+    AUTH_GSS_COMPLETE). The message is encrypted in place, so large payloads aren't copied.
+    header + data + trailer is the token gss_wrap would have produced, send the three parts one after
+    the other (e.g. with socket.sendall or writev) to avoid concatenating them.
+
+    @param context: the context object returned from authGSSImpersonationInit.
+    @param data: a writable buffer (e.g. bytearray, writable memoryview) containing the message.
+    @param conf: if true the message is encrypted, otherwise it's only integrity protected.
+    @return: a tuple of (header, trailer, conf_state) where conf_state tells if the message was encrypted.
+    """
+
+def authGSSImpersonationUnwrap(context, token):
+    """
+    Unprotects a token produced by the peer's gss_wrap. The token is decrypted in place.
+
+    @param context: the context object returned from authGSSImpersonationInit.
+    @param token: a writable buffer (e.g. bytearray) containing the whole token.
+    @return: a tuple of (offset, length, conf_state). The message is token[offset:offset+length],
+        use a memoryview to get at it without copying.
+    """
+
+def authGSSImpersonationGetMic(context, message):
+    """
+    Computes a message integrity code over a message.
+
+    @param context: the context object returned from authGSSImpersonationInit.
+    @param message: any object supporting the buffer protocol.
+    @return: a string containing the MIC.
+    """
+
+def authGSSImpersonationVerifyMic(context, message, mic):
+    """
+    Verifies a message integrity code. Raises GSSError if the MIC doesn't match the message.
+
+    @param context: the context object returned from authGSSImpersonationInit.
+    @param message: any object supporting the buffer protocol.
+    @param mic: the MIC received from the peer.
+    @return: the quality of protection applied by the peer.
+    """
+
 def authGSSImpersonationUserName(context):
     """
     Get the user name of the principal authenticated via the now complete GSSAPI client-side operations.
@@ -110,3 +256,92 @@ def authGSSImpersonationUserName(context):
     @return: a string containing the user name.
     """
 
+def authGSSImpersonationInquireCred(context):
+    """
+    Get information about the credentials a context talks to the service with.
+
+    @param context: the context object returned from authGSSImpersonationInit.
+    @return: a dict with the keys 'principal', the name of the impersonated user, and 'lifetime',
+        the number of seconds the credentials are still valid.
+    """
+
+def authGSSImpersonatorAdd(name, keytabfile, principal):
+    """
+    Adds an impersonator identity, e.g. another service account allowed to impersonate, to
+    spread the S4U exchanges over several accounts. Each identity has its own keytab,
+    credentials and cached delegated credentials. Once an identity is added the default one
+    (see authGSSKeytab) isn't used anymore. Adding a name again replaces that identity.
+
+    @param name: a name for the identity, passed as impersonator to authGSSImpersonationInit.
+    @param keytabfile: the keytab of the identity.
+    @param principal: the identity's principal in the keytab, its TGT is obtained from the keytab
+        (see authGSSKeytab). Raises OSError (EINVAL) if it's None or empty.
+    @return: a result code (see above).
+    """
+
+def authGSSImpersonatorPolicy(policy):
+    """
+    Sets how an identity is picked for an authGSSImpersonationInit that doesn't name one.
+    IMPERSONATOR_POLICY_HASH (the default) picks by the user, so a user always gets the same
+    identity and its cached credentials. IMPERSONATOR_POLICY_LEAST_LOADED picks the identity
+    with the fewest impersonations in progress.
+
+    @param policy: one of the IMPERSONATOR_POLICY_* values.
+    @return: a result code (see above).
+    """
+
+def authGSSImpersonatorStats():
+    """
+    Get the load of the added impersonator identities.
+
+    @return: a list with a dict per identity with the keys 'name', 'impersonations' (the
+        number of times it was used) and 'busy' (impersonations in progress).
+    """
+
+def authGSSCredCacheConfig(maxentries=512, minlifetime=60):
+    """
+    Configures the cache of delegated credentials used by authGSSImpersonationInit.
+    Cached credentials are keyed by the impersonator (keytab and credential cache in use) and the
+    impersonated user. If the cache is full the least recently used entry is evicted.
+
+    @param maxentries: maximum number of users to keep credentials for, 0 disables the cache.
+    @param minlifetime: credentials with fewer seconds of ticket lifetime left are not handed out
+        anymore but dropped from the cache.
+    @return: a result code (see above).
+    """
+
+def authGSSCredCacheStats():
+    """
+    Get the counters of the delegated credential cache.
+
+    @return: a dict with the keys 'hits', 'misses', 'evictions', 'expirations', 'entries',
+        'maxentries' and 'minlifetime'.
+    """
+
+def authGSSCredCacheFlush():
+    """
+    Drops all entries of the delegated credential cache, the impersonator's credentials and the
+    imported service names. Contexts already using cached credentials stay valid.
+
+    @return: a result code (see above).
+    """
+
+def authGSSCredStoreConfig(directory):
+    """
+    Keeps the delegated credentials additionally in a directory, one ccache per user, so they
+    survive a restart of the process. authGSSImpersonationInit loads still valid credentials
+    from there instead of doing the S4U exchange again. Expired ccaches are removed right away.
+    The ccaches contain session keys, the directory is created accessible to the owner only, an
+    existing one that isn't owned by the process' user or is accessible to others is refused with
+    an OSError. Only the store's own files (named *.s4u2p-cc) are ever removed from it.
+
+    @param directory: path of the store, None disables the store.
+    @return: a result code (see above).
+    """
+
+def authGSSCredStorePrune():
+    """
+    Removes expired ccaches from the credential store.
+
+    @return: the number of ccaches removed.
+    """
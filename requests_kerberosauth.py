@@ -9,7 +9,8 @@ from requests import get as reqget
 from requests import session
 import kerberos as k
 import s4u2p
-import re
+from s4u2p_util import ContextPool, resolve_spn, is_stream, body_position, rewind_body, remember_step_error
+import www_authenticate
 import logging
 
 def getLogger():
@@ -23,101 +24,352 @@ def getLogger():
 log = getLogger()
 
 class HTTPKerberosAuth(AuthBase):
-    """Attaches Kerberos Authentication to the given Request object."""
+    """Attaches Kerberos Authentication to the given Request object.
+
+    The handshake state is kept on the request, so one instance (and one session) can be
+    used from several threads at once.
+
+    Proxies (the session's or request's proxies) asking for Negotiate with a 407 are
+    authenticated to as the same user.
+    """
     
-    rx = re.compile('(?:.*,)*\s*Negotiate\s*([^,]*),?', re.I)
     auth_header = 'www-authenticate'
+    proxy_auth_header = 'proxy-authenticate'
 
-    def __init__(self, as_user=None, spn=None, gssflags=k.GSS_C_MUTUAL_FLAG|k.GSS_C_SEQUENCE_FLAG):
+    def __init__(self, as_user=None, spn=None, gssflags=k.GSS_C_MUTUAL_FLAG|k.GSS_C_SEQUENCE_FLAG, preemptive=False, context_pool=None, token_pool=None, probe=True, proxy_spn=None):
+        """
+        preemptive: once a host answered with a Negotiate challenge, send the Authorization header
+        along with the first request to that host instead of waiting for the 401 again. Requests
+        with a body are always sent that way to such hosts, so the body goes out only once.
+        probe: before a body is sent to a host not known to ask for Negotiate or not, find out with
+        a HEAD request. Bodies that are streams which can't be rewound are never sent twice,
+        the 401 is returned instead.
+        context_pool: a s4u2p_util.ContextPool to reuse impersonation contexts from, by default
+        a pool private to this instance is used. Only used when impersonating.
+        token_pool: a s4u2p_util.TokenPool to take preemptive headers from, the hosts' SPNs have to
+        be watched by it in S4U_MODE_LOOPBACK and it has to use the same gssflags. Only used when impersonating.
+        proxy_spn: the proxy's service principal, worked out like spn by default. requests opens
+        a new connection to the proxy for every request, so once a proxy asked for Negotiate
+        every request to it carries a Proxy-Authorization header, the 407 isn't waited for again.
+        """
         self.retried = 0
-        self.context = None
         self.gssflags=gssflags
         self.spn = spn
+        self.as_user = as_user
+        self.preemptive = preemptive
+        self.negotiate_hosts = set() # hosts known to require Negotiate
+        self.plain_hosts = set() # hosts known not to require Negotiate
+        self.negotiate_proxies = set() # proxies known to require Negotiate
+        self.proxy_spn = proxy_spn
+        self.probe = probe
+        self.token_pool = None
         if as_user:
+            self.context_pool = context_pool or ContextPool()
+            if token_pool is not None and token_pool.gssflags == gssflags:
+                self.token_pool = token_pool
             self.gss_step = s4u2p.authGSSImpersonationStep
             self.gss_response = s4u2p.authGSSImpersonationResponse
-            self.gss_clean = s4u2p.authGSSImpersonationClean
-            self.gss_init = lambda *args: s4u2p.authGSSImpersonationInit(as_user, *args)
             self.GSSError = s4u2p.GSSError
         else:
+            self.context_pool = None
             self.gss_step = k.authGSSClientStep
             self.gss_response = k.authGSSClientResponse
             self.gss_clean = k.authGSSClientClean
             self.gss_init = k.authGSSClientInit
             self.GSSError = k.GSSError
 
-    def negotiate_value(self, headers):
+    def negotiate_value(self, headers, auth_header=None):
         """checks for "Negotiate" in proper auth header
         """
-        authreq = headers.get(self.auth_header, None)
+        auth_header = auth_header or self.auth_header
+        authreq = headers.get(auth_header, None)
 
         if authreq:
             log.debug("authreq: %s", authreq)
-            mo = self.rx.search(authreq)
-            if mo:
-                return mo.group(1)
+            value = www_authenticate.negotiate_value(authreq)
+            if value is not None:
+                return value
             else:
-                log.debug("regex failed on: %s" % authreq)
+                log.debug("no Negotiate challenge in: %s" % authreq)
 
         else:
-            log.debug("%s header not found" % self.auth_header)
+            log.debug("%s header not found" % auth_header)
 
         return None
     
     def get_spn(self, r):
         if self.spn is None:
-            domain = urlparse(r.url).hostname
-            self.spn = spn = "HTTP@%s" % domain
+            url = urlparse(r.url)
+            spn = resolve_spn(url.hostname, url.port, principal=bool(self.as_user))
             log.debug("calculated SPN as  %s" % spn)
+            return spn
 
         return self.spn
     
+    def get_proxy_spn(self, r):
+        if self.proxy_spn is None:
+            url = urlparse(self.proxy(r))
+            return resolve_spn(url.hostname, url.port, principal=bool(self.as_user))
+        return self.proxy_spn
+
+    def host(self, r):
+        return urlparse(r.url).netloc
+
+    def proxy(self, r):
+        """the proxy r is sent through (chosen like requests does), None if it goes direct"""
+        url = urlparse(r.url)
+        no_proxy = [host.strip() for host in r.proxies.get('no', '').split(',') if host.strip()]
+        proxy = r.proxies.get(url.scheme)
+        if not proxy or any([url.hostname.endswith(host) for host in no_proxy]):
+            return None
+        if '://' not in proxy:
+            proxy = 'http://' + proxy
+        return proxy
+
+    def init_context(self, request, proxy=False):
+        """Sets up a context for the request (or its proxy), returns False if that failed."""
+
+        spn = proxy and self.get_proxy_spn(request) or self.get_spn(request)
+        if self.context_pool is not None:
+            context = self.context_pool.acquire(self.as_user, spn, self.gssflags)
+        else:
+            result, context = self.gss_init(spn, self.gssflags)
+            if result < 1:
+                log.warning("gss_init returned result %d" % result)
+                return False
+        setattr(request, proxy and "kerberos_proxy_context" or "kerberos_context", context)
+        return True
+
+    def step_failed(self, request, error, proxy=False):
+        """Remembers a permanent failure of the user with the host (or the proxy), see s4u2p_util.remember_step_error."""
+
+        if self.as_user:
+            remember_step_error(self.as_user, proxy and self.get_proxy_spn(request) or self.get_spn(request), error)
+
+    def clean_context(self, request, reuse=True, proxy=False):
+        """Done with the context of the request (or its proxy), pooled contexts go back to the pool if reuse is set."""
+
+        name = proxy and "kerberos_proxy_context" or "kerberos_context"
+        context = getattr(request, name, None)
+        if context is None:
+            return
+        setattr(request, name, None)
+        if self.context_pool is not None:
+            if reuse:
+                spn = proxy and self.get_proxy_spn(request) or self.get_spn(request)
+                self.context_pool.release(self.as_user, spn, self.gssflags, context)
+            else:
+                self.context_pool.discard(context)
+        else:
+            self.gss_clean(context)
+
+    def handle_preemptive(self, r, neg_value):
+        """Checks the response to a request that carried a preemptive Authorization header.
+        Returns the negotiate value to continue the handshake with, or None if there's nothing left to do."""
+
+        request = r.request
+        request.kerberos_preemptive = False
+        if r.status_code == 401:
+            # our token was rejected, or the host doesn't do Negotiate anymore
+            self.clean_context(request, reuse=False)
+            if neg_value is None:
+                log.debug("%s stopped asking for Negotiate" % self.host(r))
+                self.negotiate_hosts.discard(self.host(r))
+                return None
+            return ""
+
+        if neg_value is None:
+            if self.gssflags & k.GSS_C_MUTUAL_FLAG:
+                # no mutual authentication token, the host didn't look at our header
+                log.debug("%s ignored the preemptive Negotiate header" % self.host(r))
+                self.negotiate_hosts.discard(self.host(r))
+            self.clean_context(request)
+        return neg_value
+
     def handle_401(self, r):
         """Takes the given response and tries kerberos negotiation, if needed."""
 
         ret = r
-        r.request.deregister_hook('response', self.handle_401)
+        request = r.request
+        request.deregister_hook('response', self.handle_401)
+
+        if r.status_code == 407 or getattr(request, "kerberos_proxy_context", None) is not None:
+            proxied = self.handle_407(r)
+            if proxied is not r:
+                return proxied # the request was sent again, that response went through here already
 
         neg_value = self.negotiate_value(r.headers) #Check for auth_header
+        if getattr(request, "kerberos_preemptive", False):
+            neg_value = self.handle_preemptive(r, neg_value)
         firstround = False
         if neg_value is not None:
             
-            if self.context is None:
-                spn = self.get_spn(r)
-                result, self.context = self.gss_init(spn, self.gssflags)
-                
-                if result < 1:
-                    log.warning("gss_init returned result %d" % result)
+            if r.status_code == 401:
+                self.negotiate_hosts.add(self.host(r))
+                self.plain_hosts.discard(self.host(r))
+                if not self.rewind_body(request):
+                    log.warning("the request body can't be sent again, returning the 401")
+                    self.clean_context(request, reuse=False)
+                    return ret
+
+            if getattr(request, "kerberos_context", None) is None:
+                if not self.init_context(request):
                     return None
 
-                firstround = False
+                firstround = True
                 log.debug("gss_init() succeeded")
 
-            result = self.gss_step(self.context, neg_value)
+            try:
+                result = self.gss_step(request.kerberos_context, neg_value)
+            except self.GSSError, e:
+                log.warning("gss_step failed: %s" % (e,))
+                self.step_failed(request, e)
+                self.clean_context(request, reuse=False)
+                return None
 
             if result < 0:
-                self.gss_clean(self.context)
-                self.context = None
+                self.clean_context(request, reuse=False)
                 log.warning("gss_step returned result %d" % result)
                 return None
 
             log.debug("gss_step() succeeded")
 
             if result == k.AUTH_GSS_CONTINUE or (result == k.AUTH_GSS_COMPLETE and not (self.gssflags & k.GSS_C_MUTUAL_FLAG) and firstround):
-                response = self.gss_response(self.context)
-                r.request.headers['Authorization'] = "Negotiate %s" % response
-                r.request.send(anyway=True)
-                _r = r.request.response
+                response = self.gss_response(request.kerberos_context)
+                request.headers['Authorization'] = "Negotiate %s" % response
+                request.send(anyway=True)
+                _r = request.response
                 _r.history.append(r)
 
                 ret = _r
-            if result == k.AUTH_GSS_COMPLETE and self.context:
-                 self.gss_clean(self.context)
-                 self.context = None
+            if result == k.AUTH_GSS_COMPLETE:
+                 self.clean_context(request)
 
         return ret
 
+    def handle_407(self, r):
+        """Checks the proxy's answer to a request that carried a Proxy-Authorization header, or
+        sends the request again with one if the proxy asks for Negotiate. Returns the response
+        to go on with."""
+
+        request = r.request
+        proxy = self.proxy(request)
+        neg_value = self.negotiate_value(r.headers, self.proxy_auth_header)
+        if getattr(request, "kerberos_proxy_context", None) is not None:
+            del request.headers['Proxy-Authorization']
+            if r.status_code != 407:
+                if neg_value:
+                    try:
+                        self.gss_step(request.kerberos_proxy_context, neg_value)
+                    except self.GSSError, e:
+                        log.warning("mutual authentication with the proxy %s failed: %s" % (proxy, e))
+                self.clean_context(request, proxy=True)
+                return r
+            self.clean_context(request, reuse=False, proxy=True)
+            if neg_value is None:
+                log.debug("%s stopped asking for Negotiate" % proxy)
+                self.negotiate_proxies.discard(proxy)
+            return r
+
+        if r.status_code != 407 or neg_value is None or getattr(request, "kerberos_proxy_retried", False):
+            return r
+        self.negotiate_proxies.add(proxy)
+        if not self.rewind_body(request):
+            log.warning("the request body can't be sent again, returning the 407")
+            return r
+        request.kerberos_proxy_retried = True
+        request.send(anyway=True) # __call__ adds the Proxy-Authorization header
+        _r = request.response
+        _r.history.append(r)
+        return _r
+
+    def preemptive_header(self, r, proxy=False):
+        """Starts the handshake (with the proxy) right away and returns the Authorization header value."""
+
+        name = proxy and "kerberos_proxy_context" or "kerberos_context"
+        if self.token_pool is not None:
+            token = self.token_pool.get(self.as_user, proxy and self.get_proxy_spn(r) or self.get_spn(r), s4u2p.S4U_MODE_LOOPBACK)
+            if token is not None:
+                header, context = token
+                setattr(r, name, context)
+                return header
+
+        if not self.init_context(r, proxy):
+            return None
+
+        try:
+            self.gss_step(getattr(r, name), "")
+        except self.GSSError, e:
+            log.warning("preemptive gss_step failed: %s" % (e,))
+            self.step_failed(r, e, proxy)
+            self.clean_context(r, reuse=False, proxy=proxy)
+            return None
+
+        return "Negotiate %s" % self.gss_response(getattr(r, name))
+
+    def body_streams(self, r):
+        """the streams the body of r is read from"""
+        files = r.files or {}
+        values = files.values() if isinstance(files, dict) else [value for _name, value in files]
+        streams = [r.data]
+        for f in values:
+            if isinstance(f, tuple):
+                f = f[1] # (filename, file)
+            streams.append(f)
+        return [stream for stream in streams if is_stream(stream)]
+
+    def rewind_body(self, r):
+        """prepares the body of r to be sent again, returns False if it can't"""
+        positions = getattr(r, "kerberos_body_positions", ())
+        return all([rewind_body(stream, position) for stream, position in positions])
+
+    def probe_host(self, r):
+        """finds out whether the host of r asks for Negotiate with a HEAD request"""
+        skip = ("authorization", "content-length", "content-type", "transfer-encoding", "expect")
+        headers = dict((name, value) for name, value in r.headers.items() if name.lower() not in skip)
+        s = r.session or session()
+        proxy = self.proxy(r)
+        for attempt in range(2):
+            try:
+                response = s.head(r.url, headers=headers, proxies=r.proxies, auth=self.probe_auth, allow_redirects=False)
+            except Exception, e:
+                log.debug("probing %s failed: %s" % (self.host(r), e))
+                return
+            self.clean_context(response.request, reuse=response.status_code != 407, proxy=True)
+            if response.status_code != 407 or proxy in self.negotiate_proxies or self.negotiate_value(response.headers, self.proxy_auth_header) is None:
+                break
+            self.negotiate_proxies.add(proxy)
+        if response.status_code == 401 and self.negotiate_value(response.headers) is not None:
+            self.negotiate_hosts.add(self.host(r))
+        elif response.status_code != 407:
+            self.plain_hosts.add(self.host(r))
+
+    def probe_auth(self, probe):
+        """auth of the probes, only adds the Proxy-Authorization header for proxies known to ask for Negotiate"""
+        if self.proxy(probe) in self.negotiate_proxies and getattr(probe, "kerberos_proxy_context", None) is None:
+            header = self.preemptive_header(probe, proxy=True)
+            if header is not None:
+                probe.headers['Proxy-Authorization'] = header
+        return probe
+
     def __call__(self, r):
+        has_body = bool(r.data or r.files)
+        if has_body and self.probe and getattr(r, "kerberos_context", None) is None and self.host(r) not in self.negotiate_hosts and self.host(r) not in self.plain_hosts:
+            self.probe_host(r)
+        if (self.preemptive or has_body) and getattr(r, "kerberos_context", None) is None and self.host(r) in self.negotiate_hosts:
+            header = self.preemptive_header(r)
+            if header is not None:
+                log.debug("sending preemptive Negotiate header to %s" % self.host(r))
+                r.headers['Authorization'] = header
+                r.kerberos_preemptive = True
+        proxy = self.proxy(r)
+        if proxy in self.negotiate_proxies and getattr(r, "kerberos_proxy_context", None) is None:
+            # every send goes over a new connection to the proxy, so every send needs a token
+            header = self.preemptive_header(r, proxy=True)
+            if header is not None:
+                r.headers['Proxy-Authorization'] = header
+        if not hasattr(r, "kerberos_body_positions"): # not for the resends
+            r.kerberos_body_positions = [(stream, body_position(stream)) for stream in self.body_streams(r)]
         r.register_hook('response', self.handle_401)
         return r
 
@@ -126,7 +378,8 @@ def test(args):
     log.info("starting test")
     if args.keytab:
         s4u2p.authGSSKeytab(args.keytab)
-    s = session(auth=HTTPKerberosAuth(as_user=args.user, spn=args.spn))
+    proxies = args.proxy and {"http": args.proxy, "https": args.proxy} or None
+    s = session(auth=HTTPKerberosAuth(as_user=args.user, spn=args.spn, preemptive=args.preemptive, proxy_spn=args.proxy_spn), proxies=proxies)
     r=s.get(args.url)
     print r.text
 #    if website is set up to keep auth, the next calls will not authenticate again
@@ -134,6 +387,28 @@ def test(args):
 #    for i in range(20):
 #        r=s.get(args.url)
 #        print i, r.text
+    if args.threads:
+        concurrentRequests(s, args.url, args.threads, args.count)
+
+def concurrentRequests(s, url, threads, count):
+    """hammers one session from several threads, every request has to authenticate"""
+    import threading
+    failures = []
+    def run():
+        for i in range(count):
+            try:
+                r = s.get(url)
+                if r.status_code != 200:
+                    failures.append(r.status_code)
+            except Exception, e:
+                failures.append(e)
+
+    workers = [threading.Thread(target=run) for i in range(threads)]
+    for w in workers: w.start()
+    for w in workers: w.join()
+    print "%d threads x %d requests, %d failed" % (threads, count, len(failures))
+    for failure in failures[:10]:
+        print "  ", failure
     
 
 if __name__ == '__main__':
@@ -142,8 +417,13 @@ if __name__ == '__main__':
     parser = argparse.ArgumentParser(description="Kerberos authentication handler for the requests package.")
     parser.add_argument("--user", dest="user", help="user to impersonate, otherwise the current kerberos principal will be used", default=None)
     parser.add_argument("--url", dest="url", help="kerberos protected site")
-    parser.add_argument("--spn", dest="spn", help="spn to use, if not given HTTP@domain will be used")
+    parser.add_argument("--spn", dest="spn", help="spn to use, if not given s4u2p_util.spn_resolver works it out (HTTP@domain by default)")
     parser.add_argument("--keytab", dest="keytab", help="path to keytab if you won't use system's default one (only needed for impersonation)", default=None)
+    parser.add_argument("--proxy", dest="proxy", help="proxy to send the requests through (http://proxy:port), it may ask for Negotiate too", default=None)
+    parser.add_argument("--proxy-spn", dest="proxy_spn", help="spn of the proxy, if not given it's worked out like the site's", default=None)
+    parser.add_argument("--threads", dest="threads", type=int, help="also run requests from this many threads sharing the session", default=0)
+    parser.add_argument("--count", dest="count", type=int, help="number of requests per thread", default=10)
+    parser.add_argument("--preemptive", dest="preemptive", action="store_true", help="send the Negotiate header without waiting for a 401 once a host is known to require it")
     args = parser.parse_args()
     
     test(args)
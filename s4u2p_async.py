@@ -0,0 +1,290 @@
+# -*- coding: utf8 -*-
+#!/usr/bin/python3
+
+# Copyright 2012 Norman Krämer
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#     http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Negotiate handshakes for asyncio based http clients (python 3 only), used by
+httpx_kerberosauth and aiohttp_kerberosauth.
+
+Calls that may talk to the KDC (init and step) run on a bounded thread pool, the extension
+releases the GIL while it waits for the KDC, so they don't hold up the event loop or each other.
+Calls that only work on local state (response, clean) run on the loop. The delegated credentials
+are cached by the extension, concurrent inits for one user are coalesced by
+s4u2p_util.impersonation_init, so all tasks share the credentials of a user.
+"""
+
+import asyncio
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import kerberos as k
+import s4u2p
+import s4u2p_util
+
+log = logging.getLogger("s4u2p_async")
+
+DEFAULT_MAX_WORKERS = 16
+
+_executor = None
+_executor_lock = threading.Lock()
+
+def default_executor():
+    """the thread pool shared by all negotiators that weren't given their own"""
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(max_workers=DEFAULT_MAX_WORKERS, thread_name_prefix="s4u2p-gss")
+        return _executor
+
+class NegotiateError(Exception):
+    """the handshake didn't work out, e.g. the server's mutual authentication token was rejected"""
+
+class Negotiator(object):
+    """
+    Does the client side of a Negotiate handshake as as_user (the current kerberos principal if
+    None) for one http adapter. Every handshake gets its own context, a Negotiator can be used
+    by any number of tasks at once.
+    """
+
+    def __init__(self, as_user=None, spn=None, gssflags=k.GSS_C_MUTUAL_FLAG|k.GSS_C_SEQUENCE_FLAG,
+                 executor=None, context_pool=None):
+        """
+        @param spn: the service principal, by default s4u2p_util.spn_resolver works it out.
+        @param executor: a concurrent.futures executor to run the KDC bound calls on, by default
+        one shared thread pool of DEFAULT_MAX_WORKERS threads.
+        @param context_pool: a s4u2p_util.ContextPool to reuse impersonation contexts from, by
+        default a pool private to this negotiator is used. Only used when impersonating.
+        """
+        self.as_user = as_user
+        self.spn = spn
+        self.gssflags = gssflags
+        self.executor = executor
+        if as_user:
+            self.context_pool = context_pool or s4u2p_util.ContextPool()
+            self.gss_step = s4u2p.authGSSImpersonationStep
+            self.gss_response = s4u2p.authGSSImpersonationResponse
+            self.gss_clean = s4u2p.authGSSImpersonationClean
+            self.GSSError = s4u2p.GSSError
+        else:
+            self.context_pool = None
+            self.gss_step = k.authGSSClientStep
+            self.gss_response = k.authGSSClientResponse
+            self.gss_clean = k.authGSSClientClean
+            self.GSSError = k.GSSError
+
+    def get_spn(self, host, port=None):
+        if self.spn is None:
+            return s4u2p_util.resolve_spn(host, port, principal=bool(self.as_user))
+        return self.spn
+
+    def init(self, host, port=None):
+        """a new context for host, ready for the first step (blocking)"""
+        spn = self.get_spn(host, port)
+        if self.context_pool is not None:
+            return spn, self.context_pool.acquire(self.as_user, spn, self.gssflags)
+        result, context = k.authGSSClientInit(spn, self.gssflags)
+        if result < 1:
+            raise NegotiateError("authGSSClientInit returned result %d" % result)
+        return spn, context
+
+    def first_token(self, host, port=None):
+        """
+        Starts a handshake with host (blocking). Returns (state, header) with the value of the
+        Authorization header to send and the state to pass to check and clean.
+        """
+        spn, context = self.init(host, port)
+        try:
+            try:
+                result = self.gss_step(context, "")
+            except self.GSSError as e:
+                if self.as_user:
+                    s4u2p_util.remember_step_error(self.as_user, spn, e)
+                raise
+            if result < 0:
+                raise NegotiateError("gss_step returned result %d" % result)
+            return (spn, context), "Negotiate %s" % self.gss_response(context)
+        except:
+            self.clean((spn, context), reuse=False)
+            raise
+
+    def check(self, state, neg_value):
+        """checks the server's mutual authentication token (blocking), raises NegotiateError if it's bad"""
+        if not neg_value:
+            if self.gssflags & k.GSS_C_MUTUAL_FLAG:
+                log.debug("server sent no mutual authentication token")
+            return
+        try:
+            result = self.gss_step(state[1], neg_value)
+        except self.GSSError as e:
+            raise NegotiateError("mutual authentication failed: %s" % (e,))
+        if result < 0:
+            raise NegotiateError("gss_step returned result %d" % result)
+
+    def clean(self, state, reuse=True):
+        """done with the handshake, pooled contexts go back to the pool if reuse is set"""
+        spn, context = state
+        if self.context_pool is None:
+            self.gss_clean(context)
+        elif reuse:
+            self.context_pool.release(self.as_user, spn, self.gssflags, context)
+        else:
+            self.context_pool.discard(context)
+
+    async def run(self, fn, *args):
+        """runs a blocking call on the executor"""
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor or default_executor(), fn, *args)
+
+    async def async_first_token(self, host, port=None):
+        return await self.run(self.first_token, host, port)
+
+    async def async_check(self, state, neg_value):
+        # without a token to verify there's nothing that could block
+        if not neg_value:
+            return self.check(state, neg_value)
+        return await self.run(self.check, state, neg_value)
+
+class LoopLag(object):
+    """
+    Measures how late the event loop wakes up a task sleeping interval seconds, a loop that's
+    blocked by some call shows up as lag.
+    """
+
+    def __init__(self, interval=0.01):
+        self.interval = interval
+        self.lags = []
+        self.task = None
+
+    async def watch(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            start = loop.time()
+            await asyncio.sleep(self.interval)
+            self.lags.append(loop.time() - start - self.interval)
+
+    def start(self):
+        self.task = asyncio.ensure_future(self.watch())
+
+    async def stop(self):
+        self.task.cancel()
+        try:
+            await self.task
+        except asyncio.CancelledError:
+            pass
+
+    def percentile(self, p):
+        lags = sorted(self.lags) or [0]
+        return lags[min(len(lags) - 1, int(len(lags) * p / 100.0))]
+
+    def report(self):
+        return "loop lag p50=%.3fms p99=%.3fms max=%.3fms (%d samples)" % (
+            self.percentile(50) * 1000, self.percentile(99) * 1000, max(self.lags or [0]) * 1000, len(self.lags))
+
+async def load_test(fetch, users, concurrency, count):
+    """
+    Runs count calls of fetch(as_user) with at most concurrency at a time, the users taken in
+    turn, and prints the failures and the event loop's lag meanwhile.
+    """
+    lag = LoopLag()
+    lag.start()
+    semaphore = asyncio.Semaphore(concurrency)
+    failures = []
+
+    async def one(i):
+        async with semaphore:
+            try:
+                status = await fetch(users[i % len(users)])
+                if status != 200:
+                    failures.append(status)
+            except Exception as e:
+                failures.append(e)
+
+    start = time.time()
+    await asyncio.gather(*[one(i) for i in range(count)])
+    duration = time.time() - start
+    await lag.stop()
+    print("%d requests as %d users, %d at a time: %.3fs, %d failed" % (count, len(users), concurrency, duration, len(failures)))
+    for failure in failures[:10]:
+        print("  ", failure)
+    print(lag.report())
+    return failures
+
+async def latency_test(negotiator, users, host, concurrency, count, blocking):
+    """
+    Starts count handshakes with host as the users in turn, with at most concurrency at a time,
+    and reports the event loop's lag meanwhile. With blocking set the GSS calls are made right
+    on the loop, the way an adapter without the executor would make them.
+    """
+    lag = LoopLag()
+    lag.start()
+    semaphore = asyncio.Semaphore(concurrency)
+    failures = []
+
+    async def one(i):
+        async with semaphore:
+            await asyncio.sleep(0) # let the other tasks (and the lag watcher) in between handshakes
+            user_negotiator = Negotiator(users[i % len(users)], negotiator.spn, negotiator.gssflags,
+                                         negotiator.executor, negotiator.context_pool)
+            try:
+                if blocking:
+                    state, _header = user_negotiator.first_token(host)
+                else:
+                    state, _header = await user_negotiator.async_first_token(host)
+                user_negotiator.clean(state)
+            except Exception as e:
+                failures.append(e)
+
+    start = time.time()
+    await asyncio.gather(*[one(i) for i in range(count)])
+    duration = time.time() - start
+    await lag.stop()
+    print("%-8s %d handshakes as %d users, %d at a time: %.3fs, %d failed" % (
+        blocking and "loop" or "executor", count, len(users), concurrency, duration, len(failures)))
+    for failure in failures[:3]:
+        print("  ", failure)
+    print("%-8s %s" % ("", lag.report()))
+    return lag
+
+def test(args):
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(levelname)s %(message)s')
+    if args.keytab:
+        s4u2p.authGSSKeytab(args.keytab, args.principal)
+    s4u2p.authGSSCredCacheConfig(maxentries=0) # every handshake asks the KDC
+    negotiator = Negotiator(args.user[0], args.spn, executor=ThreadPoolExecutor(max_workers=args.workers))
+
+    async def run():
+        for blocking in (True, False):
+            await latency_test(negotiator, args.user, args.host, args.concurrency, args.count, blocking)
+
+    asyncio.run(run())
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Event loop lag while impersonated Negotiate handshakes run on the loop vs. on the executor.")
+    parser.add_argument("--user", dest="user", action="append", help="user to impersonate (repeat for several users)", required=True)
+    parser.add_argument("--host", dest="host", help="host to start the handshakes with", required=True)
+    parser.add_argument("--spn", dest="spn", help="spn to use, if not given s4u2p_util.spn_resolver works it out (HTTP@domain by default)")
+    parser.add_argument("--keytab", dest="keytab", help="path to keytab if you won't use system's default one", default=None)
+    parser.add_argument("--principal", dest="principal", help="impersonator's principal in the keytab, to get its TGT from the keytab instead of kinit", default=None)
+    parser.add_argument("--concurrency", dest="concurrency", type=int, help="concurrent handshakes", default=16)
+    parser.add_argument("--count", dest="count", type=int, help="number of handshakes per run", default=200)
+    parser.add_argument("--workers", dest="workers", type=int, help="threads doing the GSS calls", default=16)
+    args = parser.parse_args()
+
+    test(args)
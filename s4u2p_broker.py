@@ -0,0 +1,272 @@
+# -*- coding: utf8 -*-
+#!/usr/bin/python
+
+# Copyright 2012 Norman Krämer
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#     http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Credential broker: one process does the S4U exchanges and keeps the delegated credentials,
+the worker processes of a server get them over a unix socket.
+
+Start the broker (as the user owning the impersonator's keytab):
+
+    s4u2p-broker --socket /run/s4u2p.sock --keytab ./server.keytab
+
+and let the workers use it, either by setting S4U2P_BROKER=/run/s4u2p.sock in their
+environment or by calling s4u2p_util.use_broker("/run/s4u2p.sock"). Everything going through
+s4u2p_util.impersonation_init (that is all the http adapters) then asks the broker.
+
+The exported credentials contain session keys, the socket is only accessible to the broker's
+user by default.
+"""
+
+import os
+import sys
+import json
+import signal
+import socket
+import struct
+import logging
+import threading
+try:
+    import socketserver
+except ImportError:
+    import SocketServer as socketserver
+
+import s4u2p
+import s4u2p_util
+
+log = logging.getLogger("s4u2p_broker")
+
+# requests and exported credentials are a few KB, a bigger frame is garbage or an attack
+MAX_FRAME = 1 << 20
+
+class BrokerError(s4u2p.KrbError):
+    """the broker couldn't be reached or didn't answer properly"""
+
+class FrameError(BrokerError):
+    """the peer announced a frame bigger than MAX_FRAME, the connection can't be used anymore"""
+
+def send_frame(sock, payload):
+    if not isinstance(payload, bytes): # json
+        payload = payload.encode("utf-8")
+    sock.sendall(struct.pack(">I", len(payload)) + payload)
+
+def recv_exactly(sock, length):
+    chunks = []
+    while length:
+        chunk = sock.recv(length)
+        if not chunk:
+            raise EOFError("connection closed")
+        chunks.append(chunk)
+        length -= len(chunk)
+    return b"".join(chunks)
+
+def recv_frame(sock):
+    length, = struct.unpack(">I", recv_exactly(sock, 4))
+    if length > MAX_FRAME:
+        raise FrameError("frame of %d bytes, at most %d are accepted" % (length, MAX_FRAME))
+    return recv_exactly(sock, length)
+
+def recv_json(sock):
+    return json.loads(recv_frame(sock).decode("utf-8"))
+
+class BrokerHandler(socketserver.BaseRequestHandler):
+    """
+    Serves requests of one worker connection. A request is a json object with as_user, service
+    and optionally mode, refresh and impersonator. The answer is a json object, on success ({"ok": true})
+    followed by a frame with the exported credentials. A request that isn't a proper json object
+    is answered with an error, the connection stays usable. A frame bigger than MAX_FRAME is
+    answered with an error too, then the connection is closed.
+    """
+
+    def handle(self):
+        while True:
+            try:
+                request = recv_json(self.request)
+            except EOFError:
+                return
+            except FrameError as e:
+                log.warning("dropping connection: %s" % (e,))
+                send_frame(self.request, json.dumps({"ok": False, "error": str(e)}))
+                return
+            except ValueError as e: # also UnicodeDecodeError
+                log.warning("malformed request: %s" % (e,))
+                send_frame(self.request, json.dumps({"ok": False, "error": "malformed request: %s" % (e,)}))
+                continue
+            if not isinstance(request, dict):
+                send_frame(self.request, json.dumps({"ok": False, "error": "malformed request: not a json object"}))
+                continue
+            try:
+                token = self.server.export(request)
+            except s4u2p.GSSError as e:
+                send_frame(self.request, json.dumps({"ok": False, "gsserror": e.args}))
+            except Exception as e:
+                log.exception("request %r failed" % (request,))
+                send_frame(self.request, json.dumps({"ok": False, "error": str(e)}))
+            else:
+                send_frame(self.request, json.dumps({"ok": True}))
+                send_frame(self.request, token)
+
+class Broker(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+
+    daemon_threads = True
+
+    def __init__(self, path, mode=0o600):
+        if os.path.exists(path):
+            os.unlink(path)
+        # the socket must not be accessible to others for a moment between bind and chmod
+        umask = os.umask(0o177)
+        try:
+            socketserver.UnixStreamServer.__init__(self, path, BrokerHandler)
+        finally:
+            os.umask(umask)
+        os.chmod(path, mode)
+        s4u2p_util.use_broker(None) # we are the broker
+        self.lock = threading.Lock()
+        self.requests = 0
+
+    def export(self, request):
+        """exported credentials of as_user for service, obtained like any impersonation_init"""
+        self.lock.acquire()
+        try:
+            self.requests += 1
+        finally:
+            self.lock.release()
+        as_user, service = request["as_user"], request["service"]
+        _result, context = s4u2p_util.impersonation_init(as_user, service, mode=request.get("mode", s4u2p.S4U_MODE_LOOPBACK),
+                                                         refresh=request.get("refresh", False),
+                                                         impersonator=request.get("impersonator"))
+        try:
+            return s4u2p.authGSSImpersonationExportCred(context)
+        finally:
+            s4u2p.authGSSImpersonationClean(context)
+
+    def stats(self):
+        self.lock.acquire()
+        try:
+            stats = dict(requests=self.requests)
+        finally:
+            self.lock.release()
+        stats.update(("cache_%s" % k, v) for k, v in s4u2p.authGSSCredCacheStats().items())
+        stats.update(("negative_%s" % k, v) for k, v in s4u2p_util.negative_cache.stats().items())
+        return stats
+
+    def server_close(self):
+        socketserver.UnixStreamServer.server_close(self)
+        if os.path.exists(self.server_address):
+            os.unlink(self.server_address)
+
+class BrokerClient(object):
+    """
+    Gets delegated credentials from a broker. Every thread keeps its own connection.
+    """
+
+    def __init__(self, path, timeout=30, fallback=True):
+        """
+        @param path: the broker's socket.
+        @param timeout: seconds to wait for the broker.
+        @param fallback: if the broker can't be reached, do the S4U exchange in this process.
+        """
+        self.path = path
+        self.timeout = timeout
+        self.fallback = fallback
+        self.local = threading.local()
+
+    def connection(self):
+        sock = getattr(self.local, "sock", None)
+        if sock is None:
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            sock.settimeout(self.timeout)
+            sock.connect(self.path)
+            self.local.sock = sock
+        return sock
+
+    def close(self):
+        sock = getattr(self.local, "sock", None)
+        self.local.sock = None
+        if sock is not None:
+            sock.close()
+
+    def ask(self, request):
+        sock = self.connection()
+        send_frame(sock, json.dumps(request))
+        try:
+            answer = recv_json(sock)
+            if answer["ok"]:
+                return recv_frame(sock)
+        except FrameError:
+            self.close()
+            raise
+        if "gsserror" in answer:
+            raise s4u2p.GSSError(*[tuple(part) for part in answer["gsserror"]])
+        raise BrokerError(answer.get("error"))
+
+    def export(self, as_user, service, mode=s4u2p.S4U_MODE_LOOPBACK, refresh=False, impersonator=None):
+        """the exported credentials of as_user for service"""
+        request = dict(as_user=as_user, service=service, mode=mode, refresh=bool(refresh), impersonator=impersonator)
+        for attempt in (0, 1): # a kept connection may have been closed by a restarted broker
+            try:
+                return self.ask(request)
+            except (socket.error, EOFError) as e:
+                self.close()
+                error = e
+        raise BrokerError("broker at %s failed: %s" % (self.path, error))
+
+    def init(self, as_user, service, gssflags=s4u2p.GSS_C_MUTUAL_FLAG|s4u2p.GSS_C_SEQUENCE_FLAG,
+             mode=s4u2p.S4U_MODE_LOOPBACK, refresh=False, impersonator=None):
+        """same as s4u2p.authGSSImpersonationInit, with the credentials from the broker"""
+        try:
+            token = self.export(as_user, service, mode, refresh, impersonator)
+        except BrokerError as e:
+            if not self.fallback:
+                raise
+            log.warning("%s, impersonating locally" % (e,))
+            return s4u2p.authGSSImpersonationInit(as_user, service, gssflags, mode, refresh, impersonator)
+        return s4u2p.authGSSImpersonationInitFromCred(token, service, gssflags)
+
+def main(argv=None):
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Broker handing out delegated kerberos credentials to local processes.")
+    parser.add_argument("--socket", dest="socket", help="path of the unix socket to listen on", required=True)
+    parser.add_argument("--keytab", dest="keytab", help="path to keytab if you won't use system's default one", default=None)
+    parser.add_argument("--principal", dest="principal", help="impersonator's principal in the keytab, to get its TGT from the keytab instead of kinit", default=None)
+    parser.add_argument("--permissions", dest="permissions", help="permissions of the socket (octal)", default="0600")
+    parser.add_argument("--maxentries", dest="maxentries", type=int, help="size of the credential cache", default=512)
+    parser.add_argument("--minlifetime", dest="minlifetime", type=int, help="minimum remaining lifetime of cached credentials in seconds", default=60)
+    parser.add_argument("--refresh", dest="refresh", action="store_true", help="refresh the credentials in use before they expire")
+    parser.add_argument("--verbose", dest="verbose", action="store_true", help="log debug messages")
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=args.verbose and logging.DEBUG or logging.INFO, format='%(asctime)s %(levelname)s %(message)s')
+    if args.keytab:
+        s4u2p.authGSSKeytab(args.keytab, args.principal)
+    s4u2p.authGSSCredCacheConfig(args.maxentries, args.minlifetime)
+    if args.refresh:
+        s4u2p_util.start_refresher()
+
+    broker = Broker(args.socket, int(args.permissions, 8))
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    log.info("listening on %s" % args.socket)
+    try:
+        broker.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        log.info("stats: %s" % broker.stats())
+        broker.server_close()
+
+if __name__ == '__main__':
+    main()
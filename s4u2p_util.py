@@ -0,0 +1,900 @@
+# -*- coding: utf8 -*-
+#!/usr/bin/python
+
+# Copyright 2012 Norman Krämer
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#     http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Helpers on top of the s4u2p extension shared by the http adapters.
+"""
+
+import s4u2p
+import os
+import threading
+import time
+import logging
+from collections import deque
+
+log = logging.getLogger("s4u2p_util")
+
+def wrap_stream(context, chunks, conf=True):
+    """
+    Protects a stream of data chunk by chunk, each chunk becomes one wrap token.
+
+    Chunks that are writable buffers (bytearray) are encrypted in place, others are copied into
+    a bytearray first. For every chunk (header, data, trailer) is yielded, header + data + trailer
+    is the token to send. Nothing is concatenated, so write the three parts out one after the other.
+
+    @param context: an established context (see authGSSImpersonationWrap).
+    @param chunks: an iterable of buffers.
+    @param conf: if true the chunks are encrypted, otherwise only integrity protected.
+    """
+    for chunk in chunks:
+        if not isinstance(chunk, bytearray):
+            chunk = bytearray(chunk)
+        header, trailer, _conf_state = s4u2p.authGSSImpersonationWrap(context, chunk, conf)
+        yield header, chunk, trailer
+
+def unwrap_stream(context, tokens):
+    """
+    Unprotects a stream of wrap tokens, one token per item.
+
+    Tokens that are writable buffers (bytearray) are decrypted in place, others are copied into a
+    bytearray first. For every token a memoryview of the message within the token is yielded.
+
+    @param context: an established context (see authGSSImpersonationUnwrap).
+    @param tokens: an iterable of buffers, each containing one complete token.
+    """
+    for token in tokens:
+        if not isinstance(token, bytearray):
+            token = bytearray(token)
+        offset, length, _conf_state = s4u2p.authGSSImpersonationUnwrap(context, token)
+        yield memoryview(token)[offset:offset + length]
+
+def is_stream(body):
+    """whether body is consumed while it's sent: files, sockets, iterators and generators"""
+    return hasattr(body, "read") or hasattr(body, "__next__") or hasattr(body, "next")
+
+def body_position(body):
+    """
+    Where a request body starts, so it can be sent again after a 401: the current position of
+    seekable streams, None for streams that can't be sent twice (e.g. pipes, sockets, iterators
+    and generators), 0 for anything else (strings, dicts to be encoded, lists of chunks).
+    """
+    if not is_stream(body):
+        return 0
+    try:
+        return body.tell()
+    except (AttributeError, IOError, OSError):
+        return None
+
+def rewind_body(body, position):
+    """prepares body to be sent again, returns False if that's not possible"""
+    if position is None:
+        return False
+    if hasattr(body, "seek"):
+        try:
+            body.seek(position)
+        except (IOError, OSError):
+            return False
+    return True
+
+class SingleFlight(object):
+    """
+    Lets only one call per key run at a time, callers arriving while it runs wait for it
+    and share its outcome.
+    """
+
+    class Call(object):
+        def __init__(self):
+            self.done = threading.Event()
+            self.result = None
+            self.error = None
+
+    def __init__(self):
+        self.calls = {}
+        self.lock = threading.Lock()
+
+    def do(self, key, fn, *args, **kwargs):
+        """
+        Returns (result, leader). The leader runs fn(*args, **kwargs) and gets its result, the others
+        get the same result with leader set to False. If fn raises, every caller raises that error,
+        the others each a copy of it.
+        """
+        self.lock.acquire()
+        try:
+            call = self.calls.get(key)
+            leader = call is None
+            if leader:
+                call = self.calls[key] = SingleFlight.Call()
+        finally:
+            self.lock.release()
+
+        if leader:
+            try:
+                call.result = fn(*args, **kwargs)
+            except Exception as e:
+                call.error = e
+            self.lock.acquire()
+            try:
+                del self.calls[key]
+            finally:
+                self.lock.release()
+            call.done.set()
+        else:
+            call.done.wait()
+
+        if call.error is not None:
+            if leader:
+                raise call.error
+            raise fresh_error(call.error)
+        return call.result, leader
+
+# krb5 error codes are offsets into its com_err table, they show up as signed minor status
+KRB5_ERROR_TABLE_BASE = -1765328384
+
+# errors that won't go away by asking the KDC again, anything else (e.g. KDC unreachable,
+# clock skew, service unavailable) is never cached
+PERMANENT_ERRORS = frozenset(KRB5_ERROR_TABLE_BASE + code for code in (
+    6,  # KDC_ERR_C_PRINCIPAL_UNKNOWN, no such user
+    7,  # KDC_ERR_S_PRINCIPAL_UNKNOWN, no such service
+    12, # KDC_ERR_POLICY, e.g. no delegation allowed to this service
+    13, # KDC_ERR_BADOPTION, e.g. account is sensitive and cannot be delegated
+    18, # KDC_ERR_CLIENT_REVOKED, account disabled or locked out
+    23, # KDC_ERR_KEY_EXPIRED, password expired
+))
+
+def fresh_error(error):
+    """
+    A new exception like error to raise. Raising one instance again and again, or from several
+    threads, makes them share its traceback, which grows with every raise.
+    """
+    try:
+        return error.__class__(*error.args)
+    except Exception:
+        return error
+
+def minor_status(error):
+    """the minor status code of a s4u2p.GSSError, None if there is none"""
+    try:
+        return error.args[1][1]
+    except (IndexError, TypeError):
+        return None
+
+class NegativeCache(object):
+    """
+    Remembers permanent failures per key for ttl seconds, so they can be raised again
+    without asking the KDC.
+    """
+
+    def __init__(self, ttl=60, permanent=PERMANENT_ERRORS):
+        """
+        @param ttl: seconds a failure is remembered, 0 disables the cache.
+        @param permanent: minor status codes that are cached.
+        """
+        self.ttl = ttl
+        self.permanent = permanent
+        self.entries = {}
+        self.lock = threading.Lock()
+        self.suppressed = 0
+        self.stored = 0
+
+    def check(self, key):
+        """raises the remembered error for key, if there is one"""
+        self.lock.acquire()
+        try:
+            entry = self.entries.get(key)
+            if entry is None:
+                return
+            expires, error = entry
+            if expires <= time.time():
+                del self.entries[key]
+                return
+            self.suppressed += 1
+        finally:
+            self.lock.release()
+        raise fresh_error(error)
+
+    def remember(self, key, error):
+        """caches error for key if it's a permanent one, returns whether it was cached"""
+        if self.ttl <= 0 or minor_status(error) not in self.permanent:
+            return False
+        self.lock.acquire()
+        try:
+            self.entries[key] = (time.time() + self.ttl, error)
+            self.stored += 1
+        finally:
+            self.lock.release()
+        return True
+
+    def forget(self, key):
+        self.lock.acquire()
+        try:
+            self.entries.pop(key, None)
+        finally:
+            self.lock.release()
+
+    def clear(self):
+        self.lock.acquire()
+        try:
+            self.entries.clear()
+        finally:
+            self.lock.release()
+
+    def stats(self):
+        """number of entries, failures stored and KDC calls suppressed so far"""
+        self.lock.acquire()
+        try:
+            return dict(entries=len(self.entries), stored=self.stored, suppressed=self.suppressed)
+        finally:
+            self.lock.release()
+
+negative_cache = NegativeCache()
+
+_broker = None
+_broker_checked = False
+
+def use_broker(path, **kwargs):
+    """
+    Let impersonation_init get the credentials from the s4u2p_broker listening at path instead
+    of doing the S4U exchange in this process, None switches back. kwargs are passed to
+    s4u2p_broker.BrokerClient. Without a call to this S4U2P_BROKER from the environment is used.
+    """
+    global _broker, _broker_checked
+    _broker_checked = True
+    if path is None:
+        _broker = None
+    else:
+        from s4u2p_broker import BrokerClient
+        _broker = BrokerClient(path, **kwargs)
+    return _broker
+
+def _init_context(as_user, service, *args, **kwargs):
+    if not _broker_checked:
+        use_broker(os.environ.get("S4U2P_BROKER") or None)
+    if _broker is not None:
+        return _broker.init(as_user, service, *args, **kwargs)
+    return s4u2p.authGSSImpersonationInit(as_user, service, *args, **kwargs)
+
+def _init(key, as_user, service, *args, **kwargs):
+    try:
+        return _init_context(as_user, service, *args, **kwargs)
+    except s4u2p.GSSError as e:
+        negative_cache.remember(key, e)
+        raise
+
+def _argument(args, kwargs, name, position, default=None):
+    """an argument after service of an authGSSImpersonationInit call"""
+    if name in kwargs:
+        return kwargs[name]
+    if len(args) > position:
+        return args[position]
+    return default
+
+_inits = SingleFlight()
+
+def init_key(as_user, service, mode=s4u2p.S4U_MODE_LOOPBACK, impersonator=None):
+    """the key of an impersonation_init in negative_cache"""
+    return as_user, service, mode, impersonator
+
+def remember_step_error(as_user, service, error, mode=s4u2p.S4U_MODE_LOOPBACK, impersonator=None):
+    """
+    Records a failed authGSSImpersonationStep of a context from impersonation_init. S4U2Proxy
+    happens in the first step, so that's where users that can't be delegated to service fail;
+    if the error is a permanent one, impersonation_init raises it again right away for a while.
+    Returns whether it was cached.
+    """
+    return negative_cache.remember(init_key(as_user, service, mode, impersonator), error)
+
+DEFAULT_GSSFLAGS = s4u2p.GSS_C_MUTUAL_FLAG | s4u2p.GSS_C_SEQUENCE_FLAG
+
+def impersonation_init(as_user, service, *args, **kwargs):
+    """
+    Same as s4u2p.authGSSImpersonationInit, but only one init per (as_user, service, mode, impersonator)
+    goes to the KDC at a time. Callers that come in meanwhile wait for it: if it failed they raise
+    its error, otherwise they init their own context, which is served from the credential cache.
+
+    Permanent failures (unknown or disabled users, users that can't be delegated) are kept in
+    negative_cache for a while and raised again right away. Whether a user can be delegated
+    only shows in the first step, report failed steps with remember_step_error.
+
+    If a broker is used (see use_broker), the credentials come from there.
+    """
+    mode = _argument(args, kwargs, "mode", 1, s4u2p.S4U_MODE_LOOPBACK)
+    impersonator = _argument(args, kwargs, "impersonator", 3)
+    key = init_key(as_user, service, mode, impersonator)
+    negative_cache.check(key)
+    if _refresher is not None:
+        _refresher.touch(as_user, service, _argument(args, kwargs, "gssflags", 0, DEFAULT_GSSFLAGS),
+                         mode, impersonator)
+    result, leader = _inits.do(key, _init, key, as_user, service, *args, **kwargs)
+    if leader:
+        return result
+    return _init_context(as_user, service, *args, **kwargs)
+
+class CredentialRefresher(object):
+    """
+    Gets new delegated credentials for the (as_user, service, gssflags, mode, impersonator) pairs
+    in use before the old ones expire, so requests don't have to wait for the KDC.
+
+    A background thread looks at the remaining lifetime of the cached credentials of every pair
+    used within the last idle seconds and refreshes them once less than fraction of their lifetime is left.
+    The credentials are inquired and refreshed the way impersonation_init gets them, so with a
+    broker (see use_broker) it's the broker's credentials that are refreshed.
+    """
+
+    def __init__(self, fraction=0.2, interval=30, idle=3600):
+        """
+        @param fraction: part of the lifetime left at which the credentials are refreshed.
+        @param interval: maximum number of seconds between two looks at a pair.
+        @param idle: pairs not used for this many seconds are no longer refreshed.
+        """
+        self.fraction = fraction
+        self.interval = interval
+        self.idle = idle
+        self.pairs = {} # (as_user, service, gssflags, mode, impersonator) -> [last used, full lifetime, next check]
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.thread = None
+        self.refreshed = 0
+        self.failed = 0
+
+    def touch(self, as_user, service, gssflags=DEFAULT_GSSFLAGS, mode=s4u2p.S4U_MODE_LOOPBACK, impersonator=None):
+        """marks a pair as being used"""
+        key = (as_user, service, gssflags, mode, impersonator)
+        now = time.time()
+        self.lock.acquire()
+        try:
+            pair = self.pairs.get(key)
+            if pair is None:
+                self.pairs[key] = [now, None, now]
+            else:
+                pair[0] = now
+        finally:
+            self.lock.release()
+
+    def inquire(self, key, refresh=False):
+        """remaining lifetime of the (cached) credentials of a pair, new ones are obtained if refresh is set"""
+        as_user, service, gssflags, mode, impersonator = key
+        _result, context = _init_context(as_user, service, gssflags, mode, refresh, impersonator=impersonator)
+        try:
+            return s4u2p.authGSSImpersonationInquireCred(context)["lifetime"]
+        finally:
+            s4u2p.authGSSImpersonationClean(context)
+
+    def check(self, key, pair, now):
+        """looks at one pair, refreshes it if necessary and returns when to look again"""
+        lifetime = self.inquire(key)
+        if pair[1] is None or lifetime > pair[1]:
+            pair[1] = lifetime
+        if lifetime <= pair[1] * self.fraction:
+            log.debug("refreshing credentials of %s for %s, %ds left" % (key[0], key[1], lifetime))
+            lifetime = pair[1] = self.inquire(key, refresh=True)
+            self.refreshed += 1
+        return now + max(1, min(self.interval, lifetime - pair[1] * self.fraction))
+
+    def run_once(self):
+        """checks all pairs that are due, returns the number of seconds until the next one is"""
+        now = time.time()
+        self.lock.acquire()
+        try:
+            for key, pair in list(self.pairs.items()):
+                if pair[0] + self.idle < now:
+                    del self.pairs[key]
+            due = [(key, pair) for key, pair in self.pairs.items() if pair[2] <= now]
+        finally:
+            self.lock.release()
+
+        for key, pair in due:
+            try:
+                pair[2] = self.check(key, pair, now)
+            except s4u2p.KrbError as e: # GSSError or BrokerError
+                log.warning("refreshing credentials of %s for %s failed: %s" % (key[0], key[1], e))
+                self.failed += 1
+                pair[2] = now + self.interval
+
+        self.lock.acquire()
+        try:
+            checks = [pair[2] for pair in self.pairs.values()]
+        finally:
+            self.lock.release()
+        return max(1, min(checks or [now + self.interval]) - time.time())
+
+    def run(self):
+        while not self.stopped.is_set():
+            self.stopped.wait(self.run_once())
+
+    def start(self):
+        self.stopped.clear()
+        self.thread = threading.Thread(target=self.run, name="s4u2p credential refresher")
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+
+    def stats(self):
+        """number of pairs watched, refreshes done and refreshes failed"""
+        return dict(pairs=len(self.pairs), refreshed=self.refreshed, failed=self.failed)
+
+_refresher = None
+
+def start_refresher(**kwargs):
+    """
+    Starts refreshing the credentials of the pairs passed to impersonation_init in the
+    background, kwargs are passed to CredentialRefresher. Returns the refresher.
+    """
+    global _refresher
+    stop_refresher()
+    _refresher = CredentialRefresher(**kwargs)
+    _refresher.start()
+    return _refresher
+
+def stop_refresher():
+    global _refresher
+    if _refresher is not None:
+        _refresher.stop()
+        _refresher = None
+
+class ContextPool(object):
+    """
+    Keeps a few idle impersonation contexts per (as_user, spn, gssflags) around.
+
+    A context that's done is reset with authGSSImpersonationCleanCtx and handed out again for
+    the same user and service, which saves the authGSSImpersonationInit. The pool is thread safe,
+    a context is only ever handed to one caller at a time.
+
+    Idle contexts keep the delegated credentials they were initialized with, they are dropped
+    once less than min_lifetime of them is left. New contexts then get the current credentials
+    from the credential cache, e.g. the ones a CredentialRefresher obtained meanwhile.
+    """
+
+    def __init__(self, size=4, min_lifetime=None):
+        """
+        @param size: number of idle contexts kept per (as_user, spn, gssflags).
+        @param min_lifetime: seconds the credentials of an idle context must have left, by
+        default the credential cache's minlifetime (see authGSSCredCacheConfig).
+        """
+        self.size = size
+        self.min_lifetime = min_lifetime
+        self.idle = {} # (as_user, spn, gssflags) -> list of (expires, context)
+        self.lock = threading.Lock()
+        self.expired = 0
+
+    def expires(self, context):
+        """when context has to be dropped, 0 if its credentials can't be inquired"""
+        min_lifetime = self.min_lifetime
+        if min_lifetime is None:
+            min_lifetime = s4u2p.authGSSCredCacheStats()["minlifetime"]
+        try:
+            lifetime = s4u2p.authGSSImpersonationInquireCred(context)["lifetime"]
+        except s4u2p.GSSError:
+            return 0
+        return time.time() + lifetime - min_lifetime
+
+    def acquire(self, as_user, spn, gssflags):
+        """
+        Returns a context for as_user and spn, ready for the first step.
+        Raises s4u2p.GSSError if a new context can't be initialized, or if a permanent failure
+        of as_user with spn is in negative_cache.
+        """
+        negative_cache.check(init_key(as_user, spn))
+        key = (as_user, spn, gssflags)
+        stale = []
+        found = None
+        self.lock.acquire()
+        try:
+            contexts = self.idle.get(key)
+            now = time.time()
+            while contexts:
+                expires, context = contexts.pop()
+                if expires > now:
+                    found = context
+                    break
+                stale.append(context)
+            self.expired += len(stale)
+        finally:
+            self.lock.release()
+
+        for context in stale:
+            s4u2p.authGSSImpersonationClean(context)
+        if found is not None:
+            return found
+
+        _result, context = impersonation_init(as_user, spn, gssflags)
+        return context
+
+    def release(self, as_user, spn, gssflags, context):
+        """
+        Gives a context obtained with acquire back, it's cleaned for reuse.
+        """
+        s4u2p.authGSSImpersonationCleanCtx(context)
+        expires = self.expires(context)
+        key = (as_user, spn, gssflags)
+        self.lock.acquire()
+        try:
+            contexts = self.idle.setdefault(key, [])
+            if expires > time.time() and len(contexts) < self.size:
+                contexts.append((expires, context))
+                return
+        finally:
+            self.lock.release()
+        s4u2p.authGSSImpersonationClean(context)
+
+    def discard(self, context):
+        """
+        Drops a context obtained with acquire that shouldn't be used again, e.g. after an error.
+        """
+        s4u2p.authGSSImpersonationClean(context)
+
+    def clear(self):
+        """
+        Cleans all idle contexts.
+        """
+        self.lock.acquire()
+        try:
+            idle, self.idle = self.idle, {}
+        finally:
+            self.lock.release()
+        for contexts in idle.values():
+            for _expires, context in contexts:
+                s4u2p.authGSSImpersonationClean(context)
+
+    def stats(self):
+        """number of idle contexts and idle contexts dropped because their credentials expire"""
+        self.lock.acquire()
+        try:
+            return dict(idle=sum([len(contexts) for contexts in self.idle.values()]), expired=self.expired)
+        finally:
+            self.lock.release()
+
+class TokenPool(object):
+    """
+    Keeps a few ready to send Negotiate header values per watched (as_user, spn, mode), minted
+    by a background thread, so the request thread doesn't have to do the first step itself.
+
+    Every token comes with the context it was minted with, use it to check the server's mutual
+    authentication token and clean it afterwards. Tokens older than max_age are thrown away,
+    keep that well below the clock skew the services accept (5 minutes by default).
+    """
+
+    def __init__(self, size=4, max_age=120, gssflags=s4u2p.GSS_C_MUTUAL_FLAG|s4u2p.GSS_C_SEQUENCE_FLAG, mode=s4u2p.S4U_MODE_LOOPBACK):
+        """
+        @param size: number of tokens kept per pair.
+        @param max_age: seconds after which an unused token is discarded.
+        @param gssflags: flags the contexts are initialized with.
+        @param mode: S4U_MODE_* of the pairs watched without one.
+        """
+        self.size = size
+        self.max_age = max_age
+        self.gssflags = gssflags
+        self.mode = mode
+        self.tokens = {} # (as_user, spn, mode) -> deque of (minted, header, context), oldest first
+        self.lock = threading.Lock()
+        self.wakeup = threading.Condition(self.lock)
+        self.stopped = False
+        self.thread = None
+        self.hits = self.misses = self.minted = self.expired = self.failed = 0
+
+    def key(self, as_user, spn, mode):
+        if mode is None:
+            mode = self.mode
+        return as_user, spn, mode
+
+    def watch(self, as_user, spn, mode=None):
+        """starts keeping tokens for a pair, minted in mode (the pool's by default)"""
+        key = self.key(as_user, spn, mode)
+        self.lock.acquire()
+        try:
+            if key not in self.tokens:
+                self.tokens[key] = deque()
+                self.wakeup.notify()
+        finally:
+            self.lock.release()
+
+    def unwatch(self, as_user, spn, mode=None):
+        self.lock.acquire()
+        try:
+            tokens = self.tokens.pop(self.key(as_user, spn, mode), ())
+        finally:
+            self.lock.release()
+        for _minted, _header, context in tokens:
+            s4u2p.authGSSImpersonationClean(context)
+
+    def get(self, as_user, spn, mode=None):
+        """
+        Returns (header, context) for a watched pair, None if there is no fresh token.
+        Only tokens minted in mode (the pool's by default) are handed out.
+        """
+        stale = []
+        found = None
+        self.lock.acquire()
+        try:
+            tokens = self.tokens.get(self.key(as_user, spn, mode))
+            if tokens is not None:
+                limit = time.time() - self.max_age
+                while tokens:
+                    minted, header, context = tokens.popleft()
+                    if minted > limit:
+                        found = header, context
+                        break
+                    stale.append(context)
+                self.expired += len(stale)
+                self.wakeup.notify()
+            if found is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        finally:
+            self.lock.release()
+
+        for context in stale:
+            s4u2p.authGSSImpersonationClean(context)
+        return found
+
+    def mint(self, as_user, spn, mode=None):
+        """makes a token, returns (minted, header, context)"""
+        mode = self.key(as_user, spn, mode)[2]
+        _result, context = impersonation_init(as_user, spn, self.gssflags, mode)
+        try:
+            s4u2p.authGSSImpersonationStep(context, "")
+            return time.time(), "Negotiate %s" % s4u2p.authGSSImpersonationResponse(context), context
+        except s4u2p.GSSError as e:
+            remember_step_error(as_user, spn, e, mode)
+            s4u2p.authGSSImpersonationClean(context)
+            raise
+        except:
+            s4u2p.authGSSImpersonationClean(context)
+            raise
+
+    def fill(self):
+        """drops stale tokens and mints new ones until every pair has size of them"""
+        self.lock.acquire()
+        try:
+            limit = time.time() - self.max_age
+            stale = []
+            missing = []
+            for key, tokens in self.tokens.items():
+                while tokens and tokens[0][0] <= limit:
+                    stale.append(tokens.popleft()[2])
+                missing.extend([key] * (self.size - len(tokens)))
+            self.expired += len(stale)
+        finally:
+            self.lock.release()
+
+        for context in stale:
+            s4u2p.authGSSImpersonationClean(context)
+
+        for as_user, spn, mode in missing:
+            try:
+                token = self.mint(as_user, spn, mode)
+            except s4u2p.GSSError as e:
+                log.warning("minting a token for %s to %s failed: %s" % (as_user, spn, e))
+                self.failed += 1
+                continue
+            self.lock.acquire()
+            try:
+                tokens = self.tokens.get((as_user, spn, mode))
+                if tokens is not None and len(tokens) < self.size:
+                    tokens.append(token)
+                    self.minted += 1
+                    token = None
+            finally:
+                self.lock.release()
+            if token is not None: # unwatched or filled meanwhile
+                s4u2p.authGSSImpersonationClean(token[2])
+
+    def run(self):
+        while True:
+            self.fill()
+            self.lock.acquire()
+            try:
+                if self.stopped:
+                    break
+                # wake up when a token was taken, or to drop tokens about to get stale
+                self.wakeup.wait(max(1, self.max_age / 2))
+                if self.stopped:
+                    break
+            finally:
+                self.lock.release()
+
+    def start(self):
+        self.stopped = False
+        self.thread = threading.Thread(target=self.run, name="s4u2p token pool")
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        """stops the producer and cleans all tokens"""
+        self.lock.acquire()
+        try:
+            self.stopped = True
+            self.wakeup.notify()
+        finally:
+            self.lock.release()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+        for as_user, spn, mode in list(self.tokens):
+            self.unwatch(as_user, spn, mode)
+
+    def stats(self):
+        """tokens handed out, requests that found none, tokens minted, discarded because of age and failed mints"""
+        return dict(hits=self.hits, misses=self.misses, minted=self.minted, expired=self.expired, failed=self.failed)
+
+class SpnResolver(object):
+    """
+    Works out the service principal for a (host, port), cached for ttl seconds.
+
+    By default that's the host based name service@host, the same the adapters always used,
+    which krb5 canonicalizes with DNS lookups. With canonicalize set the host's canonical name is
+    looked up here instead and the principal name service/fqdn[@realm] is returned, the s4u2p
+    extension imports that without asking DNS. When an entry expires the stale principal is
+    still returned while a background thread looks the host up again, so DNS only ever sits in
+    the way of the very first request to a host.
+
+    Overrides take precedence over everything, they are keyed by host or by (host, port).
+    """
+
+    def __init__(self, service="HTTP", ttl=300, canonicalize=False, realm=None, overrides=None):
+        """
+        @param service: the service part of the principals.
+        @param ttl: seconds a looked up name is used before it's looked up again.
+        @param canonicalize: look up canonical host names and return principal names.
+        @param realm: realm appended to canonicalized principals, by default krb5's default realm
+        (through the principal name import) applies.
+        @param overrides: dict mapping host or (host, port) to a principal.
+        """
+        self.service = service
+        self.ttl = ttl
+        self.canonicalize = canonicalize
+        self.realm = realm
+        self.overrides = {}
+        for key, spn in (overrides or {}).items():
+            if isinstance(key, tuple):
+                self.overrides[self.override_key(*key)] = spn
+            else:
+                self.overrides[self.override_key(key)] = spn
+        self.entries = {}
+        self.refreshing = set()
+        self.lock = threading.Lock()
+        self.lookups = 0
+        self.hits = 0
+
+    def override_key(self, host, port=None):
+        return host.lower() if port is None else (host.lower(), port)
+
+    def service_name(self, spn):
+        """service@host for a principal name service/host[@realm], other names as they are"""
+        name = spn.split("@")[0]
+        if "/" not in name:
+            return spn
+        return "%s@%s" % tuple(name.split("/", 1))
+
+    def override(self, host, spn, port=None):
+        """always use spn for host (on port, if given), None removes the override"""
+        key = self.override_key(host, port)
+        self.lock.acquire()
+        try:
+            if spn is None:
+                self.overrides.pop(key, None)
+            else:
+                self.overrides[key] = spn
+        finally:
+            self.lock.release()
+
+    def lookup(self, host):
+        """the canonical name of host, host itself if it can't be resolved"""
+        import socket
+        self.lock.acquire()
+        try:
+            self.lookups += 1
+        finally:
+            self.lock.release()
+        try:
+            return socket.gethostbyname_ex(host)[0].rstrip(".").lower() or host
+        except (socket.error, UnicodeError) as e:
+            log.debug("can't canonicalize %s: %s" % (host, e))
+            return host
+
+    def principal(self, fqdn):
+        spn = "%s/%s" % (self.service, fqdn)
+        if self.realm:
+            spn = "%s@%s" % (spn, self.realm)
+        return spn
+
+    def refresh(self, host):
+        """looks host up and returns its new entry"""
+        try:
+            entry = (time.time() + self.ttl, self.principal(self.lookup(host)))
+            self.lock.acquire()
+            try:
+                self.entries[host] = entry
+            finally:
+                self.lock.release()
+            return entry
+        finally:
+            self.lock.acquire()
+            try:
+                self.refreshing.discard(host)
+            finally:
+                self.lock.release()
+
+    def spn(self, host, port=None, principal=True):
+        """
+        The service principal for host and port.
+
+        @param principal: whether the caller can use principal names (service/fqdn), the s4u2p
+        extension can, kerberos.authGSSClientInit can't and gets service@fqdn instead. Overrides
+        given as principal names are converted too.
+        """
+        host = host.lower()
+        start = False
+        self.lock.acquire()
+        try:
+            spn = self.overrides.get((host, port)) or self.overrides.get(host)
+            if spn is None and self.canonicalize:
+                entry = self.entries.get(host)
+                if entry is not None:
+                    self.hits += 1
+                    if entry[0] <= time.time():
+                        start = host not in self.refreshing
+                        self.refreshing.add(host)
+        finally:
+            self.lock.release()
+
+        if spn is None:
+            if not self.canonicalize:
+                return "%s@%s" % (self.service, host)
+            if entry is None:
+                entry = self.refresh(host)
+            elif start:
+                refresher = threading.Thread(target=self.refresh, args=(host,), name="s4u2p-spn-refresh")
+                refresher.daemon = True
+                refresher.start()
+            spn = entry[1]
+
+        if not principal:
+            spn = self.service_name(spn)
+        return spn
+
+    def prefetch(self, hosts):
+        """looks the hosts up now, e.g. at startup"""
+        for host in hosts:
+            if self.canonicalize:
+                self.refresh(host.lower())
+
+    def clear(self):
+        self.lock.acquire()
+        try:
+            self.entries.clear()
+        finally:
+            self.lock.release()
+
+    def stats(self):
+        """number of cached hosts, DNS lookups done and spns served from the cache"""
+        self.lock.acquire()
+        try:
+            return dict(entries=len(self.entries), lookups=self.lookups, hits=self.hits)
+        finally:
+            self.lock.release()
+
+spn_resolver = SpnResolver()
+
+def resolve_spn(host, port=None, principal=True):
+    """the service principal for host and port from the shared spn_resolver"""
+    return spn_resolver.spn(host, port, principal)
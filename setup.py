@@ -1,6 +1,9 @@
 # -*- coding: utf8 -*-
 from distutils.core import setup, Extension
-import commands
+try:
+    from commands import getoutput
+except ImportError:
+    from subprocess import getoutput
 
 long_description = """
 This is an small extension to the python kerberos package.
@@ -27,6 +30,7 @@ setup (
     classifiers = [
         "License :: OSI Approved :: Apache Software License",
         "Programming Language :: Python :: 2",
+        "Programming Language :: Python :: 3",
         "Development Status :: 3 - Alpha",
         "Environment :: Web Environment",
         "Intended Audience :: Developers",
@@ -34,15 +38,20 @@ setup (
         "Topic :: System :: Systems Administration :: Authentication/Directory"
         ],
     license = "Apache License, Version 2.0",
+    py_modules = ["s4u2p_util", "s4u2p_broker", "www_authenticate"],
+    scripts = ["scripts/s4u2p-broker"],
     ext_modules = [
         Extension(
             "s4u2p",
-            extra_link_args = commands.getoutput("krb5-config --libs gssapi").split(),
-            extra_compile_args = commands.getoutput("krb5-config --cflags gssapi").split(),
+            extra_link_args = getoutput("krb5-config --libs gssapi").split(),
+            extra_compile_args = getoutput("krb5-config --cflags gssapi").split(),
             sources = [
                 "src/s4u2p.c",
                 "src/base64.c",
                 "src/kerberosgss.c",
+                "src/credcache.c",
+                "src/credstore.c",
+                "src/impersonator.c",
             ],
         ),
     ],
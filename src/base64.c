@@ -35,15 +35,25 @@ static signed char index_64[128] =
 };
 #define CHAR64(c)  (((c) < 0 || (c) > 127) ? -1 : index_64[(c)])
 
-// base64_encode    :    base64 encode
+// base64_encoded_len :    length of the base64 encoding of vlen bytes (without terminating 0)
+int base64_encoded_len(int vlen)
+{
+    return ((vlen + 2) / 3) * 4;
+}
+
+// base64_decoded_maxlen :  upper bound of the length of the data decoded from vlen base64 chars
+int base64_decoded_maxlen(int vlen)
+{
+    return (vlen * 3) / 4 + 1;
+}
+
+// base64_encode_into :    base64 encode into a caller supplied buffer
 //
 // value            :    data to encode
 // vlen             :    length of data
-// (result)         :    new char[] - c-str of result
-char *base64_encode(const unsigned char *value, int vlen)
+// out              :    buffer of at least base64_encoded_len(vlen) chars, no terminating 0 is written
+void base64_encode_into(const unsigned char *value, int vlen, char *out)
 {
-    char *result = (char *)malloc((vlen * 4) / 3 + 5);
-    char *out = result;
     while (vlen >= 3)
     {
         *out++ = basis_64[value[0] >> 2];
@@ -62,59 +72,83 @@ char *base64_encode(const unsigned char *value, int vlen)
         *out++ = (vlen < 2) ? '=' : basis_64[(value[1] << 2) & 0x3C];
         *out++ = '=';
     }
-    *out = '\0';
-
-    return result;
 }
 
-// base64_decode    :    base64 decode
+// base64_decode_into :    base64 decode into a caller supplied buffer
 //
-// value            :    c-str to decode
-// rlen             :    length of decoded result
-// (result)         :    new unsigned char[] - decoded result
-unsigned char *base64_decode(const char *value, int *rlen)
+// value            :    chars to decode
+// vlen             :    number of chars
+// out              :    buffer of at least base64_decoded_maxlen(vlen) bytes
+// (result)         :    length of decoded result, -1 if value isn't valid base64
+int base64_decode_into(const char *value, int vlen, unsigned char *out)
 {
-    *rlen = 0;
     int c1, c2, c3, c4;
+    int rlen = 0;
 
-    int vlen = strlen(value);
-    unsigned char *result =(unsigned char *)malloc((vlen * 3) / 4 + 1);
-    unsigned char *out = result;
-
-    while (1)
+    while (vlen >= 4)
     {
-        if (value[0]==0)
-            return result;
         c1 = value[0];
         if (CHAR64(c1) == -1)
-            goto base64_decode_error;;
+            return -1;
         c2 = value[1];
         if (CHAR64(c2) == -1)
-            goto base64_decode_error;;
+            return -1;
         c3 = value[2];
         if ((c3 != '=') && (CHAR64(c3) == -1))
-            goto base64_decode_error;;
+            return -1;
         c4 = value[3];
         if ((c4 != '=') && (CHAR64(c4) == -1))
-            goto base64_decode_error;;
+            return -1;
 
         value += 4;
+        vlen -= 4;
         *out++ = (CHAR64(c1) << 2) | (CHAR64(c2) >> 4);
-        *rlen += 1;
+        rlen += 1;
         if (c3 != '=')
         {
             *out++ = ((CHAR64(c2) << 4) & 0xf0) | (CHAR64(c3) >> 2);
-            *rlen += 1;
+            rlen += 1;
             if (c4 != '=')
             {
                 *out++ = ((CHAR64(c3) << 6) & 0xc0) | CHAR64(c4);
-                *rlen += 1;
+                rlen += 1;
             }
         }
     }
+    return (vlen == 0) ? rlen : -1;
+}
+
+// base64_encode    :    base64 encode
+//
+// value            :    data to encode
+// vlen             :    length of data
+// (result)         :    new char[] - c-str of result
+char *base64_encode(const unsigned char *value, int vlen)
+{
+    int len = base64_encoded_len(vlen);
+    char *result = (char *)malloc(len + 1);
 
-base64_decode_error:
-    *result = 0;
-    *rlen = 0;
+    base64_encode_into(value, vlen, result);
+    result[len] = '\0';
+
+    return result;
+}
+
+// base64_decode    :    base64 decode
+//
+// value            :    c-str to decode
+// rlen             :    length of decoded result
+// (result)         :    new unsigned char[] - decoded result
+unsigned char *base64_decode(const char *value, int *rlen)
+{
+    int vlen = strlen(value);
+    unsigned char *result = (unsigned char *)malloc(base64_decoded_maxlen(vlen));
+
+    *rlen = base64_decode_into(value, vlen, result);
+    if (*rlen < 0)
+    {
+        *result = 0;
+        *rlen = 0;
+    }
     return result;
 }
@@ -16,3 +16,7 @@
 
 char *base64_encode(const unsigned char *value, int vlen);
 unsigned char *base64_decode(const char *value, int *rlen);
+int base64_encoded_len(int vlen);
+int base64_decoded_maxlen(int vlen);
+void base64_encode_into(const unsigned char *value, int vlen, char *out);
+int base64_decode_into(const char *value, int vlen, unsigned char *out);
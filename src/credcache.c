@@ -0,0 +1,394 @@
+/**
+ * Copyright (c) 2012 Norman Krämer. All rights reserved.
+ *
+ * Licensed under the Apache License, Version 2.0 (the "License");
+ * you may not use this file except in compliance with the License.
+ * You may obtain a copy of the License at
+ *
+ *     http://www.apache.org/licenses/LICENSE-2.0
+ *
+ * Unless required by applicable law or agreed to in writing, software
+ * distributed under the License is distributed on an "AS IS" BASIS,
+ * WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+ * See the License for the specific language governing permissions and
+ * limitations under the License.
+ **/
+
+/**
+ * Cache for the delegated credentials created by authenticate_gss_impers_init.
+ *
+ * Entries are keyed by (impersonator, as_user, kind), bounded in number (least recently used
+ * entries are evicted first) and dropped once the remaining ticket lifetime falls below
+ * min_lifetime seconds.
+ * An entry is reference counted: the cache holds one reference as long as the entry is
+ * linked, every impersonation state using the credentials holds another one. So an
+ * evicted entry stays usable until the last state referring to it is cleaned.
+ * All functions may be called without holding the GIL, a mutex serializes access.
+ *
+ * Additionally the imported (and canonicalized) service principal names are kept, so the
+ * hostname canonicalization of gss_import_name doesn't happen on every init.
+ */
+
+#include "credcache.h"
+
+#include <stdlib.h>
+#include <string.h>
+#include <time.h>
+#include <pthread.h>
+
+#include <gssapi/gssapi_krb5.h>
+
+#define CREDCACHE_BUCKETS 1024
+#define NAMECACHE_SIZE    128
+#define NAMECACHE_TTL     300   // seconds an imported name is used, so DNS changes show up
+
+struct cred_cache_entry {
+    char               *impersonator;
+    char               *as_user;
+    int                 kind;          // how the creds were made, see S4U_MODE_*
+    unsigned long       hash;
+    gss_cred_id_t       creds;
+    time_t              expires;
+    int                 refcount;
+
+    cred_cache_entry   *bucket_next;   // hash chain
+    cred_cache_entry   *lru_prev;      // towards the most recently used entry
+    cred_cache_entry   *lru_next;      // towards the least recently used entry
+};
+
+static cred_cache_entry *buckets[CREDCACHE_BUCKETS];
+static cred_cache_entry *lru_head = NULL;
+static cred_cache_entry *lru_tail = NULL;
+static pthread_mutex_t cache_lock = PTHREAD_MUTEX_INITIALIZER;
+
+typedef struct {
+    char*            service;
+    gss_name_t       name;
+    time_t           expires;
+} name_cache_slot;
+
+static name_cache_slot names[NAMECACHE_SIZE];
+static unsigned int names_next = 0;     // slot to replace next once the name cache is full
+static pthread_mutex_t name_lock = PTHREAD_MUTEX_INITIALIZER;
+
+static cred_cache_stats stats = {0, 0, 0, 0, 0, CREDCACHE_DEFAULT_MAX_ENTRIES, CREDCACHE_DEFAULT_MIN_LIFETIME};
+
+static unsigned long hash_key(const char *impersonator, const char *as_user, int kind)
+{
+    unsigned long h = 5381 + kind;
+    const unsigned char *p;
+
+    for (p = (const unsigned char *)impersonator; *p; p++)
+        h = ((h << 5) + h) + *p;
+    h = ((h << 5) + h);
+    for (p = (const unsigned char *)as_user; *p; p++)
+        h = ((h << 5) + h) + *p;
+    return h;
+}
+
+static void free_entry(cred_cache_entry *entry)
+{
+    OM_uint32 min_stat;
+
+    if (entry->creds != GSS_C_NO_CREDENTIAL)
+        (void)gss_release_cred(&min_stat, &entry->creds);
+    free(entry->impersonator);
+    free(entry->as_user);
+    free(entry);
+}
+
+static void lru_push_front(cred_cache_entry *entry)
+{
+    entry->lru_prev = NULL;
+    entry->lru_next = lru_head;
+    if (lru_head != NULL)
+        lru_head->lru_prev = entry;
+    lru_head = entry;
+    if (lru_tail == NULL)
+        lru_tail = entry;
+}
+
+static void lru_remove(cred_cache_entry *entry)
+{
+    if (entry->lru_prev != NULL)
+        entry->lru_prev->lru_next = entry->lru_next;
+    else
+        lru_head = entry->lru_next;
+    if (entry->lru_next != NULL)
+        entry->lru_next->lru_prev = entry->lru_prev;
+    else
+        lru_tail = entry->lru_prev;
+    entry->lru_prev = entry->lru_next = NULL;
+}
+
+static void release_entry(cred_cache_entry *entry)
+{
+    if (--entry->refcount == 0)
+        free_entry(entry);
+}
+
+// unlink an entry from the hash table and the lru list and drop the cache's reference
+static void unlink_entry(cred_cache_entry *entry)
+{
+    cred_cache_entry **pp = &buckets[entry->hash % CREDCACHE_BUCKETS];
+
+    while (*pp != NULL && *pp != entry)
+        pp = &(*pp)->bucket_next;
+    if (*pp != NULL)
+        *pp = entry->bucket_next;
+    entry->bucket_next = NULL;
+
+    lru_remove(entry);
+    stats.entries--;
+
+    release_entry(entry);
+}
+
+static void evict_to(unsigned int max_entries)
+{
+    while (stats.entries > max_entries && lru_tail != NULL)
+    {
+        unlink_entry(lru_tail);
+        stats.evictions++;
+    }
+}
+
+static cred_cache_entry *find_entry(unsigned long h, const char *impersonator, const char *as_user, int kind)
+{
+    cred_cache_entry *entry = buckets[h % CREDCACHE_BUCKETS];
+
+    while (entry != NULL)
+    {
+        if (entry->hash == h && entry->kind == kind && strcmp(entry->as_user, as_user) == 0 && strcmp(entry->impersonator, impersonator) == 0)
+            break;
+        entry = entry->bucket_next;
+    }
+    return entry;
+}
+
+void credcache_configure(unsigned int max_entries, unsigned int min_lifetime)
+{
+    pthread_mutex_lock(&cache_lock);
+    stats.max_entries = max_entries;
+    stats.min_lifetime = min_lifetime;
+    evict_to(max_entries);
+    pthread_mutex_unlock(&cache_lock);
+}
+
+// look up the delegated credentials of as_user obtained via impersonator.
+// On a hit the returned entry is referenced for the caller (release it with credcache_release)
+// and *creds is set to the (borrowed) credential handle.
+cred_cache_entry *credcache_lookup(const char *impersonator, const char *as_user, int kind, gss_cred_id_t *creds)
+{
+    cred_cache_entry *entry;
+
+    pthread_mutex_lock(&cache_lock);
+    entry = find_entry(hash_key(impersonator, as_user, kind), impersonator, as_user, kind);
+
+    if (entry != NULL && entry->expires - time(NULL) <= (time_t)stats.min_lifetime)
+    {
+        unlink_entry(entry);
+        stats.expirations++;
+        entry = NULL;
+    }
+
+    if (entry == NULL)
+    {
+        stats.misses++;
+        pthread_mutex_unlock(&cache_lock);
+        return NULL;
+    }
+
+    stats.hits++;
+    lru_remove(entry);
+    lru_push_front(entry);
+    entry->refcount++;
+    *creds = entry->creds;
+    pthread_mutex_unlock(&cache_lock);
+    return entry;
+}
+
+// add freshly acquired delegated credentials to the cache. The cache takes ownership of creds.
+// Returns the new entry referenced for the caller or NULL if the credentials weren't cached
+// (caching disabled or lifetime too short), in which case the caller keeps ownership of creds.
+cred_cache_entry *credcache_insert(const char *impersonator, const char *as_user, int kind, gss_cred_id_t creds, OM_uint32 lifetime)
+{
+    cred_cache_entry *entry, *old;
+    time_t now = time(NULL);
+
+    entry = (cred_cache_entry *)calloc(1, sizeof(cred_cache_entry));
+    if (entry == NULL)
+        return NULL;
+    entry->creds = GSS_C_NO_CREDENTIAL;
+    entry->impersonator = strdup(impersonator);
+    entry->as_user = strdup(as_user);
+    if (entry->impersonator == NULL || entry->as_user == NULL)
+    {
+        free_entry(entry);
+        return NULL;
+    }
+
+    entry->kind = kind;
+    entry->hash = hash_key(impersonator, as_user, kind);
+
+    pthread_mutex_lock(&cache_lock);
+
+    if (stats.max_entries == 0 || lifetime <= stats.min_lifetime)
+    {
+        pthread_mutex_unlock(&cache_lock);
+        free_entry(entry);
+        return NULL;
+    }
+
+    // replace a previous entry for the same key
+    old = find_entry(entry->hash, impersonator, as_user, kind);
+    if (old != NULL)
+        unlink_entry(old);
+
+    entry->creds = creds;
+    if (lifetime == GSS_C_INDEFINITE)
+        entry->expires = now + 365 * 24 * 3600;
+    else
+        entry->expires = now + (time_t)lifetime;
+    entry->refcount = 2; // one for the cache, one for the caller
+
+    entry->bucket_next = buckets[entry->hash % CREDCACHE_BUCKETS];
+    buckets[entry->hash % CREDCACHE_BUCKETS] = entry;
+    lru_push_front(entry);
+    stats.entries++;
+
+    evict_to(stats.max_entries);
+    pthread_mutex_unlock(&cache_lock);
+    return entry;
+}
+
+void credcache_release(cred_cache_entry *entry)
+{
+    if (entry == NULL)
+        return;
+    pthread_mutex_lock(&cache_lock);
+    release_entry(entry);
+    pthread_mutex_unlock(&cache_lock);
+}
+
+void credcache_flush(void)
+{
+    pthread_mutex_lock(&cache_lock);
+    while (lru_tail != NULL)
+        unlink_entry(lru_tail);
+    pthread_mutex_unlock(&cache_lock);
+}
+
+void credcache_stats(cred_cache_stats *out)
+{
+    pthread_mutex_lock(&cache_lock);
+    *out = stats;
+    pthread_mutex_unlock(&cache_lock);
+}
+
+static int find_name(const char *service)
+{
+    int i;
+
+    for (i = 0; i < NAMECACHE_SIZE; i++)
+        if (names[i].service != NULL && strcmp(names[i].service, service) == 0)
+            return i;
+    return -1;
+}
+
+// import a service name, *name receives a copy the caller has to release. Imported names are
+// cached for NAMECACHE_TTL seconds.
+// "HTTP@host" is a host based service name that krb5 canonicalizes (DNS), a name with a
+// '/' like "HTTP/host.fqdn@REALM" is taken as a principal name as it is.
+OM_uint32 namecache_import(OM_uint32 *min_stat, const char *service, gss_name_t *name)
+{
+    OM_uint32 maj_stat, tmp_min_stat;
+    gss_buffer_desc name_token;
+    gss_name_t imported = GSS_C_NO_NAME, canonical = GSS_C_NO_NAME;
+    name_cache_slot *slot;
+    int i, principal;
+
+    pthread_mutex_lock(&name_lock);
+    i = find_name(service);
+    if (i >= 0 && names[i].expires > time(NULL))
+    {
+        maj_stat = gss_duplicate_name(min_stat, names[i].name, name);
+        pthread_mutex_unlock(&name_lock);
+        return maj_stat;
+    }
+    pthread_mutex_unlock(&name_lock);
+
+    name_token.length = strlen(service);
+    name_token.value = (char *)service;
+    principal = strchr(service, '/') != NULL;
+
+    maj_stat = gss_import_name(min_stat, &name_token,
+                               principal ? (gss_OID)GSS_KRB5_NT_PRINCIPAL_NAME : GSS_C_NT_HOSTBASED_SERVICE, &imported);
+    if (GSS_ERROR(maj_stat))
+        return maj_stat;
+
+    // resolve the host now, every copy of the mechanism name then skips that.
+    // A principal name needs no lookup, canonicalizing just makes it a mechanism name.
+    if (GSS_ERROR(gss_canonicalize_name(&tmp_min_stat, imported, (gss_OID)gss_mech_krb5, &canonical)))
+        canonical = GSS_C_NO_NAME;
+    if (canonical != GSS_C_NO_NAME)
+    {
+        (void)gss_release_name(&tmp_min_stat, &imported);
+        imported = canonical;
+    }
+
+    maj_stat = gss_duplicate_name(min_stat, imported, name);
+    if (GSS_ERROR(maj_stat))
+    {
+        (void)gss_release_name(&tmp_min_stat, &imported);
+        return maj_stat;
+    }
+
+    pthread_mutex_lock(&name_lock);
+    i = find_name(service);
+    if (i >= 0 && names[i].expires > time(NULL))
+    {
+        // another thread was faster
+        pthread_mutex_unlock(&name_lock);
+        (void)gss_release_name(&tmp_min_stat, &imported);
+        return maj_stat;
+    }
+    if (i >= 0)
+        slot = &names[i]; // expired, replace it
+    else
+    {
+        slot = &names[names_next];
+        names_next = (names_next + 1) % NAMECACHE_SIZE;
+    }
+    if (slot->service != NULL)
+    {
+        free(slot->service);
+        (void)gss_release_name(&tmp_min_stat, &slot->name);
+    }
+    slot->service = strdup(service);
+    slot->name = imported;
+    slot->expires = time(NULL) + NAMECACHE_TTL;
+    if (slot->service == NULL)
+        (void)gss_release_name(&tmp_min_stat, &slot->name);
+    pthread_mutex_unlock(&name_lock);
+
+    return maj_stat;
+}
+
+void namecache_flush(void)
+{
+    OM_uint32 min_stat;
+    int i;
+
+    pthread_mutex_lock(&name_lock);
+    for (i = 0; i < NAMECACHE_SIZE; i++)
+    {
+        if (names[i].service == NULL)
+            continue;
+        free(names[i].service);
+        names[i].service = NULL;
+        (void)gss_release_name(&min_stat, &names[i].name);
+    }
+    names_next = 0;
+    pthread_mutex_unlock(&name_lock);
+}
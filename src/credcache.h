@@ -0,0 +1,42 @@
+/**
+ * Copyright (c) 2012 Norman Krämer. All rights reserved.
+ *
+ * Licensed under the Apache License, Version 2.0 (the "License");
+ * you may not use this file except in compliance with the License.
+ * You may obtain a copy of the License at
+ *
+ *     http://www.apache.org/licenses/LICENSE-2.0
+ *
+ * Unless required by applicable law or agreed to in writing, software
+ * distributed under the License is distributed on an "AS IS" BASIS,
+ * WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+ * See the License for the specific language governing permissions and
+ * limitations under the License.
+ **/
+
+#include <gssapi/gssapi.h>
+
+#define CREDCACHE_DEFAULT_MAX_ENTRIES   512
+#define CREDCACHE_DEFAULT_MIN_LIFETIME  60
+
+typedef struct cred_cache_entry cred_cache_entry;
+
+typedef struct {
+    unsigned long    hits;
+    unsigned long    misses;
+    unsigned long    evictions;
+    unsigned long    expirations;
+    unsigned int     entries;
+    unsigned int     max_entries;
+    unsigned int     min_lifetime;
+} cred_cache_stats;
+
+void credcache_configure(unsigned int max_entries, unsigned int min_lifetime);
+cred_cache_entry *credcache_lookup(const char *impersonator, const char *as_user, int kind, gss_cred_id_t *creds);
+cred_cache_entry *credcache_insert(const char *impersonator, const char *as_user, int kind, gss_cred_id_t creds, OM_uint32 lifetime);
+void credcache_release(cred_cache_entry *entry);
+void credcache_flush(void);
+void credcache_stats(cred_cache_stats *stats);
+
+OM_uint32 namecache_import(OM_uint32 *min_stat, const char *service, gss_name_t *name);
+void namecache_flush(void);
@@ -0,0 +1,288 @@
+/**
+ * Copyright (c) 2012 Norman Krämer. All rights reserved.
+ *
+ * Licensed under the Apache License, Version 2.0 (the "License");
+ * you may not use this file except in compliance with the License.
+ * You may obtain a copy of the License at
+ *
+ *     http://www.apache.org/licenses/LICENSE-2.0
+ *
+ * Unless required by applicable law or agreed to in writing, software
+ * distributed under the License is distributed on an "AS IS" BASIS,
+ * WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+ * See the License for the specific language governing permissions and
+ * limitations under the License.
+ **/
+
+/**
+ * On disk store for the delegated credentials, so they survive a restart of the process.
+ *
+ * Every (impersonator, as_user, kind) gets a FILE: ccache in the store directory, written
+ * with gss_store_cred_into to a temporary name and renamed into place, so readers never see
+ * a half written ccache. The modification time of a ccache is set to the expiry of its
+ * tickets, which lets loading and pruning skip expired ones without opening them.
+ * All functions may be called without holding the GIL.
+ */
+
+#include "credstore.h"
+
+#include <stdio.h>
+#include <stdlib.h>
+#include <string.h>
+#include <errno.h>
+#include <time.h>
+#include <unistd.h>
+#include <dirent.h>
+#include <pthread.h>
+#include <sys/stat.h>
+#include <sys/time.h>
+
+#include <gssapi/gssapi_krb5.h>
+
+// only files named like this are ours, the store may share its directory with other files
+#define CREDSTORE_SUFFIX     ".s4u2p-cc"
+#define CREDSTORE_TMP_PREFIX ".s4u2p-tmp."
+
+static char *store_dir = NULL;
+static unsigned long tmp_counter = 0;
+static pthread_mutex_t store_lock = PTHREAD_MUTEX_INITIALIZER;
+
+// returns a copy of the store directory, NULL if the store is disabled
+static char *get_dir(void)
+{
+    char *dir = NULL;
+
+    pthread_mutex_lock(&store_lock);
+    if (store_dir != NULL)
+        dir = strdup(store_dir);
+    pthread_mutex_unlock(&store_lock);
+    return dir;
+}
+
+// use directory as store, NULL disables the store. Returns 0 or an errno value.
+// an existing directory has to belong to us and be inaccessible to others, the ccaches hold session keys
+int credstore_configure(const char *directory)
+{
+    char *dir = NULL;
+    struct stat st;
+
+    if (directory != NULL) {
+        if (mkdir(directory, 0700) != 0 && errno != EEXIST)
+            return errno;
+        if (stat(directory, &st) != 0)
+            return errno;
+        if (!S_ISDIR(st.st_mode))
+            return ENOTDIR;
+        if (st.st_uid != geteuid() || (st.st_mode & 0077) != 0)
+            return EACCES;
+        dir = strdup(directory);
+        if (dir == NULL)
+            return ENOMEM;
+    }
+
+    pthread_mutex_lock(&store_lock);
+    free(store_dir);
+    store_dir = dir;
+    pthread_mutex_unlock(&store_lock);
+
+    if (dir != NULL)
+        credstore_prune();
+    return 0;
+}
+
+int credstore_enabled(void)
+{
+    int enabled;
+
+    pthread_mutex_lock(&store_lock);
+    enabled = store_dir != NULL;
+    pthread_mutex_unlock(&store_lock);
+    return enabled;
+}
+
+// dir/<as_user>.<kind>.<hash of impersonator and as_user>.s4u2p-cc, as_user reduced to characters safe in a file name
+static char *ccache_path(const char *dir, const char *impersonator, const char *as_user, int kind)
+{
+    unsigned long long h = 14695981039346656037ULL; // FNV-1a
+    const unsigned char *p;
+    char *path, *q;
+    size_t len = strlen(dir) + strlen(as_user) + 64 + sizeof(CREDSTORE_SUFFIX);
+
+    for (p = (const unsigned char *)impersonator; *p; p++)
+        h = (h ^ *p) * 1099511628211ULL;
+    h = (h ^ '|') * 1099511628211ULL;
+    for (p = (const unsigned char *)as_user; *p; p++)
+        h = (h ^ *p) * 1099511628211ULL;
+
+    path = (char *)malloc(len);
+    if (path == NULL)
+        return NULL;
+
+    snprintf(path, len, "%s/%s.%d.%016llx" CREDSTORE_SUFFIX, dir, as_user, kind, h);
+    for (q = path + strlen(dir) + 1; *q; q++) {
+        if (!((*q >= 'a' && *q <= 'z') || (*q >= 'A' && *q <= 'Z') || (*q >= '0' && *q <= '9') ||
+              *q == '.' || *q == '_' || *q == '-' || *q == '@'))
+            *q = '_';
+    }
+    if (path[strlen(dir) + 1] == '.') // no hidden files, they are our temporaries
+        path[strlen(dir) + 1] = '_';
+    return path;
+}
+
+static OM_uint32 ccache_op(OM_uint32 *min_stat, const char *path, gss_cred_id_t *load, gss_cred_id_t store, OM_uint32 *lifetime)
+{
+    gss_key_value_element_desc element;
+    gss_key_value_set_desc cred_store;
+    char *ccache = (char *)malloc(strlen(path) + 6);
+    OM_uint32 maj_stat;
+
+    if (ccache == NULL) {
+        *min_stat = ENOMEM;
+        return GSS_S_FAILURE;
+    }
+    sprintf(ccache, "FILE:%s", path);
+    element.key = "ccache";
+    element.value = ccache;
+    cred_store.count = 1;
+    cred_store.elements = &element;
+
+    if (load != NULL)
+        maj_stat = gss_acquire_cred_from(min_stat, GSS_C_NO_NAME, GSS_C_INDEFINITE, GSS_C_NO_OID_SET,
+                                         GSS_C_INITIATE, &cred_store, load, NULL, lifetime);
+    else
+        maj_stat = gss_store_cred_into(min_stat, store, GSS_C_INITIATE, GSS_C_NO_OID, 1, 0,
+                                       &cred_store, NULL, NULL);
+    free(ccache);
+    return maj_stat;
+}
+
+// load the stored creds if they are valid for more than min_lifetime seconds
+OM_uint32 credstore_load(const char *impersonator, const char *as_user, int kind, OM_uint32 min_lifetime,
+                         gss_cred_id_t *creds, OM_uint32 *lifetime)
+{
+    OM_uint32 maj_stat, min_stat;
+    struct stat st;
+    char *dir, *path = NULL;
+    time_t now = time(NULL);
+
+    *creds = GSS_C_NO_CREDENTIAL;
+    *lifetime = 0;
+
+    dir = get_dir();
+    if (dir == NULL)
+        return GSS_S_NO_CRED;
+
+    path = ccache_path(dir, impersonator, as_user, kind);
+    maj_stat = GSS_S_NO_CRED;
+    if (path == NULL || stat(path, &st) != 0)
+        goto end;
+
+    if (st.st_mtime <= now) {
+        unlink(path);
+        goto end;
+    }
+    if (st.st_mtime <= now + (time_t)min_lifetime)
+        goto end;
+
+    maj_stat = ccache_op(&min_stat, path, creds, GSS_C_NO_CREDENTIAL, lifetime);
+    if (!GSS_ERROR(maj_stat) && *lifetime <= min_lifetime) {
+        (void)gss_release_cred(&min_stat, creds);
+        maj_stat = GSS_S_CREDENTIALS_EXPIRED;
+    }
+
+end:
+    free(path);
+    free(dir);
+    return maj_stat;
+}
+
+// store creds valid for lifetime seconds, failures are ignored: the store is only an optimization
+void credstore_save(const char *impersonator, const char *as_user, int kind, gss_cred_id_t creds, OM_uint32 lifetime)
+{
+    OM_uint32 min_stat;
+    struct timeval times[2];
+    char *dir, *path = NULL, *tmp = NULL;
+    unsigned long counter;
+    size_t len;
+
+    dir = get_dir();
+    if (dir == NULL || lifetime == 0)
+        goto end;
+
+    path = ccache_path(dir, impersonator, as_user, kind);
+    if (path == NULL)
+        goto end;
+
+    pthread_mutex_lock(&store_lock);
+    counter = tmp_counter++;
+    pthread_mutex_unlock(&store_lock);
+
+    len = strlen(dir) + 64;
+    tmp = (char *)malloc(len);
+    if (tmp == NULL)
+        goto end;
+    snprintf(tmp, len, "%s/" CREDSTORE_TMP_PREFIX "%ld.%lu", dir, (long)getpid(), counter);
+
+    if (GSS_ERROR(ccache_op(&min_stat, tmp, NULL, creds, NULL))) {
+        unlink(tmp);
+        goto end;
+    }
+
+    times[0].tv_sec = times[1].tv_sec = time(NULL) + lifetime;
+    times[0].tv_usec = times[1].tv_usec = 0;
+    if (utimes(tmp, times) != 0 || rename(tmp, path) != 0)
+        unlink(tmp);
+
+end:
+    free(tmp);
+    free(path);
+    free(dir);
+}
+
+// remove expired ccaches and temporaries left behind by crashed processes, returns how many.
+// other files in the directory are left alone
+int credstore_prune(void)
+{
+    DIR *d;
+    struct dirent *de;
+    struct stat st;
+    char *dir, *path;
+    time_t now = time(NULL);
+    int removed = 0;
+    size_t name_len, suffix_len = strlen(CREDSTORE_SUFFIX);
+    int tmp;
+
+    dir = get_dir();
+    if (dir == NULL)
+        return 0;
+
+    d = opendir(dir);
+    if (d == NULL) {
+        free(dir);
+        return 0;
+    }
+
+    while ((de = readdir(d)) != NULL) {
+        name_len = strlen(de->d_name);
+        tmp = strncmp(de->d_name, CREDSTORE_TMP_PREFIX, strlen(CREDSTORE_TMP_PREFIX)) == 0;
+        if (!tmp && (name_len <= suffix_len || strcmp(de->d_name + name_len - suffix_len, CREDSTORE_SUFFIX) != 0))
+            continue;
+        path = (char *)malloc(strlen(dir) + strlen(de->d_name) + 2);
+        if (path == NULL)
+            break;
+        sprintf(path, "%s/%s", dir, de->d_name);
+        if (stat(path, &st) == 0 && S_ISREG(st.st_mode)) {
+            if (tmp
+                ? st.st_mtime + 3600 < now   // an hour is plenty for a store in progress
+                : st.st_mtime <= now) {
+                if (unlink(path) == 0)
+                    removed++;
+            }
+        }
+        free(path);
+    }
+
+    closedir(d);
+    free(dir);
+    return removed;
+}
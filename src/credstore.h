@@ -0,0 +1,24 @@
+/**
+ * Copyright (c) 2012 Norman Krämer. All rights reserved.
+ *
+ * Licensed under the Apache License, Version 2.0 (the "License");
+ * you may not use this file except in compliance with the License.
+ * You may obtain a copy of the License at
+ *
+ *     http://www.apache.org/licenses/LICENSE-2.0
+ *
+ * Unless required by applicable law or agreed to in writing, software
+ * distributed under the License is distributed on an "AS IS" BASIS,
+ * WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+ * See the License for the specific language governing permissions and
+ * limitations under the License.
+ **/
+
+#include <gssapi/gssapi.h>
+
+int credstore_configure(const char *directory);
+int credstore_enabled(void);
+OM_uint32 credstore_load(const char *impersonator, const char *as_user, int kind, OM_uint32 min_lifetime,
+                         gss_cred_id_t *creds, OM_uint32 *lifetime);
+void credstore_save(const char *impersonator, const char *as_user, int kind, gss_cred_id_t creds, OM_uint32 lifetime);
+int credstore_prune(void);
@@ -0,0 +1,505 @@
+/**
+ * Copyright (c) 2012 Norman Krämer. All rights reserved.
+ *
+ * Licensed under the Apache License, Version 2.0 (the "License");
+ * you may not use this file except in compliance with the License.
+ * You may obtain a copy of the License at
+ *
+ *     http://www.apache.org/licenses/LICENSE-2.0
+ *
+ * Unless required by applicable law or agreed to in writing, software
+ * distributed under the License is distributed on an "AS IS" BASIS,
+ * WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+ * See the License for the specific language governing permissions and
+ * limitations under the License.
+ **/
+
+/**
+ * The impersonator's own credentials.
+ *
+ * Acquiring them opens and locks the default ccache and reads the keytab, so the handle is
+ * kept and shared by all impersonations. It is replaced when its tickets near expiry, when
+ * another keytab is registered or when KRB5CCNAME changes.
+ * With a client principal set, the TGT is obtained from the keytab itself (client keytab) into
+ * a MEMORY: ccache, so there's no need for an external kinit and no ccache file involved. The
+ * kerberos library gets a new TGT when the handle is replaced near expiry.
+ *
+ * Instead of the one default identity several identities (service accounts), each with its own
+ * keytab and principal, can be added, to spread the S4U load over them. Every identity has its
+ * own handle, keytab and MEMORY: ccache with a TGT of its principal; its delegated credentials
+ * are cached separately, since the key differs. An impersonation either names the identity to use or one is picked by the policy.
+ * The handle is reference counted, a replaced handle is released once the last impersonation
+ * using it is done. All functions may be called without holding the GIL.
+ *
+ * The lock is never held while talking to the KDC: one thread acquires the new handle of an
+ * identity while the others keep using the old one as long as it's valid, and only wait for
+ * the new one if there is none they could use.
+ */
+
+#include "impersonator.h"
+#include "credcache.h"
+
+#include <gssapi/gssapi_krb5.h>
+
+#include <stdio.h>
+#include <stdlib.h>
+#include <string.h>
+#include <errno.h>
+#include <pthread.h>
+
+#define IMPERSONATOR_CCACHE "MEMORY:s4u2p-impersonator"
+
+typedef struct {
+    char*            name;       // NULL for the default identity
+    char*            keytab;     // NULL: the default keytab
+    char*            principal;  // set if the TGT comes from keytab, always for added identities
+    impersonator*    current;
+    unsigned long    impersonations;
+    int              busy;
+    int              refreshing; // a thread is acquiring a new handle
+    unsigned long    generation; // changes whenever current is dropped, a handle acquired meanwhile is outdated
+} identity;
+
+static identity default_identity = {NULL, NULL, NULL, NULL, 0, 0, 0, 0};
+static identity identities[IMPERSONATOR_MAX_IDENTITIES];
+static int identity_count = 0;
+static int policy = IMPERSONATOR_POLICY_HASH;
+static pthread_mutex_t impersonator_lock = PTHREAD_MUTEX_INITIALIZER;
+static pthread_cond_t impersonator_refreshed = PTHREAD_COND_INITIALIZER;
+
+static identity *slot_identity(int slot)
+{
+    return slot < 0 ? &default_identity : &identities[slot];
+}
+
+// The impersonator is identified by the keytab and the credential cache its credentials come from.
+static char *make_key(identity *id)
+{
+    const char *name = id->name ? id->name : "";
+    const char *keytab = id->keytab ? id->keytab : "";
+    const char *principal = id->principal ? id->principal : "";
+    const char *ccache = id->principal ? IMPERSONATOR_CCACHE : getenv("KRB5CCNAME");
+    char *key;
+
+    if (ccache == NULL)
+        ccache = "";
+    key = (char *)malloc(strlen(keytab) + strlen(principal) + strlen(ccache) + strlen(name) + 4);
+    if (key != NULL)
+        sprintf(key, "%s|%s|%s|%s", keytab, principal, ccache, name);
+    return key;
+}
+
+// acquire the impersonator's credentials, from the default ccache or with the client keytab
+static OM_uint32 acquire_creds(OM_uint32 *min_stat, identity *id, gss_cred_id_t *creds)
+{
+    OM_uint32 maj_stat, tmp_min_stat;
+    gss_buffer_desc name_token;
+    gss_name_t name = GSS_C_NO_NAME;
+    gss_key_value_element_desc elements[3];
+    gss_key_value_set_desc cred_store;
+    char *ccache = NULL;
+
+    if (id->principal == NULL && id->name == NULL)
+        return gss_acquire_cred(min_stat, GSS_C_NO_NAME,
+                                GSS_C_INDEFINITE, GSS_C_NO_OID_SET, GSS_C_BOTH,
+                                creds, NULL, NULL);
+
+    cred_store.count = 0;
+    cred_store.elements = elements;
+    if (id->keytab != NULL) {
+        // the default identity registered its keytab process wide, added ones keep it to themselves
+        elements[cred_store.count].key = "keytab";
+        elements[cred_store.count++].value = id->keytab;
+    }
+
+    if (id->principal != NULL) {
+        name_token.value = id->principal;
+        name_token.length = strlen(id->principal);
+        maj_stat = gss_import_name(min_stat, &name_token, (gss_OID)GSS_KRB5_NT_PRINCIPAL_NAME, &name);
+        if (GSS_ERROR(maj_stat))
+            return maj_stat;
+
+        ccache = (char *)malloc(strlen(IMPERSONATOR_CCACHE) + (id->name ? strlen(id->name) : 0) + 2);
+        if (ccache == NULL) {
+            (void)gss_release_name(&tmp_min_stat, &name);
+            *min_stat = ENOMEM;
+            return GSS_S_FAILURE;
+        }
+        if (id->name)
+            sprintf(ccache, "%s-%s", IMPERSONATOR_CCACHE, id->name);
+        else
+            strcpy(ccache, IMPERSONATOR_CCACHE);
+
+        elements[cred_store.count].key = "client_keytab";
+        elements[cred_store.count++].value = id->keytab;
+        elements[cred_store.count].key = "ccache";
+        elements[cred_store.count++].value = ccache;
+    }
+
+    maj_stat = gss_acquire_cred_from(min_stat, name, GSS_C_INDEFINITE, GSS_C_NO_OID_SET, GSS_C_BOTH,
+                                     &cred_store, creds, NULL, NULL);
+    if (name != GSS_C_NO_NAME)
+        (void)gss_release_name(&tmp_min_stat, &name);
+    free(ccache);
+    return maj_stat;
+}
+
+static void release_locked(impersonator *imp)
+{
+    OM_uint32 min_stat;
+
+    if (--imp->refcount > 0)
+        return;
+    if (imp->creds != GSS_C_NO_CREDENTIAL)
+        (void)gss_release_cred(&min_stat, &imp->creds);
+    if (imp->name != GSS_C_NO_NAME)
+        (void)gss_release_name(&min_stat, &imp->name);
+    free(imp->key);
+    free(imp);
+}
+
+static void drop_current_locked(identity *id)
+{
+    id->generation++;
+    if (id->current != NULL)
+    {
+        release_locked(id->current);
+        id->current = NULL;
+    }
+}
+
+// a new handle with the credentials of the identity described by config, called without the lock
+static impersonator *acquire_impersonator(OM_uint32 *maj_stat, OM_uint32 *min_stat, identity *config)
+{
+    impersonator *imp;
+    OM_uint32 lifetime = 0, tmp_min_stat;
+    time_t now = time(NULL);
+
+    imp = (impersonator *)calloc(1, sizeof(impersonator));
+    if (imp == NULL)
+    {
+        *maj_stat = GSS_S_FAILURE;
+        *min_stat = ENOMEM;
+        return NULL;
+    }
+    imp->creds = GSS_C_NO_CREDENTIAL;
+    imp->name = GSS_C_NO_NAME;
+
+    // get my credentials
+    *maj_stat = acquire_creds(min_stat, config, &imp->creds);
+    if (GSS_ERROR(*maj_stat))
+    {
+        free(imp);
+        return NULL;
+    }
+
+    *maj_stat = gss_inquire_cred(min_stat, imp->creds, &imp->name, &lifetime, NULL, NULL);
+    if (GSS_ERROR(*maj_stat))
+    {
+        (void)gss_release_cred(&tmp_min_stat, &imp->creds);
+        free(imp);
+        return NULL;
+    }
+    imp->expires = (lifetime == GSS_C_INDEFINITE) ? now + 365 * 24 * 3600 : now + (time_t)lifetime;
+    return imp;
+}
+
+static void free_config(identity *config)
+{
+    free(config->name);
+    free(config->keytab);
+    free(config->principal);
+}
+
+// copy of what acquire_creds needs, the identity may change while the lock isn't held
+static int copy_config_locked(identity *config, identity *id)
+{
+    memset(config, 0, sizeof(identity));
+    config->name = id->name ? strdup(id->name) : NULL;
+    config->keytab = id->keytab ? strdup(id->keytab) : NULL;
+    config->principal = id->principal ? strdup(id->principal) : NULL;
+    if ((id->name && config->name == NULL) || (id->keytab && config->keytab == NULL) ||
+        (id->principal && config->principal == NULL)) {
+        free_config(config);
+        return ENOMEM;
+    }
+    return 0;
+}
+
+// use keytab to accept tickets to ourselves, and with principal set also to get our TGT
+OM_uint32 impersonator_set_keytab(OM_uint32 *min_stat, const char *keytab, const char *principal)
+{
+    OM_uint32 maj_stat;
+
+    *min_stat = 0;
+    pthread_mutex_lock(&impersonator_lock);
+    maj_stat = krb5_gss_register_acceptor_identity(keytab);
+    if (!GSS_ERROR(maj_stat))
+    {
+        free(default_identity.keytab);
+        default_identity.keytab = strdup(keytab);
+        free(default_identity.principal);
+        default_identity.principal = principal ? strdup(principal) : NULL;
+        drop_current_locked(&default_identity);
+    }
+    pthread_mutex_unlock(&impersonator_lock);
+    // the service names may canonicalize differently with the new identity's realm
+    if (!GSS_ERROR(maj_stat))
+        namecache_flush();
+    return maj_stat;
+}
+
+// add (or replace) the identity name. Once identities are added, the default one isn't used anymore.
+// The principal is required: without it the TGT would come from the default ccache, the same
+// for every identity. Returns 0 or an errno value.
+int impersonator_add(const char *name, const char *keytab, const char *principal)
+{
+    identity *id = NULL;
+    char *new_name, *new_keytab, *new_principal;
+    int i, ret = 0;
+
+    if (principal == NULL || *principal == 0)
+        return EINVAL;
+    if (strlen(name) >= sizeof(((impersonator_info *)0)->name))
+        return ENAMETOOLONG;
+
+    new_name = strdup(name);
+    new_keytab = strdup(keytab);
+    new_principal = strdup(principal);
+    if (new_name == NULL || new_keytab == NULL || new_principal == NULL) {
+        ret = ENOMEM;
+        goto fail;
+    }
+
+    pthread_mutex_lock(&impersonator_lock);
+    for (i = 0; i < identity_count; i++) {
+        if (strcmp(identities[i].name, name) == 0) {
+            id = &identities[i];
+            drop_current_locked(id);
+            free(id->name);
+            free(id->keytab);
+            free(id->principal);
+            break;
+        }
+    }
+    if (id == NULL) {
+        if (identity_count == IMPERSONATOR_MAX_IDENTITIES) {
+            pthread_mutex_unlock(&impersonator_lock);
+            ret = ENOSPC;
+            goto fail;
+        }
+        id = &identities[identity_count++];
+        memset(id, 0, sizeof(identity));
+    }
+    id->name = new_name;
+    id->keytab = new_keytab;
+    id->principal = new_principal;
+    pthread_mutex_unlock(&impersonator_lock);
+    return 0;
+
+fail:
+    free(new_name);
+    free(new_keytab);
+    free(new_principal);
+    return ret;
+}
+
+void impersonator_set_policy(int new_policy)
+{
+    pthread_mutex_lock(&impersonator_lock);
+    policy = new_policy;
+    pthread_mutex_unlock(&impersonator_lock);
+}
+
+// fill in up to max stats of the added identities, returns their number
+int impersonator_stats(impersonator_info *stats, int max)
+{
+    int i;
+
+    pthread_mutex_lock(&impersonator_lock);
+    for (i = 0; i < identity_count && i < max; i++) {
+        strncpy(stats[i].name, identities[i].name, sizeof(stats[i].name) - 1);
+        stats[i].name[sizeof(stats[i].name) - 1] = 0;
+        stats[i].impersonations = identities[i].impersonations;
+        stats[i].busy = identities[i].busy;
+    }
+    pthread_mutex_unlock(&impersonator_lock);
+    return i;
+}
+
+static unsigned long long hash_string(unsigned long long h, const char *s)
+{
+    for (; *s; s++)
+        h = (h ^ (unsigned char)*s) * 1099511628211ULL; // FNV-1a
+    return h;
+}
+
+// spread the bits of h, FNV alone hardly changes the high bits for a short suffix
+static unsigned long long mix(unsigned long long h)
+{
+    h ^= h >> 33;
+    h *= 0xff51afd7ed558ccdULL;
+    h ^= h >> 33;
+    h *= 0xc4ceb9fe1a85ec53ULL;
+    h ^= h >> 33;
+    return h;
+}
+
+// the slot of the identity to use, -1 for the default one, -2 if selector names no identity
+static int select_locked(const char *selector, const char *as_user)
+{
+    unsigned long long weight, best_weight = 0;
+    int i, best = 0;
+
+    if (identity_count == 0)
+        return selector == NULL ? -1 : -2;
+
+    if (selector != NULL) {
+        for (i = 0; i < identity_count; i++) {
+            if (strcmp(identities[i].name, selector) == 0)
+                return i;
+        }
+        return -2;
+    }
+
+    for (i = 0; i < identity_count; i++) {
+        if (policy == IMPERSONATOR_POLICY_LEAST_LOADED) {
+            if (identities[i].busy < identities[best].busy)
+                best = i;
+        } else {
+            // rendezvous hashing: adding an identity only moves the users it wins
+            weight = mix(hash_string(hash_string(14695981039346656037ULL, as_user ? as_user : ""), identities[i].name));
+            if (i == 0 || weight > best_weight) {
+                best = i;
+                best_weight = weight;
+            }
+        }
+    }
+    return best;
+}
+
+// get the credentials of the impersonator named selector, or of the one picked for as_user by the
+// policy if selector is NULL, acquiring them if needed.
+// The result is referenced for the caller, hand it back with impersonator_release.
+impersonator *impersonator_get(OM_uint32 *maj_stat, OM_uint32 *min_stat, const char *selector, const char *as_user)
+{
+    impersonator *imp = NULL, *fresh;
+    identity *id;
+    identity config;
+    char *key = NULL;
+    time_t now;
+    unsigned long generation;
+    int slot, valid;
+
+    *maj_stat = GSS_S_COMPLETE;
+    *min_stat = 0;
+
+    pthread_mutex_lock(&impersonator_lock);
+    for (;;)
+    {
+        slot = select_locked(selector, as_user);
+        if (slot == -2)
+        {
+            *maj_stat = GSS_S_NO_CRED;
+            goto end;
+        }
+        id = slot_identity(slot);
+
+        free(key);
+        key = make_key(id);
+        if (key == NULL)
+        {
+            *maj_stat = GSS_S_FAILURE;
+            *min_stat = ENOMEM;
+            goto end;
+        }
+
+        now = time(NULL);
+        valid = id->current != NULL && strcmp(id->current->key, key) == 0 && id->current->expires > now;
+        if (valid && id->current->expires - now > IMPERSONATOR_REFRESH_MARGIN)
+            break;
+        if (id->refreshing)
+        {
+            // someone else is at the KDC, the old handle does meanwhile
+            if (valid)
+                break;
+            pthread_cond_wait(&impersonator_refreshed, &impersonator_lock);
+            continue;
+        }
+
+        // our turn to get a new handle
+        if (copy_config_locked(&config, id) != 0)
+        {
+            *maj_stat = GSS_S_FAILURE;
+            *min_stat = ENOMEM;
+            goto end;
+        }
+        id->refreshing = 1;
+        generation = id->generation;
+        pthread_mutex_unlock(&impersonator_lock);
+
+        fresh = acquire_impersonator(maj_stat, min_stat, &config);
+        free_config(&config);
+
+        pthread_mutex_lock(&impersonator_lock);
+        id->refreshing = 0;
+        pthread_cond_broadcast(&impersonator_refreshed);
+        if (fresh == NULL)
+        {
+            // an old handle that's still valid is better than nothing
+            valid = id->current != NULL && strcmp(id->current->key, key) == 0 && id->current->expires > time(NULL);
+            if (!valid)
+                goto end;
+            *maj_stat = GSS_S_COMPLETE;
+            *min_stat = 0;
+            break;
+        }
+
+        fresh->key = key;
+        key = NULL;
+        fresh->slot = slot;
+        if (id->generation != generation)
+        {
+            // the identity was changed or flushed meanwhile, use the handle this once only
+            fresh->refcount = 1;
+            imp = fresh;
+            goto counted;
+        }
+        drop_current_locked(id);
+        fresh->refcount = 1;
+        id->current = fresh;
+        break;
+    }
+
+    imp = id->current;
+    imp->refcount++;
+counted:
+    id->impersonations++;
+    id->busy++;
+
+end:
+    pthread_mutex_unlock(&impersonator_lock);
+    free(key);
+    return imp;
+}
+
+void impersonator_release(impersonator *imp)
+{
+    if (imp == NULL)
+        return;
+    pthread_mutex_lock(&impersonator_lock);
+    slot_identity(imp->slot)->busy--;
+    release_locked(imp);
+    pthread_mutex_unlock(&impersonator_lock);
+}
+
+void impersonator_flush(void)
+{
+    int i;
+
+    pthread_mutex_lock(&impersonator_lock);
+    drop_current_locked(&default_identity);
+    for (i = 0; i < identity_count; i++)
+        drop_current_locked(&identities[i]);
+    pthread_mutex_unlock(&impersonator_lock);
+}
@@ -0,0 +1,51 @@
+/**
+ * Copyright (c) 2012 Norman Krämer. All rights reserved.
+ *
+ * Licensed under the Apache License, Version 2.0 (the "License");
+ * you may not use this file except in compliance with the License.
+ * You may obtain a copy of the License at
+ *
+ *     http://www.apache.org/licenses/LICENSE-2.0
+ *
+ * Unless required by applicable law or agreed to in writing, software
+ * distributed under the License is distributed on an "AS IS" BASIS,
+ * WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+ * See the License for the specific language governing permissions and
+ * limitations under the License.
+ **/
+
+#include <time.h>
+#include <gssapi/gssapi.h>
+
+// refresh the impersonator's credentials once fewer seconds than this are left
+#define IMPERSONATOR_REFRESH_MARGIN 300
+
+// at most this many identities can be added with impersonator_add
+#define IMPERSONATOR_MAX_IDENTITIES 64
+
+// how impersonator_get picks one of the added identities if the caller doesn't name one
+#define IMPERSONATOR_POLICY_HASH         0   // by the user, so a user's credentials stay cached with one identity
+#define IMPERSONATOR_POLICY_LEAST_LOADED 1   // the one with the fewest impersonations in progress
+
+typedef struct {
+    char*            key;        // identifies the impersonator in the delegated credential cache
+    gss_cred_id_t    creds;      // GSS_C_BOTH credentials of the impersonator
+    gss_name_t       name;       // the impersonator's principal
+    time_t           expires;
+    int              refcount;
+    int              slot;       // index of the added identity, -1 for the default one
+} impersonator;
+
+typedef struct {
+    char             name[64];
+    unsigned long    impersonations;   // impersonator_get calls that picked this identity
+    int              busy;             // impersonations in progress
+} impersonator_info;
+
+OM_uint32 impersonator_set_keytab(OM_uint32 *min_stat, const char *keytab, const char *principal);
+int impersonator_add(const char *name, const char *keytab, const char *principal);
+void impersonator_set_policy(int policy);
+int impersonator_stats(impersonator_info *stats, int max);
+impersonator *impersonator_get(OM_uint32 *maj_stat, OM_uint32 *min_stat, const char *selector, const char *as_user);
+void impersonator_release(impersonator *imp);
+void impersonator_flush(void);
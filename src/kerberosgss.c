@@ -22,69 +22,139 @@
 #include <Python.h>
 #include "kerberosgss.h"
 
-#include "base64.h"
-
 #include <stdio.h>
 #include <stdlib.h>
 #include <string.h>
+#include <errno.h>
+#include <time.h>
 #include <arpa/inet.h>
-
-static void set_gss_error(OM_uint32 err_maj, OM_uint32 err_min);
+#include <pthread.h>
 
 extern PyObject *GssException_class;
 extern PyObject *KrbException_class;
 
-int authenticate_gss_impers_step(gss_impers_state* state, const char* challenge)
+// seconds S4U_MODE_AUTO keeps using loopback after it had to fall back, before it tries direct again
+#define DIRECT_RETRY_INTERVAL 600
+
+#ifndef KRB5KDC_ERR_PADATA_TYPE_NOSUPP
+#define KRB5KDC_ERR_PADATA_TYPE_NOSUPP (-1765328368L)
+#endif
+
+// set when S4U_MODE_AUTO had to fall back to loopback, inits until then skip the direct attempt.
+// it expires, so the direct mode is tried again e.g. after the KDC was upgraded
+static time_t direct_unsupported_until = 0;
+static pthread_mutex_t direct_lock = PTHREAD_MUTEX_INITIALIZER;
+
+static int direct_unsupported(void)
+{
+    int unsupported;
+
+    pthread_mutex_lock(&direct_lock);
+    unsupported = time(NULL) < direct_unsupported_until;
+    pthread_mutex_unlock(&direct_lock);
+    return unsupported;
+}
+
+// whether the first step with S4U2Self creds failed because direct mode can't work here: the
+// library can't use them for S4U2Proxy, or the KDC doesn't understand the S4U padata. Other
+// errors (unknown service, BADOPTION for a user that can't be delegated, ...) would fail with
+// loopback creds too.
+static int direct_not_supported(OM_uint32 maj_stat, OM_uint32 min_stat)
+{
+    switch (GSS_ROUTINE_ERROR(maj_stat)) {
+    case GSS_S_UNAVAILABLE:
+    case GSS_S_BAD_MECH:
+    case GSS_S_NO_CRED:
+        return 1;
+    }
+    return min_stat == (OM_uint32)KRB5KDC_ERR_PADATA_TYPE_NOSUPP;
+}
+
+static void record_gss_error(gss_impers_state* state, OM_uint32 err_maj, OM_uint32 err_min)
+{
+    state->err_maj = err_maj;
+    state->err_min = err_min;
+}
+
+static OM_uint32 obtain_creds(OM_uint32 *min_stat, const char* as_user, int s4u_mode, int refresh, gss_impers_state* state);
+
+static OM_uint32 init_sec_context(OM_uint32 *min_stat, gss_impers_state* state, gss_buffer_t input_token, gss_buffer_t output_token)
+{
+    OM_uint32 maj_stat, tmp_min_stat;
+
+    maj_stat = gss_init_sec_context(min_stat,
+                                    state->delegated_creds,
+                                    &state->context,
+                                    state->service_principal_name,
+                                    GSS_C_NO_OID,
+                                    (OM_uint32)state->gss_flags,
+                                    0,
+                                    GSS_C_NO_CHANNEL_BINDINGS,
+                                    input_token,
+                                    NULL,
+                                    output_token,
+                                    NULL,
+                                    NULL);
+
+    // a context that failed to establish is of no further use
+    if (GSS_ERROR(maj_stat) && state->context != GSS_C_NO_CONTEXT)
+        (void)gss_delete_sec_context(&tmp_min_stat, &state->context, GSS_C_NO_BUFFER);
+    return maj_stat;
+}
+
+// challenge is the raw (not base64 encoded) token received from the server
+int authenticate_gss_impers_step(gss_impers_state* state, const void* challenge, size_t challenge_len)
 {
     OM_uint32 maj_stat;
-    OM_uint32 min_stat;
+    OM_uint32 min_stat, fallback_min_stat;
     gss_buffer_desc input_token = GSS_C_EMPTY_BUFFER;
     gss_buffer_desc output_token = GSS_C_EMPTY_BUFFER;
     int ret = AUTH_GSS_CONTINUE;
     
     // Always clear out the old response
-    if (state->response != NULL)
-    {
-        free(state->response);
-        state->response = NULL;
-    }
+    if (state->response.value != NULL)
+        (void)gss_release_buffer(&min_stat, &state->response);
     
     // If there is a challenge (data from the server) we need to give it to GSS
-    if (challenge && *challenge)
+    if (challenge && challenge_len)
     {
-        int len;
-        input_token.value = base64_decode(challenge, &len);
-        input_token.length = len;
+        input_token.value = (void *)challenge;
+        input_token.length = challenge_len;
     }
     
     // Do GSSAPI step
-    maj_stat = gss_init_sec_context(&min_stat,
-                                    state->delegated_creds,
-                                    &state->context,
-                                    state->service_principal_name,
-                                    GSS_C_NO_OID,
-                                    (OM_uint32)state->gss_flags,
-                                    0,
-                                    GSS_C_NO_CHANNEL_BINDINGS,
-                                    &input_token,
-                                    NULL,
-                                    &output_token,
-                                    NULL,
-                                    NULL);
+    maj_stat = init_sec_context(&min_stat, state, &input_token, &output_token);
+
+    if (GSS_ERROR(maj_stat) && state->direct && state->s4u_mode == S4U_MODE_AUTO && state->context == GSS_C_NO_CONTEXT &&
+        direct_not_supported(maj_stat, min_stat))
+    {
+        // retry with loopback creds, if that fails too the direct step's error is reported
+        if (!GSS_ERROR(obtain_creds(&fallback_min_stat, state->as_user, S4U_MODE_LOOPBACK, 0, state)))
+        {
+            maj_stat = init_sec_context(&min_stat, state, &input_token, &output_token);
+            if (!GSS_ERROR(maj_stat))
+            {
+                pthread_mutex_lock(&direct_lock);
+                direct_unsupported_until = time(NULL) + DIRECT_RETRY_INTERVAL;
+                pthread_mutex_unlock(&direct_lock);
+            }
+        }
+    }
     
     if ((maj_stat != GSS_S_COMPLETE) && (maj_stat != GSS_S_CONTINUE_NEEDED))
     {
-        set_gss_error(maj_stat, min_stat);
+        record_gss_error(state, maj_stat, min_stat);
         ret = AUTH_GSS_ERROR;
         goto end;
     }
     
     ret = (maj_stat == GSS_S_COMPLETE) ? AUTH_GSS_COMPLETE : AUTH_GSS_CONTINUE;
-    // Grab the client response to send back to the server
+    // Keep the client response to send back to the server, it's encoded when asked for
     if (output_token.length)
     {
-        state->response = base64_encode((const unsigned char *)output_token.value, output_token.length);;
-        maj_stat = gss_release_buffer(&min_stat, &output_token);
+        state->response = output_token;
+        output_token.value = NULL;
+        output_token.length = 0;
     }
     
     // Try to get the user name if we have completed all GSS operations
@@ -94,7 +164,7 @@ int authenticate_gss_impers_step(gss_impers_state* state, const char* challenge)
         maj_stat = gss_inquire_context(&min_stat, state->context, &gssuser, NULL, NULL, NULL,  NULL, NULL, NULL);
         if (GSS_ERROR(maj_stat))
         {
-            set_gss_error(maj_stat, min_stat);
+            record_gss_error(state, maj_stat, min_stat);
             ret = AUTH_GSS_ERROR;
             goto end;
         }
@@ -108,7 +178,7 @@ int authenticate_gss_impers_step(gss_impers_state* state, const char* challenge)
                 gss_release_buffer(&min_stat, &name_token);
             gss_release_name(&min_stat, &gssuser);
             
-            set_gss_error(maj_stat, min_stat);
+            record_gss_error(state, maj_stat, min_stat);
             ret = AUTH_GSS_ERROR;
             goto end;
         }
@@ -124,19 +194,17 @@ int authenticate_gss_impers_step(gss_impers_state* state, const char* challenge)
 end:
     if (output_token.value)
         gss_release_buffer(&min_stat, &output_token);
-    if (input_token.value)
-        free(input_token.value);
     return ret;
 }
 
 
-static void set_gss_error(OM_uint32 err_maj, OM_uint32 err_min)
+static PyObject *gss_error_value(OM_uint32 err_maj, OM_uint32 err_min)
 {
     OM_uint32 maj_stat, min_stat;
     OM_uint32 msg_ctx = 0;
     gss_buffer_desc status_string;
-    char buf_maj[512];
-    char buf_min[512];
+    char buf_maj[512] = "";
+    char buf_min[512] = "";
     
     do
     {
@@ -164,34 +232,53 @@ static void set_gss_error(OM_uint32 err_maj, OM_uint32 err_min)
         }
     } while (!GSS_ERROR(maj_stat) && msg_ctx != 0);
     
-    PyErr_SetObject(GssException_class, Py_BuildValue("((s:i)(s:i))", buf_maj, err_maj, buf_min, err_min));
+    return Py_BuildValue("((s:i)(s:i))", buf_maj, err_maj, buf_min, err_min);
 }
 
-int authenticate_gss_use_keytab(const char* keytab){
-    OM_uint32 maj_stat, min_stat=0;
-    maj_stat = krb5_gss_register_acceptor_identity(keytab);
-    if (GSS_ERROR(maj_stat)) {
-        set_gss_error(maj_stat, min_stat);
-        return AUTH_GSS_ERROR;
+void set_gss_error(OM_uint32 err_maj, OM_uint32 err_min)
+{
+    PyObject *value;
+
+    // our own allocation failures are recorded as GSS_S_FAILURE/ENOMEM
+    if (err_maj == GSS_S_FAILURE && err_min == ENOMEM) {
+        PyErr_NoMemory();
+        return;
     }
+    value = gss_error_value(err_maj, err_min);
+
+    if (value != NULL) {
+        PyErr_SetObject(GssException_class, value);
+        Py_DECREF(value);
+    }
+}
+
+PyObject *gss_error_object(OM_uint32 err_maj, OM_uint32 err_min)
+{
+    PyObject *exc, *value = gss_error_value(err_maj, err_min);
+
+    if (value == NULL)
+        return NULL;
+    exc = PyObject_CallObject(GssException_class, value);
+    Py_DECREF(value);
+    return exc;
+}
+
+// may be called without holding the GIL, on AUTH_GSS_ERROR the status is left in maj_stat/min_stat
+int authenticate_gss_use_keytab(const char* keytab, const char* principal, OM_uint32 *maj_stat, OM_uint32 *min_stat){
+    *min_stat = 0;
+    *maj_stat = impersonator_set_keytab(min_stat, keytab, principal);
+    if (GSS_ERROR(*maj_stat))
+        return AUTH_GSS_ERROR;
     return AUTH_GSS_CONTINUE;
 }
 
-static OM_uint32 ticket2self(OM_uint32 *min_stat, gss_cred_id_t client_creds, gss_cred_id_t impersonator_creds, gss_cred_id_t *delegated_creds)
+static OM_uint32 ticket2self(OM_uint32 *min_stat, gss_cred_id_t client_creds, gss_cred_id_t impersonator_creds, gss_name_t self_target, gss_cred_id_t *delegated_creds)
 {
     OM_uint32 maj_stat, tmp_min_stat;
     gss_ctx_id_t initiator_context = GSS_C_NO_CONTEXT;
     gss_ctx_id_t acceptor_context = GSS_C_NO_CONTEXT;
-    gss_name_t self_target = GSS_C_NO_NAME;
     gss_buffer_desc clienttoken, servertoken;
 
-
-    maj_stat = gss_inquire_cred(min_stat, impersonator_creds, &self_target, NULL, NULL, NULL);
-
-    if (GSS_ERROR(maj_stat)) {
-        goto end;
-    }
-
     clienttoken.value = NULL;
     clienttoken.length = 0;
     maj_stat = gss_init_sec_context(min_stat, client_creds, &initiator_context, self_target,
@@ -216,96 +303,182 @@ end:
     if (acceptor_context != GSS_C_NO_CONTEXT)  (void) gss_delete_sec_context(&tmp_min_stat, &acceptor_context, NULL);
     (void) gss_release_buffer(&tmp_min_stat, &clienttoken);
     (void) gss_release_buffer(&tmp_min_stat, &servertoken);
-    if (self_target != GSS_C_NO_NAME) (void) gss_release_name(&tmp_min_stat, &self_target);
 
     return maj_stat;
 }
 
-int authenticate_gss_impers_init(const char* as_user, const char* service, long int gss_flags, gss_impers_state* state){
-    OM_uint32 maj_stat;
-    OM_uint32 min_stat, tmp_min_stat;
+static OM_uint32 impersonate(OM_uint32 *min_stat, gss_name_t client_name, impersonator *imp, int direct, gss_cred_id_t *delegated_creds)
+{
+    OM_uint32 maj_stat, tmp_min_stat;
+    gss_cred_id_t client_creds = GSS_C_NO_CREDENTIAL;
+
+    // i am about to get a ticket to myself on behalf of as_user, so mask as the user and get impersonated client creds
+    maj_stat = gss_acquire_cred_impersonate_name(min_stat, imp->creds, client_name,
+                                              GSS_C_INDEFINITE, GSS_C_NO_OID_SET, GSS_C_INITIATE,
+                                              &client_creds, NULL, NULL);
+
+    if (GSS_ERROR(maj_stat))
+        goto end;
+
+    if (direct)
+    {
+        // recent libraries do S4U2Proxy with these creds in gss_init_sec_context, no need for the loopback
+        *delegated_creds = client_creds;
+        client_creds = GSS_C_NO_CREDENTIAL;
+        goto end;
+    }
+
+    // now request a ticket
+    maj_stat = ticket2self(min_stat, client_creds, imp->creds, imp->name, delegated_creds);
+
+    // voila, with accepting the AP_REQ ( to ourself ) we got the user's delegated creds which we can use to talk
+    // to the service as the user
+
+end:
+    if (client_creds != GSS_C_NO_CREDENTIAL) (void)gss_release_cred(&tmp_min_stat, &client_creds);
+    return maj_stat;
+}
+
+static void release_creds(gss_impers_state *state)
+{
+    OM_uint32 min_stat;
+
+    if (state->cache_entry != NULL){
+        // the creds belong to the credential cache, just drop our reference
+        credcache_release(state->cache_entry);
+        state->cache_entry = NULL;
+        state->delegated_creds = GSS_C_NO_CREDENTIAL;
+    }
+    else if (state->delegated_creds != GSS_C_NO_CREDENTIAL){
+    	(void) gss_release_cred(&min_stat, &state->delegated_creds);
+    	state->delegated_creds = GSS_C_NO_CREDENTIAL;
+    }
+}
+
+// get the creds to talk to services as as_user into state, replacing any creds it had before.
+// with refresh set the credential cache is bypassed and its entry replaced by the new creds.
+static OM_uint32 obtain_creds(OM_uint32 *min_stat, const char* as_user, int s4u_mode, int refresh, gss_impers_state* state)
+{
+    OM_uint32 maj_stat, tmp_min_stat;
+    OM_uint32 lifetime = 0;
     gss_buffer_desc name_token = GSS_C_EMPTY_BUFFER;
-    gss_name_t client_name;
-    gss_cred_id_t client_creds = GSS_C_NO_CREDENTIAL, impersonator_creds = GSS_C_NO_CREDENTIAL;
-    int ret = AUTH_GSS_COMPLETE;
-    
+    gss_name_t client_name = GSS_C_NO_NAME;
+    gss_cred_id_t delegated_creds = GSS_C_NO_CREDENTIAL;
+    impersonator *imp = NULL;
+    int direct = (s4u_mode == S4U_MODE_DIRECT) || (s4u_mode == S4U_MODE_AUTO && !direct_unsupported());
+    int kind = direct ? S4U_MODE_DIRECT : S4U_MODE_LOOPBACK;
+
+    release_creds(state);
+    state->direct = direct;
+
+    // get my credentials
+    imp = impersonator_get(&maj_stat, min_stat, state->impersonator, as_user);
+    if (imp == NULL)
+        return maj_stat;
+
+    // the user's delegated creds may still be around from an earlier init, then there is no need to talk to the KDC
+    if (!refresh) {
+        state->cache_entry = credcache_lookup(imp->key, as_user, kind, &state->delegated_creds);
+        if (state->cache_entry != NULL)
+            goto end;
+
+        // or on disk, from before a restart
+        if (credstore_enabled()) {
+            cred_cache_stats cache_stats;
+            credcache_stats(&cache_stats);
+            if (!GSS_ERROR(credstore_load(imp->key, as_user, kind, cache_stats.min_lifetime, &delegated_creds, &lifetime))) {
+                maj_stat = GSS_S_COMPLETE;
+                state->delegated_creds = delegated_creds;
+                state->cache_entry = credcache_insert(imp->key, as_user, kind, delegated_creds, lifetime);
+                goto end;
+            }
+        }
+    }
+
+    name_token.length = strlen(as_user);
+    name_token.value = (char *)as_user;
+
+    maj_stat = gss_import_name(min_stat, &name_token, (gss_OID)GSS_KRB5_NT_PRINCIPAL_NAME, &client_name);
+    if (GSS_ERROR(maj_stat))
+        goto end;
+
+    maj_stat = impersonate(min_stat, client_name, imp, direct, &delegated_creds);
+    if (GSS_ERROR(maj_stat))
+        goto end;
+
+    if (GSS_ERROR(gss_inquire_cred(&tmp_min_stat, delegated_creds, NULL, &lifetime, NULL, NULL)))
+        lifetime = 0;
+
+    credstore_save(imp->key, as_user, kind, delegated_creds, lifetime);
+    state->delegated_creds = delegated_creds;
+    state->cache_entry = credcache_insert(imp->key, as_user, kind, delegated_creds, lifetime);
+
+end:
+    if (client_name != GSS_C_NO_NAME) (void)gss_release_name(&tmp_min_stat, &client_name);
+    impersonator_release(imp);
+    return maj_stat;
+}
+
+static void init_state(gss_impers_state* state, long int gss_flags, int s4u_mode)
+{
     state->context = GSS_C_NO_CONTEXT;
     state->service_principal_name = GSS_C_NO_NAME;
     state->delegated_creds = GSS_C_NO_CREDENTIAL;
+    state->cache_entry = NULL;
+    state->as_user = NULL;
+    state->impersonator = NULL;
+    state->s4u_mode = s4u_mode;
+    state->direct = 0;
     state->username = NULL;
-    state->response = NULL;
+    state->response.value = NULL;
+    state->response.length = 0;
     state->gss_flags = gss_flags;
+    state->err_maj = state->err_min = 0;
+}
+
+int authenticate_gss_impers_init(const char* as_user, const char* service, long int gss_flags, int s4u_mode, int refresh,
+                                 const char* impersonator, gss_impers_state* state){
+    OM_uint32 maj_stat;
+    OM_uint32 min_stat;
+    int ret = AUTH_GSS_COMPLETE;
+    
+    init_state(state, gss_flags, s4u_mode);
 
     // Server name may be empty which means we aren't going to create our own creds
     size_t service_len = strlen(service);
     if (service_len != 0)
     {
-        name_token.length = strlen(as_user);
-        name_token.value = (char *)as_user;
-
-        maj_stat = gss_import_name(&min_stat, &name_token, (gss_OID)GSS_KRB5_NT_PRINCIPAL_NAME, &client_name);
-        if (GSS_ERROR(maj_stat))
-        {
-            set_gss_error(maj_stat, min_stat);
-            ret = AUTH_GSS_ERROR;
-            goto end;
-        }
-
-        name_token.length = strlen(service);
-        name_token.value = (char *)service;
-        
-        maj_stat = gss_import_name(&min_stat, &name_token, GSS_C_NT_HOSTBASED_SERVICE, &state->service_principal_name);
+        maj_stat = namecache_import(&min_stat, service, &state->service_principal_name);
         
         if (GSS_ERROR(maj_stat))
         {
-            set_gss_error(maj_stat, min_stat);
+            record_gss_error(state, maj_stat, min_stat);
             ret = AUTH_GSS_ERROR;
             goto end;
         }
 
-        // get my credentials
-        maj_stat = gss_acquire_cred(&min_stat, GSS_C_NO_NAME,
-        							GSS_C_INDEFINITE, GSS_C_NO_OID_SET, GSS_C_BOTH,
-        							&impersonator_creds, NULL, NULL);
-        
-        if (GSS_ERROR(maj_stat))
+        state->as_user = strdup(as_user);
+        if (impersonator != NULL)
+            state->impersonator = strdup(impersonator);
+        if (state->as_user == NULL || (impersonator != NULL && state->impersonator == NULL))
         {
-            set_gss_error(maj_stat, min_stat);
+            record_gss_error(state, GSS_S_FAILURE, ENOMEM);
             ret = AUTH_GSS_ERROR;
             goto end;
         }
-
-        // now i am about to get a ticket to myself on behalf of as_user, so mask as the user and get impersonated client creds
-        maj_stat = gss_acquire_cred_impersonate_name(&min_stat, impersonator_creds, client_name,
-                                                  GSS_C_INDEFINITE, GSS_C_NO_OID_SET, GSS_C_INITIATE,
-                                                  &client_creds, NULL, NULL);
+        maj_stat = obtain_creds(&min_stat, as_user, s4u_mode, refresh, state);
 
         if (GSS_ERROR(maj_stat))
         {
-            set_gss_error(maj_stat, min_stat);
+            record_gss_error(state, maj_stat, min_stat);
             ret = AUTH_GSS_ERROR;
             goto end;
         }
 
-        // now request a ticket
-        maj_stat = ticket2self(&min_stat, client_creds, impersonator_creds, &state->delegated_creds);
-
-        if (GSS_ERROR(maj_stat))
-        {
-            set_gss_error(maj_stat, min_stat);
-            ret = AUTH_GSS_ERROR;
-            goto end;
-        }
-
-        // voila, with accepting the AP_REQ ( to ourself ) we got the user's delegated creds which we can use to talk
-        // to the service as the user
         // you may now proceed with authenticate_gss_impers_step
     }
     
 end:
-	if (client_name != GSS_C_NO_NAME) (void)gss_release_name(&tmp_min_stat, &client_name);
-    if (impersonator_creds != GSS_C_NO_CREDENTIAL) (void)gss_release_cred(&tmp_min_stat, &impersonator_creds);
-    if (client_creds != GSS_C_NO_CREDENTIAL) (void)gss_release_cred(&tmp_min_stat, &client_creds);
     return ret;
 }
 
@@ -326,15 +499,20 @@ int authenticate_gss_impers_clean(gss_impers_state *state){
         free(state->username);
         state->username = NULL;
     }
-    if (state->response != NULL)
+    if (state->response.value != NULL)
+        (void)gss_release_buffer(&min_stat, &state->response);
+
+    release_creds(state);
+
+    if (state->as_user != NULL)
     {
-        free(state->response);
-        state->response = NULL;
+        free(state->as_user);
+        state->as_user = NULL;
     }
-
-    if (state->delegated_creds != GSS_C_NO_CREDENTIAL){
-    	(void) gss_release_cred(&min_stat, &state->delegated_creds);
-    	state->delegated_creds = GSS_C_NO_CREDENTIAL;
+    if (state->impersonator != NULL)
+    {
+        free(state->impersonator);
+        state->impersonator = NULL;
     }
 
     return ret;
@@ -354,12 +532,282 @@ int authenticate_gss_impers_cleanctx(gss_impers_state *state){
         free(state->username);
         state->username = NULL;
     }
-    if (state->response != NULL)
+    if (state->response.value != NULL)
+        (void)gss_release_buffer(&min_stat, &state->response);
+
+    return ret;
+
+}
+
+// like authenticate_gss_impers_init, but with delegated creds exported by
+// authenticate_gss_impers_export_cred (possibly in another process) instead of an S4U exchange
+int authenticate_gss_impers_init_from_cred(const void *token, size_t len, const char* service, long int gss_flags, gss_impers_state* state)
+{
+    OM_uint32 maj_stat;
+    OM_uint32 min_stat;
+    gss_buffer_desc cred_token;
+
+    init_state(state, gss_flags, S4U_MODE_LOOPBACK);
+
+    maj_stat = namecache_import(&min_stat, service, &state->service_principal_name);
+    if (GSS_ERROR(maj_stat))
+        goto end;
+
+    cred_token.value = (void *)token;
+    cred_token.length = len;
+    maj_stat = gss_import_cred(&min_stat, &cred_token, &state->delegated_creds);
+
+end:
+    if (GSS_ERROR(maj_stat)) {
+        record_gss_error(state, maj_stat, min_stat);
+        return AUTH_GSS_ERROR;
+    }
+    return AUTH_GSS_COMPLETE;
+}
+
+// serialize the delegated creds of the context into token, see authenticate_gss_impers_init_from_cred
+int authenticate_gss_impers_export_cred(gss_impers_state *state, gss_buffer_t token)
+{
+    OM_uint32 maj_stat, min_stat;
+
+    maj_stat = gss_export_cred(&min_stat, state->delegated_creds, token);
+    if (GSS_ERROR(maj_stat))
     {
-        free(state->response);
-        state->response = NULL;
+        record_gss_error(state, maj_stat, min_stat);
+        return AUTH_GSS_ERROR;
     }
+    return AUTH_GSS_COMPLETE;
+}
+
+// principal and remaining lifetime of the creds the context talks to the service with,
+// *principal is malloc'ed and has to be freed by the caller.
+int authenticate_gss_impers_inquire_cred(gss_impers_state *state, char **principal, OM_uint32 *lifetime)
+{
+    OM_uint32 maj_stat, min_stat, tmp_min_stat;
+    gss_name_t name = GSS_C_NO_NAME;
+    gss_buffer_desc name_token = GSS_C_EMPTY_BUFFER;
+    int ret = AUTH_GSS_COMPLETE;
 
+    *principal = NULL;
+    *lifetime = 0;
+
+    maj_stat = gss_inquire_cred(&min_stat, state->delegated_creds, &name, lifetime, NULL, NULL);
+    if (GSS_ERROR(maj_stat))
+        goto end;
+
+    maj_stat = gss_display_name(&min_stat, name, &name_token, NULL);
+    if (GSS_ERROR(maj_stat))
+        goto end;
+
+    *principal = (char *)malloc(name_token.length + 1);
+    if (*principal == NULL) {
+        maj_stat = GSS_S_FAILURE;
+        min_stat = ENOMEM;
+        goto end;
+    }
+    memcpy(*principal, name_token.value, name_token.length);
+    (*principal)[name_token.length] = 0;
+
+end:
+    if (GSS_ERROR(maj_stat)) {
+        record_gss_error(state, maj_stat, min_stat);
+        ret = AUTH_GSS_ERROR;
+    }
+    if (name_token.value != NULL) (void)gss_release_buffer(&tmp_min_stat, &name_token);
+    if (name != GSS_C_NO_NAME) (void)gss_release_name(&tmp_min_stat, &name);
     return ret;
+}
+
+// encrypt (or just sign if !conf_req) len bytes at data in place. header and trailer receive the
+// parts of the token around the data: header | data | trailer is what gss_wrap would have produced.
+int authenticate_gss_impers_wrap(gss_impers_state *state, int conf_req, void *data, size_t len,
+                                 gss_buffer_t header, gss_buffer_t trailer, int *conf_state)
+{
+    OM_uint32 maj_stat, min_stat, tmp_min_stat;
+    gss_iov_buffer_desc iov[4];
+    unsigned char *p;
+
+    iov[0].type = GSS_IOV_BUFFER_TYPE_HEADER | GSS_IOV_BUFFER_FLAG_ALLOCATE;
+    iov[0].buffer.value = NULL;
+    iov[0].buffer.length = 0;
+    iov[1].type = GSS_IOV_BUFFER_TYPE_DATA;
+    iov[1].buffer.value = data;
+    iov[1].buffer.length = len;
+    iov[2].type = GSS_IOV_BUFFER_TYPE_PADDING | GSS_IOV_BUFFER_FLAG_ALLOCATE;
+    iov[2].buffer.value = NULL;
+    iov[2].buffer.length = 0;
+    iov[3].type = GSS_IOV_BUFFER_TYPE_TRAILER | GSS_IOV_BUFFER_FLAG_ALLOCATE;
+    iov[3].buffer.value = NULL;
+    iov[3].buffer.length = 0;
+
+    maj_stat = gss_wrap_iov(&min_stat, state->context, conf_req, GSS_C_QOP_DEFAULT, conf_state, iov, 4);
+    if (GSS_ERROR(maj_stat))
+    {
+        record_gss_error(state, maj_stat, min_stat);
+        (void)gss_release_iov_buffer(&tmp_min_stat, iov, 4);
+        return AUTH_GSS_ERROR;
+    }
+
+    // hand out padding and trailer as one piece, both follow the data
+    header->length = iov[0].buffer.length;
+    header->value = malloc(header->length + 1);
+    trailer->length = iov[2].buffer.length + iov[3].buffer.length;
+    trailer->value = malloc(trailer->length + 1);
+    if (header->value != NULL && trailer->value != NULL)
+    {
+        memcpy(header->value, iov[0].buffer.value, iov[0].buffer.length);
+        p = (unsigned char *)trailer->value;
+        memcpy(p, iov[2].buffer.value, iov[2].buffer.length);
+        memcpy(p + iov[2].buffer.length, iov[3].buffer.value, iov[3].buffer.length);
+    }
+    (void)gss_release_iov_buffer(&tmp_min_stat, iov, 4);
+
+    if (header->value == NULL || trailer->value == NULL)
+    {
+        free(header->value);
+        free(trailer->value);
+        header->value = trailer->value = NULL;
+        record_gss_error(state, GSS_S_FAILURE, ENOMEM);
+        return AUTH_GSS_ERROR;
+    }
+    return AUTH_GSS_COMPLETE;
+}
+
+// decrypt/verify the wrap token of len bytes at token in place. *offset and *data_len receive the
+// position of the message within the token.
+int authenticate_gss_impers_unwrap(gss_impers_state *state, void *token, size_t len,
+                                   size_t *offset, size_t *data_len, int *conf_state, OM_uint32 *qop_state)
+{
+    OM_uint32 maj_stat, min_stat;
+    gss_iov_buffer_desc iov[2];
+
+    iov[0].type = GSS_IOV_BUFFER_TYPE_STREAM;
+    iov[0].buffer.value = token;
+    iov[0].buffer.length = len;
+    iov[1].type = GSS_IOV_BUFFER_TYPE_DATA;
+    iov[1].buffer.value = NULL;
+    iov[1].buffer.length = 0;
+
+    maj_stat = gss_unwrap_iov(&min_stat, state->context, conf_state, qop_state, iov, 2);
+    if (GSS_ERROR(maj_stat))
+    {
+        record_gss_error(state, maj_stat, min_stat);
+        return AUTH_GSS_ERROR;
+    }
+
+    *offset = (unsigned char *)iov[1].buffer.value - (unsigned char *)token;
+    *data_len = iov[1].buffer.length;
+    return AUTH_GSS_COMPLETE;
+}
+
+int authenticate_gss_impers_get_mic(gss_impers_state *state, const void *message, size_t len, gss_buffer_t mic)
+{
+    OM_uint32 maj_stat, min_stat;
+    gss_buffer_desc message_buffer;
+
+    message_buffer.value = (void *)message;
+    message_buffer.length = len;
+
+    maj_stat = gss_get_mic(&min_stat, state->context, GSS_C_QOP_DEFAULT, &message_buffer, mic);
+    if (GSS_ERROR(maj_stat))
+    {
+        record_gss_error(state, maj_stat, min_stat);
+        return AUTH_GSS_ERROR;
+    }
+    return AUTH_GSS_COMPLETE;
+}
+
+int authenticate_gss_impers_verify_mic(gss_impers_state *state, const void *message, size_t len,
+                                       const void *mic, size_t mic_len, OM_uint32 *qop_state)
+{
+    OM_uint32 maj_stat, min_stat;
+    gss_buffer_desc message_buffer, mic_buffer;
+
+    message_buffer.value = (void *)message;
+    message_buffer.length = len;
+    mic_buffer.value = (void *)mic;
+    mic_buffer.length = mic_len;
+
+    maj_stat = gss_verify_mic(&min_stat, state->context, &message_buffer, &mic_buffer, qop_state);
+    if (GSS_ERROR(maj_stat))
+    {
+        record_gss_error(state, maj_stat, min_stat);
+        return AUTH_GSS_ERROR;
+    }
+    return AUTH_GSS_COMPLETE;
+}
+
+typedef struct {
+    const char**      users;
+    size_t            count;
+    const char*       service;
+    long int          gss_flags;
+    int               s4u_mode;
+    gss_impers_state** states;
+    int*              results;
+
+    size_t            next;
+    pthread_mutex_t   lock;
+} impers_batch;
+
+static void *impers_batch_worker(void *arg)
+{
+    impers_batch *batch = (impers_batch *)arg;
+    size_t i;
+
+    for (;;)
+    {
+        pthread_mutex_lock(&batch->lock);
+        i = batch->next++;
+        pthread_mutex_unlock(&batch->lock);
+        if (i >= batch->count)
+            break;
+        batch->results[i] = authenticate_gss_impers_init(batch->users[i], batch->service, batch->gss_flags, batch->s4u_mode, 0, NULL, batch->states[i]);
+    }
+    return NULL;
+}
+
+// run authenticate_gss_impers_init for every user on up to max_workers native threads.
+// results[i] receives the result for users[i], errors are left in states[i] as usual.
+int authenticate_gss_impers_init_many(const char** users, size_t count, const char* service, long int gss_flags,
+                                      int s4u_mode, int max_workers, gss_impers_state** states, int* results)
+{
+    impers_batch batch;
+    pthread_t *threads;
+    int i, started = 0;
+
+    batch.users = users;
+    batch.count = count;
+    batch.service = service;
+    batch.gss_flags = gss_flags;
+    batch.s4u_mode = s4u_mode;
+    batch.states = states;
+    batch.results = results;
+    batch.next = 0;
+    pthread_mutex_init(&batch.lock, NULL);
+
+    if (max_workers < 1)
+        max_workers = 1;
+    if ((size_t)max_workers > count)
+        max_workers = (int)count;
+
+    threads = (pthread_t *)malloc(sizeof(pthread_t) * (max_workers > 0 ? max_workers : 1));
+    if (threads != NULL)
+    {
+        for (i = 0; i < max_workers; i++)
+        {
+            if (pthread_create(&threads[started], NULL, impers_batch_worker, &batch) == 0)
+                started++;
+        }
+    }
+
+    // do the work ourselves if no thread could be started, otherwise just help out
+    impers_batch_worker(&batch);
+
+    for (i = 0; i < started; i++)
+        pthread_join(threads[i], NULL);
 
+    free(threads);
+    pthread_mutex_destroy(&batch.lock);
+    return AUTH_GSS_COMPLETE;
 }
@@ -23,22 +23,60 @@
 #include <gssapi/gssapi_generic.h>
 #include <gssapi/gssapi_krb5.h>
 
+#include "credcache.h"
+#include "credstore.h"
+#include "impersonator.h"
+
 #define AUTH_GSS_ERROR      -1
 #define AUTH_GSS_COMPLETE    1
 #define AUTH_GSS_CONTINUE    0
 
+// how the credentials to talk to the service as the user are obtained
+#define S4U_MODE_LOOPBACK    0   // S4U2Self, then accept a ticket to ourselves to get delegated creds
+#define S4U_MODE_DIRECT      1   // use the S4U2Self creds directly, S4U2Proxy happens in gss_init_sec_context
+#define S4U_MODE_AUTO        2   // direct, falling back to loopback if the library can't do that
+
 typedef struct {
     gss_ctx_id_t     context;
     gss_name_t       service_principal_name;
     long int 		 gss_flags;
     char*            username;
-    char*            response;
+    gss_buffer_desc  response;        // raw output token of the last step
 
     gss_cred_id_t    delegated_creds; // the cred we use to talk to the service
+    char*            as_user;
+    char*            impersonator;    // name of the identity to impersonate with, NULL: picked by policy
+    int              s4u_mode;        // the requested S4U_MODE_*
+    int              direct;          // delegated_creds were obtained with S4U_MODE_DIRECT
+    cred_cache_entry* cache_entry;    // set if delegated_creds are borrowed from the credential cache
+
+    OM_uint32        err_maj;         // status of the last failed GSSAPI call, see set_gss_error
+    OM_uint32        err_min;
+    int              in_use;          // set while a call runs without the GIL
 } gss_impers_state;
 
-int authenticate_gss_use_keytab(const char* keytab);
-int authenticate_gss_impers_init(const char* as_user, const char* service, long int gss_flags, gss_impers_state* state);
+/*
+ * The authenticate_gss_impers_* functions don't touch any Python object, so they may be called
+ * without holding the GIL. On AUTH_GSS_ERROR the GSSAPI status is left in state->err_maj/err_min,
+ * turn it into a Python exception with set_gss_error once the GIL is held again.
+ */
+void set_gss_error(OM_uint32 err_maj, OM_uint32 err_min);
+PyObject *gss_error_object(OM_uint32 err_maj, OM_uint32 err_min);
+int authenticate_gss_use_keytab(const char* keytab, const char* principal, OM_uint32 *maj_stat, OM_uint32 *min_stat);
+int authenticate_gss_impers_init(const char* as_user, const char* service, long int gss_flags, int s4u_mode, int refresh,
+                                 const char* impersonator, gss_impers_state* state);
+int authenticate_gss_impers_init_from_cred(const void *token, size_t len, const char* service, long int gss_flags, gss_impers_state* state);
+int authenticate_gss_impers_export_cred(gss_impers_state *state, gss_buffer_t token);
 int authenticate_gss_impers_clean(gss_impers_state *state);
 int authenticate_gss_impers_cleanctx(gss_impers_state *state);
-int authenticate_gss_impers_step(gss_impers_state *state, const char *challenge);
+int authenticate_gss_impers_inquire_cred(gss_impers_state *state, char **principal, OM_uint32 *lifetime);
+int authenticate_gss_impers_step(gss_impers_state *state, const void *challenge, size_t challenge_len);
+int authenticate_gss_impers_wrap(gss_impers_state *state, int conf_req, void *data, size_t len,
+                                 gss_buffer_t header, gss_buffer_t trailer, int *conf_state);
+int authenticate_gss_impers_unwrap(gss_impers_state *state, void *token, size_t len,
+                                   size_t *offset, size_t *data_len, int *conf_state, OM_uint32 *qop_state);
+int authenticate_gss_impers_get_mic(gss_impers_state *state, const void *message, size_t len, gss_buffer_t mic);
+int authenticate_gss_impers_verify_mic(gss_impers_state *state, const void *message, size_t len,
+                                       const void *mic, size_t mic_len, OM_uint32 *qop_state);
+int authenticate_gss_impers_init_many(const char** users, size_t count, const char* service, long int gss_flags,
+                                      int s4u_mode, int max_workers, gss_impers_state** states, int* results);
@@ -19,56 +19,367 @@
  * This is a derivative work of the kerberos 1.1.1 package http://trac.calendarserver.org/
  */
 
+#define PY_SSIZE_T_CLEAN
 #include <Python.h>
 
 #include "kerberosgss.h"
+#include "base64.h"
+
+// raw tokens are bytes, base64 encoded tokens and names are native strings (str on both)
+#if PY_MAJOR_VERSION >= 3
+#define PyInt_FromLong PyLong_FromLong
+#define PyString_FromStringAndSize PyBytes_FromStringAndSize
+#define BYTES_FORMAT "y#"
+#else
+#define BYTES_FORMAT "s#"
+#endif
 
 PyObject *KrbException_class;
 PyObject *GssException_class;
 
+// A context must not be used by two threads at the same time. Since the GSSAPI calls run
+// without the GIL, mark the state busy (while still holding the GIL) before releasing it.
+static int claim_state(gss_impers_state *state)
+{
+    if (state->in_use) {
+        PyErr_SetString(KrbException_class, "Context is in use by another thread");
+        return 0;
+    }
+    state->in_use = 1;
+    return 1;
+}
+
+#define STATE_FREELIST_SIZE 64
+
+// recycled gss_impers_state blocks, only touched while holding the GIL
+static gss_impers_state *state_freelist[STATE_FREELIST_SIZE];
+static int state_freelist_len = 0;
+
+static gss_impers_state *state_alloc(void)
+{
+    if (state_freelist_len > 0)
+        return state_freelist[--state_freelist_len];
+    return (gss_impers_state *) malloc(sizeof(gss_impers_state));
+}
+
+static void state_free(gss_impers_state *state)
+{
+    if (state_freelist_len < STATE_FREELIST_SIZE)
+        state_freelist[state_freelist_len++] = state;
+    else
+        free(state);
+}
+
+typedef struct {
+    PyObject_HEAD
+    gss_impers_state *state;   // NULL once cleaned
+} ImpersonationContext;
+
+// releases all GSS resources of contexts that were never passed to authGSSImpersonationClean
+static void context_dealloc(ImpersonationContext *self)
+{
+    if (self->state != NULL) {
+        authenticate_gss_impers_clean(self->state);
+        state_free(self->state);
+        self->state = NULL;
+    }
+    PyObject_Del(self);
+}
+
+static PyTypeObject ImpersonationContext_Type = {
+    PyVarObject_HEAD_INIT(NULL, 0)
+    "s4u2p.ImpersonationContext",       /*tp_name*/
+    sizeof(ImpersonationContext),       /*tp_basicsize*/
+    0,                                  /*tp_itemsize*/
+    (destructor)context_dealloc,        /*tp_dealloc*/
+    0,                                  /*tp_print*/
+    0,                                  /*tp_getattr*/
+    0,                                  /*tp_setattr*/
+    0,                                  /*tp_compare*/
+    0,                                  /*tp_repr*/
+    0,                                  /*tp_as_number*/
+    0,                                  /*tp_as_sequence*/
+    0,                                  /*tp_as_mapping*/
+    0,                                  /*tp_hash */
+    0,                                  /*tp_call*/
+    0,                                  /*tp_str*/
+    0,                                  /*tp_getattro*/
+    0,                                  /*tp_setattro*/
+    0,                                  /*tp_as_buffer*/
+    Py_TPFLAGS_DEFAULT,                 /*tp_flags*/
+    "Impersonation context as returned by authGSSImpersonationInit.", /* tp_doc */
+};
+
+// wrap state into a new context object, on failure the caller still owns state
+static PyObject *context_new(gss_impers_state *state)
+{
+    ImpersonationContext *ctx = PyObject_New(ImpersonationContext, &ImpersonationContext_Type);
+
+    if (ctx == NULL)
+        return NULL;
+    ctx->state = state;
+    return (PyObject *)ctx;
+}
+
+// get the state of a context object, *state is NULL for an already cleaned context
+static int context_state(PyObject *pystate, gss_impers_state **state)
+{
+    if (!PyObject_TypeCheck(pystate, &ImpersonationContext_Type)) {
+        PyErr_SetString(PyExc_TypeError, "Expected a context object");
+        return 0;
+    }
+    *state = ((ImpersonationContext *)pystate)->state;
+    return 1;
+}
+
+// like context_state, but a cleaned context is an error
+static gss_impers_state *context_live_state(PyObject *pystate)
+{
+    gss_impers_state *state;
+
+    if (!context_state(pystate, &state))
+        return NULL;
+    if (state == NULL)
+        PyErr_SetString(KrbException_class, "Context has already been cleaned");
+    return state;
+}
+
 static PyObject* authGSSImpersonationInit(PyObject* self, PyObject* args, PyObject* keywds)
 {
     const char *service, *as_user;
     gss_impers_state *state;
     PyObject *pystate;
-    static char *kwlist[] = {"as_user", "service", "gssflags", NULL};
+    const char *impersonator = NULL;
+    static char *kwlist[] = {"as_user", "service", "gssflags", "mode", "refresh", "impersonator", NULL};
     long int gss_flags = GSS_C_MUTUAL_FLAG | GSS_C_SEQUENCE_FLAG;
+    int s4u_mode = S4U_MODE_LOOPBACK;
+    int refresh = 0;
     int result = 0;
 
-    if (!PyArg_ParseTupleAndKeywords(args, keywds, "s|s|l", kwlist, &as_user, &service, &gss_flags))
+    if (!PyArg_ParseTupleAndKeywords(args, keywds, "ss|liiz", kwlist, &as_user, &service, &gss_flags, &s4u_mode, &refresh, &impersonator))
+        return NULL;
+
+    if (s4u_mode < S4U_MODE_LOOPBACK || s4u_mode > S4U_MODE_AUTO) {
+        PyErr_SetString(PyExc_ValueError, "mode must be one of the S4U_MODE_* values");
         return NULL;
+    }
+
+    state = state_alloc();
+    if (state == NULL)
+        return PyErr_NoMemory();
+
+    Py_BEGIN_ALLOW_THREADS
+    result = authenticate_gss_impers_init(as_user, service, gss_flags, s4u_mode, refresh, impersonator, state);
+    Py_END_ALLOW_THREADS
 
-    state = (gss_impers_state *) malloc(sizeof(gss_impers_state));
-    pystate = PyCObject_FromVoidPtr(state, NULL);
+    if (result == AUTH_GSS_ERROR) {
+        set_gss_error(state->err_maj, state->err_min);
+        authenticate_gss_impers_clean(state);
+        state_free(state);
+        return NULL;
+    }
 
-    result = authenticate_gss_impers_init(as_user, service, gss_flags, state);
-    if (result == AUTH_GSS_ERROR)
+    state->in_use = 0;
+    pystate = context_new(state);
+    if (pystate == NULL) {
+        authenticate_gss_impers_clean(state);
+        state_free(state);
         return NULL;
+    }
 
-    return Py_BuildValue("(iO)", result, pystate);
+    return Py_BuildValue("(iN)", result, pystate);
 }
 
-static PyObject *authGSSImpersonationClean(PyObject *self, PyObject *args)
+static PyObject* authGSSImpersonationInitFromCred(PyObject* self, PyObject* args, PyObject* keywds)
 {
+    const char *service;
     gss_impers_state *state;
     PyObject *pystate;
+    Py_buffer token;
+    static char *kwlist[] = {"token", "service", "gssflags", NULL};
+    long int gss_flags = GSS_C_MUTUAL_FLAG | GSS_C_SEQUENCE_FLAG;
+    int result = 0;
+
+    if (!PyArg_ParseTupleAndKeywords(args, keywds, "s*s|l", kwlist, &token, &service, &gss_flags))
+        return NULL;
+
+    state = state_alloc();
+    if (state == NULL) {
+        PyBuffer_Release(&token);
+        return PyErr_NoMemory();
+    }
+
+    Py_BEGIN_ALLOW_THREADS
+    result = authenticate_gss_impers_init_from_cred(token.buf, token.len, service, gss_flags, state);
+    Py_END_ALLOW_THREADS
+    PyBuffer_Release(&token);
+
+    if (result == AUTH_GSS_ERROR) {
+        set_gss_error(state->err_maj, state->err_min);
+        authenticate_gss_impers_clean(state);
+        state_free(state);
+        return NULL;
+    }
+
+    state->in_use = 0;
+    pystate = context_new(state);
+    if (pystate == NULL) {
+        authenticate_gss_impers_clean(state);
+        state_free(state);
+        return NULL;
+    }
+
+    return Py_BuildValue("(iN)", result, pystate);
+}
+
+static PyObject *authGSSImpersonationExportCred(PyObject *self, PyObject *args)
+{
+    gss_impers_state *state;
+    PyObject *pystate, *ret;
+    gss_buffer_desc token = GSS_C_EMPTY_BUFFER;
+    OM_uint32 min_stat;
     int result = 0;
 
     if (!PyArg_ParseTuple(args, "O", &pystate))
         return NULL;
 
-    if (!PyCObject_Check(pystate)) {
-        PyErr_SetString(PyExc_TypeError, "Expected a context object");
+    state = context_live_state(pystate);
+    if (state == NULL)
+        return NULL;
+
+    if (!claim_state(state))
+        return NULL;
+
+    result = authenticate_gss_impers_export_cred(state, &token);
+    state->in_use = 0;
+
+    if (result == AUTH_GSS_ERROR) {
+        set_gss_error(state->err_maj, state->err_min);
         return NULL;
     }
 
-    state = (gss_impers_state *)PyCObject_AsVoidPtr(pystate);
+    ret = PyString_FromStringAndSize((const char *)token.value, token.length);
+    (void)gss_release_buffer(&min_stat, &token);
+    return ret;
+}
+
+static PyObject* authGSSImpersonationInitMany(PyObject* self, PyObject* args, PyObject* keywds)
+{
+    const char *service, **users = NULL;
+    gss_impers_state **states = NULL;
+    int *results = NULL;
+    PyObject *pyusers, *seq = NULL, *ret = NULL, *item;
+    static char *kwlist[] = {"users", "service", "gssflags", "max_workers", "mode", NULL};
+    long int gss_flags = GSS_C_MUTUAL_FLAG | GSS_C_SEQUENCE_FLAG;
+    int max_workers = 8, s4u_mode = S4U_MODE_LOOPBACK, ran = 0;
+    Py_ssize_t count, i;
+
+    if (!PyArg_ParseTupleAndKeywords(args, keywds, "Os|lii", kwlist, &pyusers, &service, &gss_flags, &max_workers, &s4u_mode))
+        return NULL;
+
+    if (s4u_mode < S4U_MODE_LOOPBACK || s4u_mode > S4U_MODE_AUTO) {
+        PyErr_SetString(PyExc_ValueError, "mode must be one of the S4U_MODE_* values");
+        return NULL;
+    }
+
+    // a tuple of its own, a list of the caller could change while the GIL is released
+    seq = PySequence_Tuple(pyusers);
+    if (seq == NULL)
+        return NULL;
+    count = PyTuple_GET_SIZE(seq);
+
+    users = (const char **) calloc(count + 1, sizeof(char *));
+    states = (gss_impers_state **) calloc(count + 1, sizeof(gss_impers_state *));
+    results = (int *) calloc(count + 1, sizeof(int));
+    if (users == NULL || states == NULL || results == NULL) {
+        PyErr_NoMemory();
+        goto end;
+    }
+
+    for (i = 0; i < count; i++) {
+        // the tuple holds the strings, so their buffers stay alive as long as seq does
+#if PY_MAJOR_VERSION >= 3
+        users[i] = PyUnicode_AsUTF8(PyTuple_GET_ITEM(seq, i));
+#else
+        users[i] = PyString_AsString(PyTuple_GET_ITEM(seq, i));
+#endif
+        if (users[i] == NULL)
+            goto end;
+        states[i] = state_alloc();
+        if (states[i] == NULL) {
+            PyErr_NoMemory();
+            goto end;
+        }
+    }
+
+    Py_BEGIN_ALLOW_THREADS
+    authenticate_gss_impers_init_many(users, count, service, gss_flags, s4u_mode, max_workers, states, results);
+    Py_END_ALLOW_THREADS
+    ran = 1;
+
+    ret = PyList_New(count);
+    if (ret == NULL)
+        goto end;
+
+    for (i = 0; i < count; i++) {
+        if (results[i] == AUTH_GSS_ERROR) {
+            item = gss_error_object(states[i]->err_maj, states[i]->err_min);
+            authenticate_gss_impers_clean(states[i]);
+            state_free(states[i]);
+            states[i] = NULL;
+        }
+        else {
+            states[i]->in_use = 0;
+            item = context_new(states[i]);
+            if (item != NULL) {
+                states[i] = NULL;
+                item = Py_BuildValue("(iN)", results[i], item);
+            }
+        }
+        if (item == NULL) {
+            Py_CLEAR(ret);
+            goto end;
+        }
+        PyList_SET_ITEM(ret, i, item);
+    }
+
+end:
+    if (states != NULL) {
+        for (i = 0; i < count; i++) {
+            if (states[i] == NULL)
+                continue;
+            if (ran)
+                authenticate_gss_impers_clean(states[i]);
+            state_free(states[i]);
+        }
+    }
+    free(users);
+    free(states);
+    free(results);
+    Py_DECREF(seq);
+    return ret;
+}
+
+static PyObject *authGSSImpersonationClean(PyObject *self, PyObject *args)
+{
+    gss_impers_state *state;
+    PyObject *pystate;
+    int result = 0;
+
+    if (!PyArg_ParseTuple(args, "O", &pystate))
+        return NULL;
+
+    if (!context_state(pystate, &state))
+        return NULL;
+
     if (state != NULL)
     {
+        if (!claim_state(state))
+            return NULL;
         result = authenticate_gss_impers_clean(state);
 
-        free(state);
-        PyCObject_SetVoidPtr(pystate, NULL);
+        state_free(state);
+        ((ImpersonationContext *)pystate)->state = NULL;
     }
 
     return Py_BuildValue("i", result);
@@ -83,48 +394,128 @@ static PyObject *authGSSImpersonationCleanCtx(PyObject *self, PyObject *args)
     if (!PyArg_ParseTuple(args, "O", &pystate))
         return NULL;
 
-    if (!PyCObject_Check(pystate)) {
-        PyErr_SetString(PyExc_TypeError, "Expected a context object");
+    if (!context_state(pystate, &state))
         return NULL;
-    }
 
-    state = (gss_impers_state *)PyCObject_AsVoidPtr(pystate);
     if (state != NULL)
     {
+        if (!claim_state(state))
+            return NULL;
         result = authenticate_gss_impers_cleanctx(state);
-
+        state->in_use = 0;
     }
 
     return Py_BuildValue("i", result);
 }
 
-static PyObject *authGSSImpersonationStep(PyObject *self, PyObject *args)
+static PyObject *impersonation_step(PyObject *pystate, const void *token, size_t token_len)
 {
     gss_impers_state *state;
-    PyObject *pystate;
-    char *challenge;
     int result = 0;
 
-    if (!PyArg_ParseTuple(args, "Os", &pystate, &challenge))
+    state = context_live_state(pystate);
+    if (state == NULL)
         return NULL;
 
-    if (!PyCObject_Check(pystate)) {
-        PyErr_SetString(PyExc_TypeError, "Expected a context object");
+    if (!claim_state(state))
+        return NULL;
+
+    Py_BEGIN_ALLOW_THREADS
+    result = authenticate_gss_impers_step(state, token, token_len);
+    Py_END_ALLOW_THREADS
+
+    state->in_use = 0;
+    if (result == AUTH_GSS_ERROR) {
+        set_gss_error(state->err_maj, state->err_min);
         return NULL;
     }
 
-    state = (gss_impers_state *)PyCObject_AsVoidPtr(pystate);
-    if (state == NULL)
+    return Py_BuildValue("i", result);
+}
+
+#define STEP_STACK_BUFFER 4096
+
+static PyObject *authGSSImpersonationStep(PyObject *self, PyObject *args)
+{
+    PyObject *pystate, *ret;
+    char *challenge;
+    Py_ssize_t challenge_len;
+    int token_len;
+    unsigned char stack_buffer[STEP_STACK_BUFFER];
+    unsigned char *token = stack_buffer;
+
+    if (!PyArg_ParseTuple(args, "Os#", &pystate, &challenge, &challenge_len))
         return NULL;
 
-    result = authenticate_gss_impers_step(state, challenge);
-    if (result == AUTH_GSS_ERROR)
+    // server tokens are small, decode them on the stack
+    if (base64_decoded_maxlen(challenge_len) > STEP_STACK_BUFFER) {
+        token = (unsigned char *) malloc(base64_decoded_maxlen(challenge_len));
+        if (token == NULL)
+            return PyErr_NoMemory();
+    }
+
+    token_len = base64_decode_into(challenge, (int)challenge_len, token);
+    if (token_len < 0)
+        token_len = 0;
+
+    ret = impersonation_step(pystate, token, token_len);
+
+    if (token != stack_buffer)
+        free(token);
+    return ret;
+}
+
+static PyObject *authGSSImpersonationStepRaw(PyObject *self, PyObject *args)
+{
+    PyObject *pystate, *ret;
+    Py_buffer token;
+
+    // any object supporting the buffer protocol, the token isn't copied
+    if (!PyArg_ParseTuple(args, "Os*", &pystate, &token))
         return NULL;
 
-    return Py_BuildValue("i", result);
+    ret = impersonation_step(pystate, token.buf, token.len);
+
+    PyBuffer_Release(&token);
+    return ret;
 }
 
 static PyObject *authGSSImpersonationResponse(PyObject *self, PyObject *args)
+{
+    gss_impers_state *state;
+    PyObject *pystate, *ret;
+
+    if (!PyArg_ParseTuple(args, "O", &pystate))
+        return NULL;
+
+    state = context_live_state(pystate);
+    if (state == NULL)
+        return NULL;
+
+    if (!claim_state(state))
+        return NULL;
+    state->in_use = 0;
+
+    if (state->response.value == NULL)
+        Py_RETURN_NONE;
+
+    // encode straight into the string object, base64 is ascii
+#if PY_MAJOR_VERSION >= 3
+    ret = PyUnicode_New(base64_encoded_len(state->response.length), 127);
+    if (ret == NULL)
+        return NULL;
+    base64_encode_into((const unsigned char *)state->response.value, state->response.length, (char *)PyUnicode_1BYTE_DATA(ret));
+#else
+    ret = PyString_FromStringAndSize(NULL, base64_encoded_len(state->response.length));
+    if (ret == NULL)
+        return NULL;
+    base64_encode_into((const unsigned char *)state->response.value, state->response.length, PyString_AS_STRING(ret));
+#endif
+
+    return ret;
+}
+
+static PyObject *authGSSImpersonationResponseRaw(PyObject *self, PyObject *args)
 {
     gss_impers_state *state;
     PyObject *pystate;
@@ -132,16 +523,168 @@ static PyObject *authGSSImpersonationResponse(PyObject *self, PyObject *args)
     if (!PyArg_ParseTuple(args, "O", &pystate))
         return NULL;
 
-    if (!PyCObject_Check(pystate)) {
-        PyErr_SetString(PyExc_TypeError, "Expected a context object");
+    state = context_live_state(pystate);
+    if (state == NULL)
+        return NULL;
+
+    if (!claim_state(state))
+        return NULL;
+    state->in_use = 0;
+
+    if (state->response.value == NULL)
+        Py_RETURN_NONE;
+
+    return PyString_FromStringAndSize((const char *)state->response.value, state->response.length);
+}
+
+// like context_live_state, but the security context must be established
+static gss_impers_state *context_established_state(PyObject *pystate)
+{
+    gss_impers_state *state = context_live_state(pystate);
+
+    if (state != NULL && state->context == GSS_C_NO_CONTEXT) {
+        PyErr_SetString(KrbException_class, "Context is not established");
         return NULL;
     }
+    return state;
+}
 
-    state = (gss_impers_state *)PyCObject_AsVoidPtr(pystate);
-    if (state == NULL)
+static PyObject *authGSSImpersonationWrap(PyObject *self, PyObject *args, PyObject *keywds)
+{
+    static char *kwlist[] = {"context", "data", "conf", NULL};
+    gss_impers_state *state;
+    PyObject *pystate, *ret = NULL;
+    Py_buffer data;
+    gss_buffer_desc header, trailer;
+    int conf_req = 1, conf_state = 0, result;
+
+    // data has to be writable, it is encrypted in place
+    if (!PyArg_ParseTupleAndKeywords(args, keywds, "Ow*|i", kwlist, &pystate, &data, &conf_req))
+        return NULL;
+
+    state = context_established_state(pystate);
+    if (state == NULL || !claim_state(state))
+        goto end;
+
+    Py_BEGIN_ALLOW_THREADS
+    result = authenticate_gss_impers_wrap(state, conf_req, data.buf, data.len, &header, &trailer, &conf_state);
+    Py_END_ALLOW_THREADS
+
+    state->in_use = 0;
+    if (result == AUTH_GSS_ERROR) {
+        set_gss_error(state->err_maj, state->err_min);
+        goto end;
+    }
+
+    ret = Py_BuildValue("(" BYTES_FORMAT BYTES_FORMAT "i)", header.value, (Py_ssize_t)header.length,
+                        trailer.value, (Py_ssize_t)trailer.length, conf_state);
+    free(header.value);
+    free(trailer.value);
+
+end:
+    PyBuffer_Release(&data);
+    return ret;
+}
+
+static PyObject *authGSSImpersonationUnwrap(PyObject *self, PyObject *args)
+{
+    gss_impers_state *state;
+    PyObject *pystate, *ret = NULL;
+    Py_buffer token;
+    size_t offset = 0, data_len = 0;
+    int conf_state = 0, result;
+    OM_uint32 qop_state = 0;
+
+    // the token is decrypted in place
+    if (!PyArg_ParseTuple(args, "Ow*", &pystate, &token))
+        return NULL;
+
+    state = context_established_state(pystate);
+    if (state == NULL || !claim_state(state))
+        goto end;
+
+    Py_BEGIN_ALLOW_THREADS
+    result = authenticate_gss_impers_unwrap(state, token.buf, token.len, &offset, &data_len, &conf_state, &qop_state);
+    Py_END_ALLOW_THREADS
+
+    state->in_use = 0;
+    if (result == AUTH_GSS_ERROR) {
+        set_gss_error(state->err_maj, state->err_min);
+        goto end;
+    }
+
+    ret = Py_BuildValue("(nni)", (Py_ssize_t)offset, (Py_ssize_t)data_len, conf_state);
+
+end:
+    PyBuffer_Release(&token);
+    return ret;
+}
+
+static PyObject *authGSSImpersonationGetMic(PyObject *self, PyObject *args)
+{
+    gss_impers_state *state;
+    PyObject *pystate, *ret = NULL;
+    Py_buffer message;
+    gss_buffer_desc mic = GSS_C_EMPTY_BUFFER;
+    OM_uint32 min_stat;
+    int result;
+
+    if (!PyArg_ParseTuple(args, "Os*", &pystate, &message))
+        return NULL;
+
+    state = context_established_state(pystate);
+    if (state == NULL || !claim_state(state))
+        goto end;
+
+    Py_BEGIN_ALLOW_THREADS
+    result = authenticate_gss_impers_get_mic(state, message.buf, message.len, &mic);
+    Py_END_ALLOW_THREADS
+
+    state->in_use = 0;
+    if (result == AUTH_GSS_ERROR) {
+        set_gss_error(state->err_maj, state->err_min);
+        goto end;
+    }
+
+    ret = PyString_FromStringAndSize((const char *)mic.value, mic.length);
+    (void)gss_release_buffer(&min_stat, &mic);
+
+end:
+    PyBuffer_Release(&message);
+    return ret;
+}
+
+static PyObject *authGSSImpersonationVerifyMic(PyObject *self, PyObject *args)
+{
+    gss_impers_state *state;
+    PyObject *pystate, *ret = NULL;
+    Py_buffer message, mic;
+    OM_uint32 qop_state = 0;
+    int result;
+
+    if (!PyArg_ParseTuple(args, "Os*s*", &pystate, &message, &mic))
         return NULL;
 
-    return Py_BuildValue("s", state->response);
+    state = context_established_state(pystate);
+    if (state == NULL || !claim_state(state))
+        goto end;
+
+    Py_BEGIN_ALLOW_THREADS
+    result = authenticate_gss_impers_verify_mic(state, message.buf, message.len, mic.buf, mic.len, &qop_state);
+    Py_END_ALLOW_THREADS
+
+    state->in_use = 0;
+    if (result == AUTH_GSS_ERROR) {
+        set_gss_error(state->err_maj, state->err_min);
+        goto end;
+    }
+
+    ret = Py_BuildValue("I", qop_state);
+
+end:
+    PyBuffer_Release(&message);
+    PyBuffer_Release(&mic);
+    return ret;
 }
 
 static PyObject *authGSSImpersonationUserName(PyObject *self, PyObject *args)
@@ -152,38 +695,225 @@ static PyObject *authGSSImpersonationUserName(PyObject *self, PyObject *args)
     if (!PyArg_ParseTuple(args, "O", &pystate))
         return NULL;
 
-    if (!PyCObject_Check(pystate)) {
-        PyErr_SetString(PyExc_TypeError, "Expected a context object");
+    state = context_live_state(pystate);
+    if (state == NULL)
         return NULL;
-    }
 
-    state = (gss_impers_state *)PyCObject_AsVoidPtr(pystate);
-    if (state == NULL)
+    if (!claim_state(state))
         return NULL;
+    state->in_use = 0;
 
     return Py_BuildValue("s", state->username);
 }
 
-static PyObject *authUse_keytab(PyObject *self, PyObject *args)
+static PyObject *authGSSImpersonationInquireCred(PyObject *self, PyObject *args)
 {
-    char *keytab;
+    gss_impers_state *state;
+    PyObject *pystate, *ret;
+    char *principal = NULL;
+    OM_uint32 lifetime = 0;
     int result = 0;
 
-    if (!PyArg_ParseTuple(args, "s", &keytab))
+    if (!PyArg_ParseTuple(args, "O", &pystate))
+        return NULL;
+
+    state = context_live_state(pystate);
+    if (state == NULL)
         return NULL;
 
-    result = authenticate_gss_use_keytab(keytab);
-    if (result == AUTH_GSS_ERROR)
+    if (!claim_state(state))
+        return NULL;
+
+    Py_BEGIN_ALLOW_THREADS
+    result = authenticate_gss_impers_inquire_cred(state, &principal, &lifetime);
+    Py_END_ALLOW_THREADS
+    state->in_use = 0;
+
+    if (result == AUTH_GSS_ERROR) {
+        set_gss_error(state->err_maj, state->err_min);
         return NULL;
+    }
+
+    ret = Py_BuildValue("{s:s,s:k}", "principal", principal, "lifetime", (unsigned long)lifetime);
+    free(principal);
+    return ret;
+}
+
+static PyObject *authUse_keytab(PyObject *self, PyObject *args, PyObject *keywds)
+{
+    static char *kwlist[] = {"keytabfile", "principal", NULL};
+    char *keytab, *principal = NULL;
+    OM_uint32 maj_stat, min_stat;
+    int result = 0;
+
+    if (!PyArg_ParseTupleAndKeywords(args, keywds, "s|z", kwlist, &keytab, &principal))
+        return NULL;
+
+    // the impersonator functions take a lock that is held while an identity is replaced
+    Py_BEGIN_ALLOW_THREADS
+    result = authenticate_gss_use_keytab(keytab, principal, &maj_stat, &min_stat);
+    Py_END_ALLOW_THREADS
+
+    if (result == AUTH_GSS_ERROR) {
+        set_gss_error(maj_stat, min_stat);
+        return NULL;
+    }
 
     return Py_BuildValue("i", result);
 }
 
+static PyObject *authImpersonatorAdd(PyObject *self, PyObject *args, PyObject *keywds)
+{
+    static char *kwlist[] = {"name", "keytabfile", "principal", NULL};
+    const char *name, *keytab, *principal;
+    int err;
+
+    if (!PyArg_ParseTupleAndKeywords(args, keywds, "ssz", kwlist, &name, &keytab, &principal))
+        return NULL;
+
+    Py_BEGIN_ALLOW_THREADS
+    err = impersonator_add(name, keytab, principal);
+    Py_END_ALLOW_THREADS
+
+    if (err != 0) {
+        errno = err;
+        return PyErr_SetFromErrno(PyExc_OSError);
+    }
+
+    return Py_BuildValue("i", AUTH_GSS_COMPLETE);
+}
+
+static PyObject *authImpersonatorPolicy(PyObject *self, PyObject *args)
+{
+    int policy;
+
+    if (!PyArg_ParseTuple(args, "i", &policy))
+        return NULL;
+
+    if (policy != IMPERSONATOR_POLICY_HASH && policy != IMPERSONATOR_POLICY_LEAST_LOADED) {
+        PyErr_SetString(PyExc_ValueError, "policy must be one of the IMPERSONATOR_POLICY_* values");
+        return NULL;
+    }
+    Py_BEGIN_ALLOW_THREADS
+    impersonator_set_policy(policy);
+    Py_END_ALLOW_THREADS
+
+    return Py_BuildValue("i", AUTH_GSS_COMPLETE);
+}
+
+static PyObject *authImpersonatorStats(PyObject *self, PyObject *args)
+{
+    impersonator_info stats[IMPERSONATOR_MAX_IDENTITIES];
+    PyObject *ret, *item;
+    int count, i;
+
+    Py_BEGIN_ALLOW_THREADS
+    count = impersonator_stats(stats, IMPERSONATOR_MAX_IDENTITIES);
+    Py_END_ALLOW_THREADS
+
+    ret = PyList_New(count);
+    if (ret == NULL)
+        return NULL;
+
+    for (i = 0; i < count; i++) {
+        item = Py_BuildValue("{s:s,s:k,s:i}", "name", stats[i].name,
+                             "impersonations", stats[i].impersonations, "busy", stats[i].busy);
+        if (item == NULL) {
+            Py_DECREF(ret);
+            return NULL;
+        }
+        PyList_SET_ITEM(ret, i, item);
+    }
+    return ret;
+}
+
+static PyObject *authCredCacheConfig(PyObject *self, PyObject *args, PyObject *keywds)
+{
+    static char *kwlist[] = {"maxentries", "minlifetime", NULL};
+    cred_cache_stats stats;
+    unsigned int max_entries, min_lifetime;
+
+    credcache_stats(&stats);
+    max_entries = stats.max_entries;
+    min_lifetime = stats.min_lifetime;
+
+    if (!PyArg_ParseTupleAndKeywords(args, keywds, "|II", kwlist, &max_entries, &min_lifetime))
+        return NULL;
+
+    credcache_configure(max_entries, min_lifetime);
+
+    return Py_BuildValue("i", AUTH_GSS_COMPLETE);
+}
+
+static PyObject *authCredCacheStats(PyObject *self, PyObject *args)
+{
+    cred_cache_stats stats;
+
+    credcache_stats(&stats);
+
+    return Py_BuildValue("{s:k,s:k,s:k,s:k,s:I,s:I,s:I}",
+                         "hits", stats.hits,
+                         "misses", stats.misses,
+                         "evictions", stats.evictions,
+                         "expirations", stats.expirations,
+                         "entries", stats.entries,
+                         "maxentries", stats.max_entries,
+                         "minlifetime", stats.min_lifetime);
+}
+
+static PyObject *authCredCacheFlush(PyObject *self, PyObject *args)
+{
+    Py_BEGIN_ALLOW_THREADS
+    credcache_flush();
+    namecache_flush();
+    impersonator_flush();
+    Py_END_ALLOW_THREADS
+
+    return Py_BuildValue("i", AUTH_GSS_COMPLETE);
+}
+
+static PyObject *authCredStoreConfig(PyObject *self, PyObject *args)
+{
+    const char *directory = NULL;
+    int err;
+
+    if (!PyArg_ParseTuple(args, "z", &directory))
+        return NULL;
+
+    Py_BEGIN_ALLOW_THREADS
+    err = credstore_configure(directory);
+    Py_END_ALLOW_THREADS
+
+    if (err != 0) {
+        errno = err;
+        return PyErr_SetFromErrnoWithFilename(PyExc_OSError, (char *)directory);
+    }
+
+    return Py_BuildValue("i", AUTH_GSS_COMPLETE);
+}
+
+static PyObject *authCredStorePrune(PyObject *self, PyObject *args)
+{
+    int removed;
+
+    Py_BEGIN_ALLOW_THREADS
+    removed = credstore_prune();
+    Py_END_ALLOW_THREADS
+
+    return Py_BuildValue("i", removed);
+}
+
 static PyMethodDef S4U2PKerberosMethods[] = {
-    {"authGSSKeytab",  authUse_keytab, METH_VARARGS,
-	     "Set keytab to use in GSSAPI operations."},
+    {"authGSSKeytab",  (PyCFunction)authUse_keytab, METH_VARARGS | METH_KEYWORDS,
+	     "Set keytab to use in GSSAPI operations, with a principal the impersonator's TGT is obtained from it too."},
     {"authGSSImpersonationInit",  (PyCFunction)authGSSImpersonationInit, METH_VARARGS | METH_KEYWORDS,
      "Initialize impersonation GSSAPI operations."},
+    {"authGSSImpersonationInitMany",  (PyCFunction)authGSSImpersonationInitMany, METH_VARARGS | METH_KEYWORDS,
+     "Initialize impersonation GSSAPI operations for many users in parallel."},
+    {"authGSSImpersonationInitFromCred",  (PyCFunction)authGSSImpersonationInitFromCred, METH_VARARGS | METH_KEYWORDS,
+     "Initialize impersonation GSSAPI operations with credentials exported by authGSSImpersonationExportCred."},
+    {"authGSSImpersonationExportCred",  authGSSImpersonationExportCred, METH_VARARGS,
+     "Export the credentials of a context, e.g. to hand them to another process."},
     {"authGSSImpersonationClean",  authGSSImpersonationClean, METH_VARARGS,
      "Terminate impersonation GSSAPI operations."},
      {"authGSSImpersonationCleanCtx",  authGSSImpersonationCleanCtx, METH_VARARGS,
@@ -192,19 +922,55 @@ static PyMethodDef S4U2PKerberosMethods[] = {
      "Do a Impersonation GSSAPI step."},
     {"authGSSImpersonationResponse",  authGSSImpersonationResponse, METH_VARARGS,
      "Get the response from the last Impersonation GSSAPI step."},
+    {"authGSSImpersonationStepRaw",  authGSSImpersonationStepRaw, METH_VARARGS,
+     "Do a Impersonation GSSAPI step with a raw (not base64 encoded) token."},
+    {"authGSSImpersonationResponseRaw",  authGSSImpersonationResponseRaw, METH_VARARGS,
+     "Get the raw (not base64 encoded) response from the last Impersonation GSSAPI step."},
     {"authGSSImpersonationUserName",  authGSSImpersonationUserName, METH_VARARGS,
      "Get the user name from the last Impersonation GSSAPI step."},
+    {"authGSSImpersonationInquireCred",  authGSSImpersonationInquireCred, METH_VARARGS,
+     "Get the principal and the remaining lifetime in seconds of the credentials a context uses."},
+    {"authGSSImpersonationWrap",  (PyCFunction)authGSSImpersonationWrap, METH_VARARGS | METH_KEYWORDS,
+     "Encrypt or sign a writable buffer in place, returns the header and trailer of the token."},
+    {"authGSSImpersonationUnwrap",  authGSSImpersonationUnwrap, METH_VARARGS,
+     "Decrypt or verify a token in a writable buffer in place, returns the position of the message."},
+    {"authGSSImpersonationGetMic",  authGSSImpersonationGetMic, METH_VARARGS,
+     "Compute a MIC over a message."},
+    {"authGSSImpersonationVerifyMic",  authGSSImpersonationVerifyMic, METH_VARARGS,
+     "Verify the MIC of a message."},
+    {"authGSSCredCacheConfig",  (PyCFunction)authCredCacheConfig, METH_VARARGS | METH_KEYWORDS,
+     "Set size and minimum remaining lifetime of the delegated credential cache."},
+    {"authGSSImpersonatorAdd",  (PyCFunction)authImpersonatorAdd, METH_VARARGS | METH_KEYWORDS,
+     "Add an impersonator identity with its own keytab."},
+    {"authGSSImpersonatorPolicy",  authImpersonatorPolicy, METH_VARARGS,
+     "Set how an impersonator identity is picked if authGSSImpersonationInit doesn't name one."},
+    {"authGSSImpersonatorStats",  authImpersonatorStats, METH_NOARGS,
+     "Get the number of impersonations done and in progress per impersonator identity."},
+    {"authGSSCredCacheStats",  authCredCacheStats, METH_NOARGS,
+     "Get hit, miss and eviction counters of the delegated credential cache."},
+    {"authGSSCredCacheFlush",  authCredCacheFlush, METH_NOARGS,
+     "Drop all cached delegated credentials, impersonator credentials and service names."},
+    {"authGSSCredStoreConfig",  authCredStoreConfig, METH_VARARGS,
+     "Keep delegated credentials in a directory of ccaches that survives restarts, None disables it."},
+    {"authGSSCredStorePrune",  authCredStorePrune, METH_NOARGS,
+     "Remove expired ccaches from the credential store, returns how many were removed."},
     {NULL, NULL, 0, NULL}        /* Sentinel */
 };
 
-PyMODINIT_FUNC inits4u2p(void)
+static int init_module(PyObject *m)
 {
-    PyObject *m,*d;
+    PyObject *d;
 
-    m = Py_InitModule("s4u2p", S4U2PKerberosMethods);
+    if (m == NULL)
+        return -1;
 
     d = PyModule_GetDict(m);
 
+    if (PyType_Ready(&ImpersonationContext_Type) < 0)
+        goto error;
+    Py_INCREF(&ImpersonationContext_Type);
+    PyDict_SetItemString(d, "ImpersonationContext", (PyObject *)&ImpersonationContext_Type);
+
     /* create the base exception class */
     if (!(KrbException_class = PyErr_NewException("kerberos.KrbError", NULL, NULL)))
         goto error;
@@ -220,6 +986,13 @@ PyMODINIT_FUNC inits4u2p(void)
     PyDict_SetItemString(d, "AUTH_GSS_COMPLETE", PyInt_FromLong(AUTH_GSS_COMPLETE));
     PyDict_SetItemString(d, "AUTH_GSS_CONTINUE", PyInt_FromLong(AUTH_GSS_CONTINUE));
 
+    PyDict_SetItemString(d, "S4U_MODE_LOOPBACK", PyInt_FromLong(S4U_MODE_LOOPBACK));
+    PyDict_SetItemString(d, "S4U_MODE_DIRECT", PyInt_FromLong(S4U_MODE_DIRECT));
+    PyDict_SetItemString(d, "S4U_MODE_AUTO", PyInt_FromLong(S4U_MODE_AUTO));
+
+    PyDict_SetItemString(d, "IMPERSONATOR_POLICY_HASH", PyInt_FromLong(IMPERSONATOR_POLICY_HASH));
+    PyDict_SetItemString(d, "IMPERSONATOR_POLICY_LEAST_LOADED", PyInt_FromLong(IMPERSONATOR_POLICY_LEAST_LOADED));
+
     PyDict_SetItemString(d, "GSS_C_DELEG_FLAG", PyInt_FromLong(GSS_C_DELEG_FLAG));
     PyDict_SetItemString(d, "GSS_C_MUTUAL_FLAG", PyInt_FromLong(GSS_C_MUTUAL_FLAG));
     PyDict_SetItemString(d, "GSS_C_REPLAY_FLAG", PyInt_FromLong(GSS_C_REPLAY_FLAG));
@@ -231,6 +1004,35 @@ PyMODINIT_FUNC inits4u2p(void)
     PyDict_SetItemString(d, "GSS_C_TRANS_FLAG", PyInt_FromLong(GSS_C_TRANS_FLAG));
 
 error:
-    if (PyErr_Occurred())
+    if (PyErr_Occurred()) {
         PyErr_SetString(PyExc_ImportError, "kerberos: init failed");
+        return -1;
+    }
+    return 0;
+}
+
+#if PY_MAJOR_VERSION >= 3
+static struct PyModuleDef s4u2p_module = {
+    PyModuleDef_HEAD_INIT,
+    "s4u2p",                            /* m_name */
+    NULL,                               /* m_doc */
+    -1,                                 /* m_size */
+    S4U2PKerberosMethods,               /* m_methods */
+};
+
+PyMODINIT_FUNC PyInit_s4u2p(void)
+{
+    PyObject *m = PyModule_Create(&s4u2p_module);
+
+    if (init_module(m) < 0) {
+        Py_XDECREF(m);
+        return NULL;
+    }
+    return m;
+}
+#else
+PyMODINIT_FUNC inits4u2p(void)
+{
+    init_module(Py_InitModule("s4u2p", S4U2PKerberosMethods));
 }
+#endif
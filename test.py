@@ -9,6 +9,8 @@ parser.add_argument("--port", dest="port", help="port, where a webserver is list
 parser.add_argument("--servicename", dest="servicename", help="service with which a kerberos session is to be initiated.", default="http@VM-WIN7-KRAEMER")
 parser.add_argument("--path", dest="path", help="path to kerberos protected resource on the webserver", default="/username/") # my sample webpage just replies with: Hello <domainuser>
 parser.add_argument("--keytab", dest="keytab", help="path to keytab if you won't use system's default one", default=None)
+parser.add_argument("--principal", dest="principal", help="impersonator's principal in the keytab, to get its TGT from the keytab instead of kinit", default=None)
+parser.add_argument("tests", nargs="*", help="tests to run (see the bottom of this file), default: all")
 
 
 def getConn(host, port):
@@ -120,6 +122,148 @@ def reuseCredMultipleCalls(args):
    authGSSImpersonationClean(ctx) # clean up
 
 
+def concurrentCalls(args, threads=8):
+   """
+   authGSSImpersonationInit and authGSSImpersonationStep release the GIL while talking to the KDC, so
+   impersonations on separate contexts run in parallel. A single context must only be used by one thread at a time,
+   using it from a second thread while a call is in progress raises a KrbError.
+   """
+   import threading
+   import time
+
+   errors = []
+   def worker():
+      try:
+         _ignore, ctx = authGSSImpersonationInit(args.user, args.servicename)
+         h = getConn(args.host, args.port)
+         callserver(h, args.path, ctx, authGSSImpersonationStep, authGSSImpersonationResponse)
+         authGSSImpersonationClean(ctx) # clean up
+      except KrbError, e:
+         errors.append(e)
+
+   authGSSCredCacheFlush() # make every thread talk to the KDC
+   start = time.time()
+   workers = [threading.Thread(target=worker) for i in range(threads)]
+   for t in workers: t.start()
+   for t in workers: t.join()
+   print "%d threads done in %.3fs, %d errors" % (threads, time.time() - start, len(errors))
+   for e in errors:
+      print e
+
+def initManyCalls(args, count=20):
+   """
+   Warm up the delegated credentials of several users at once, failures are returned per user.
+   """
+   import time
+
+   authGSSCredCacheFlush()
+   start = time.time()
+   results = authGSSImpersonationInitMany([args.user] * count, args.servicename, max_workers=8)
+   print "%d inits done in %.3fs" % (count, time.time() - start)
+   for r in results:
+      if isinstance(r, GSSError):
+         print "failed:", r
+      else:
+         authGSSImpersonationClean(r[1]) # clean up
+
+def contextPoolCalls(args, threads=8, count=50):
+   """
+   s4u2p_util.ContextPool shared by several threads: a context is only ever handed to one thread at a time, released
+   contexts are handed out again and contexts whose credentials have less than min_lifetime left are dropped.
+   """
+   import threading
+   from s4u2p_util import ContextPool
+
+   flags = GSS_C_MUTUAL_FLAG | GSS_C_SEQUENCE_FLAG
+   pool = ContextPool(size=threads)
+   lock = threading.Lock()
+   in_use = set()
+   errors = []
+   def worker():
+      for i in range(count):
+         try:
+            ctx = pool.acquire(args.user, args.servicename, flags)
+            with lock:
+               if ctx in in_use:
+                  errors.append("context handed out twice")
+               in_use.add(ctx)
+            authGSSImpersonationStep(ctx, "")
+            authGSSImpersonationResponse(ctx)
+            with lock:
+               in_use.discard(ctx)
+            pool.release(args.user, args.servicename, flags, ctx)
+         except KrbError, e:
+            errors.append(e)
+
+   workers = [threading.Thread(target=worker) for i in range(threads)]
+   for t in workers: t.start()
+   for t in workers: t.join()
+   stats = pool.stats()
+   print "%d threads x %d contexts: %d idle afterwards, %d errors" % (threads, count, stats["idle"], len(errors))
+   assert not errors, errors[:3]
+   assert 0 < stats["idle"] <= threads
+
+   ctx = pool.acquire(args.user, args.servicename, flags)
+   pool.release(args.user, args.servicename, flags, ctx)
+   assert pool.acquire(args.user, args.servicename, flags) is ctx, "released context wasn't reused"
+   lifetime = authGSSImpersonationInquireCred(ctx)["lifetime"]
+   pool.discard(ctx)
+   pool.clear()
+
+   pool = ContextPool(min_lifetime=lifetime + 60) # no credentials live long enough
+   ctx = pool.acquire(args.user, args.servicename, flags)
+   pool.release(args.user, args.servicename, flags, ctx)
+   assert pool.stats()["idle"] == 0, "context with expiring credentials was kept"
+   print "expiring contexts dropped: ok"
+
+def mutualFailureCalls(args):
+   """
+   requests_kerberosauth against a local server answering with a bogus mutual authentication token: the response is
+   returned and the context, which can't be used anymore, isn't given back to the pool.
+   """
+   import threading
+   import BaseHTTPServer
+   from requests import session
+   from s4u2p_util import ContextPool
+   from requests_kerberosauth import HTTPKerberosAuth
+
+   class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+      def do_GET(self):
+         if self.headers.get("Authorization"):
+            self.send_response(200)
+            self.send_header("WWW-Authenticate", "Negotiate Ym9ndXM=")
+         else:
+            self.send_response(401)
+            self.send_header("WWW-Authenticate", "Negotiate")
+         self.send_header("Content-Length", "0")
+         self.end_headers()
+      def log_message(self, *args):
+         pass
+
+   server = BaseHTTPServer.HTTPServer(("127.0.0.1", 0), Handler)
+   thread = threading.Thread(target=server.serve_forever)
+   thread.daemon = True
+   thread.start()
+   try:
+      pool = ContextPool()
+      s = session(auth=HTTPKerberosAuth(as_user=args.user, spn=args.servicename, context_pool=pool))
+      r = s.get("http://127.0.0.1:%d/" % server.server_address[1])
+      print "bogus mutual authentication token: HTTP Status %d, %d idle contexts" % (r.status_code, pool.stats()["idle"])
+      assert r.status_code == 200
+      assert pool.stats()["idle"] == 0, "failed context went back to the pool"
+   finally:
+      server.shutdown()
+
+tests = [
+   oneAuthMultipleCalls,
+   #noImpersonationCalls,
+   reuseCredMultipleCalls,
+   concurrentCalls,
+   initManyCalls,
+   contextPoolCalls,
+   mutualFailureCalls,
+]
+
 args = parser.parse_args()
 
 print """
@@ -129,14 +273,11 @@ session ticket for: %s
 used keyfile      : %s\n""" % (args.host,args.port, args.path, args.user, args.servicename, "default" if not args.keytab else args.keytab)
 
 if args.keytab:
-    authGSSKeytab(args.keytab)
+    authGSSKeytab(args.keytab, args.principal)
     
 
-print "oneAuthMultipleCalls"
-oneAuthMultipleCalls(args)
-
-#print "noImpersonationCalls"
-#noImpersonationCalls(args)
-
-print "\nreuseCredMultipleCalls"
-reuseCredMultipleCalls(args)
+for test in tests:
+    if args.tests and test.__name__ not in args.tests:
+        continue
+    print "\n%s" % test.__name__
+    test(args)
@@ -22,12 +22,13 @@
 # this is a derivative work of urllib2_kerberos from https://bitbucket.org/tolsen/urllib2_kerberos
 # It extends the original work by way to optionally pass an username to impersonate.
 
-import re
 import logging
 import urllib2 as u2
 
 import kerberos as k
 import s4u2p
+from s4u2p_util import impersonation_init, resolve_spn, remember_step_error
+import www_authenticate
 
 def getLogger():
     log = logging.getLogger("http_kerberos_auth_handler")
@@ -42,7 +43,6 @@ log = getLogger()
 class AbstractKerberosAuthHandler(object):
     """auth handler for urllib2 that does Kerberos HTTP Negotiate Authentication
     """
-    rx = re.compile('(?:.*,)*\s*Negotiate\s*([^,]*),?', re.I)
 
     def negotiate_value(self, headers):
         """checks for "Negotiate" in proper auth header
@@ -51,11 +51,11 @@ class AbstractKerberosAuthHandler(object):
 
         if authreq:
             log.debug("authreq: %s", authreq)
-            mo = self.rx.search(authreq)
-            if mo:
-                return mo.group(1)
+            value = www_authenticate.negotiate_value(authreq)
+            if value is not None:
+                return value
             else:
-                log.debug("regex failed on: %s" % authreq)
+                log.debug("no Negotiate challenge in: %s" % authreq)
 
         else:
             log.debug("%s header not found" % self.auth_header)
@@ -67,11 +67,12 @@ class AbstractKerberosAuthHandler(object):
         self.context = None
         self.gssflags=gssflags
         self.spn = spn
+        self.as_user = as_user
         if as_user:
             self.gss_step = s4u2p.authGSSImpersonationStep
             self.gss_response = s4u2p.authGSSImpersonationResponse
             self.gss_clean = s4u2p.authGSSImpersonationClean
-            self.gss_init = lambda *args: s4u2p.authGSSImpersonationInit(as_user, *args)
+            self.gss_init = lambda *args: impersonation_init(as_user, *args)
             self.GSSError = s4u2p.GSSError
         else:
             self.gss_step = k.authGSSClientStep
@@ -90,7 +91,8 @@ class AbstractKerberosAuthHandler(object):
 
             tail, sep, head = host.rpartition(':')
             domain = tail if tail else head
-            spn = "HTTP@%s" % domain
+            port = int(head) if tail and head.isdigit() else None
+            spn = resolve_spn(domain, port, principal=bool(self.as_user))
         else:
             spn = self.spn    
         result, self.context = self.gss_init(spn, self.gssflags)
@@ -101,7 +103,12 @@ class AbstractKerberosAuthHandler(object):
 
         log.debug("authGSSClientInit() succeeded")
 
-        result = self.gss_step(self.context, neg_value)
+        try:
+            result = self.gss_step(self.context, neg_value)
+        except self.GSSError, e:
+            if self.as_user:
+                remember_step_error(self.as_user, spn, e)
+            raise
 
         if result < 0:
             log.warning("authGSSClientStep returned result %d" % result)
@@ -22,15 +22,31 @@ Kerberos authenticating pool
 """
 
 try:
-    from http.client import HTTPConnection
+    from http.client import HTTPConnection, HTTPResponse as HTTPLibResponse
 except ImportError:
-    from httplib import HTTPConnection
+    from httplib import HTTPConnection, HTTPResponse as HTTPLibResponse
+try:
+    from queue import Empty
+except ImportError:
+    from Queue import Empty
 import logging
+import socket
+import threading
+try:
+    import ssl
+except ImportError: # python built without ssl, as urllib3 handles it
+    ssl = None
 import kerberos as k
 import s4u2p
+from s4u2p_util import impersonation_init, resolve_spn, body_position, rewind_body, remember_step_error
+import www_authenticate
 
 from urllib3.connectionpool import *
-from urllib3.util import get_host
+from urllib3.connectionpool import port_by_scheme
+from urllib3.packages.ssl_match_hostname import match_hostname
+from urllib3.poolmanager import PoolManager
+from urllib3._collections import RecentlyUsedContainer
+from urllib3.util import get_host, is_connection_dropped
 
 def getLogger():
     log = logging.getLogger("http_kerberos_auth_handler")
@@ -51,34 +67,227 @@ class KerberosConnectionPool(HTTPConnectionPool):
     """
 
     scheme = 'http'
+    auth_header = 'WWW-Authenticate'
+    authz_header = 'Authorization'
+    auth_status = 401
+    proxy_auth_header = 'Proxy-Authenticate'
+    proxy_authz_header = 'Proxy-Authorization'
+    proxy_auth_status = 407
 
     def __init__(self, *args, **kwargs):
         """
-        authurl is a random URL on the server that is protected by NTLM.
-        user is the Windows user, probably in the DOMAIN\username format.
-        pw is the password for the user.
+        as_user is the user to impersonate, if None the current kerberos principal is used.
+        It can be overridden per request by passing as_user to urlopen.
+        spn is the service principal, by default s4u2p_util.spn_resolver works it out
+        (HTTP@host unless it's set up to canonicalize).
+
+        Connections remember the (as_user, spn) they authenticated as, so servers that keep
+        a connection authenticated (IIS' authPersistNonNTLM) don't need a new handshake.
+
+        Request bodies are sent only once where possible: the pool remembers whether its host
+        asks for Negotiate (finding out with a HEAD request before the first body is sent) and
+        sends requests with a body along with an Authorization header instead of waiting for
+        the 401, unless the connection is known to be authenticated already. Streams are sent as
+        they are read, a stream that can't be rewound is never sent twice, the 401 is returned
+        instead.
+
+        proxy_url ("http://proxy:3128") sends the requests through a proxy, https ones through a
+        CONNECT tunnel. If the proxy asks for Negotiate (407) the pool authenticates to it as the
+        same user, with proxy_spn (worked out like spn by default) and proxy_gssflags (no
+        delegation by default). Connections remember the identity they authenticated to the proxy
+        as too, once the proxy is known to ask for Negotiate new connections (and tunnels) send
+        the Proxy-Authorization header right away.
         """
-        as_user=kwargs.setdefault("as_user", None)
+        self.as_user=kwargs.setdefault("as_user", None)
         self.gssflags=kwargs.setdefault("gssflags", k.GSS_C_MUTUAL_FLAG|k.GSS_C_SEQUENCE_FLAG|k.GSS_C_DELEG_FLAG)
         self.spn = kwargs.setdefault("spn", None)
         del kwargs["as_user"]
         del kwargs["gssflags"]
         del kwargs["spn"]
-        if as_user:
-            self.gss_step = s4u2p.authGSSImpersonationStep
-            self.gss_response = s4u2p.authGSSImpersonationResponse
-            self.gss_clean = s4u2p.authGSSImpersonationClean
-            self.gss_init = lambda *args: s4u2p.authGSSImpersonationInit(as_user, *args)
-            self.GSSError = s4u2p.GSSError
-        else:
-            self.gss_step = k.authGSSClientStep
-            self.gss_response = k.authGSSClientResponse
-            self.gss_clean = k.authGSSClientClean
-            self.gss_init = k.authGSSClientInit
-            self.GSSError = k.GSSError
+        self.proxy_url = kwargs.pop("proxy_url", None)
+        self.proxy_spn = kwargs.pop("proxy_spn", None)
+        self.proxy_gssflags = kwargs.pop("proxy_gssflags", k.GSS_C_MUTUAL_FLAG|k.GSS_C_SEQUENCE_FLAG)
+        self.proxy_host = self.proxy_port = None
+        if self.proxy_url:
+            proxy_scheme, self.proxy_host, self.proxy_port = get_host(self.proxy_url)
+            self.proxy_port = self.proxy_port or port_by_scheme.get(proxy_scheme or 'http', 80)
+        self.gss_init, self.gss_step, self.gss_response, self.gss_clean, self.GSSError = self.gss_functions(self.as_user)
+        self._local = threading.local()
+        self._stats_lock = threading.Lock()
+        self._stats = dict(requests=0, hits=0, handshakes=0, switches=0, probes=0, preemptive=0,
+                           proxy_handshakes=0, proxy_preemptive=0, tunnels=0)
+        self.negotiate = None # whether the host asks for Negotiate, None if not known yet
+        self.persistent = None # whether the host keeps connections authenticated, None if not known yet
+        self.proxy_negotiate = None # whether the proxy asks for Negotiate, None if not known yet
             
         super(KerberosConnectionPool, self).__init__(*args, **kwargs)
-         
+
+    def gss_functions(self, as_user):
+        """returns init, step, response, clean and the error class to authenticate as as_user"""
+        if as_user:
+            return (lambda *args: impersonation_init(as_user, *args),
+                    s4u2p.authGSSImpersonationStep, s4u2p.authGSSImpersonationResponse,
+                    s4u2p.authGSSImpersonationClean, s4u2p.GSSError)
+        return (k.authGSSClientInit, k.authGSSClientStep, k.authGSSClientResponse,
+                k.authGSSClientClean, k.GSSError)
+
+    def negotiate_value(self, resp, proxy=False):
+        """the token of the response's Negotiate challenge, "" if it has none, None if there's no challenge"""
+        return www_authenticate.negotiate_value(resp.getheader(proxy and self.proxy_auth_header or self.auth_header))
+
+    def get_spn(self):
+        if self.spn is None:
+            return resolve_spn(self.host, self.port, principal=bool(self.current_user()))
+        return self.spn
+
+    def get_proxy_spn(self):
+        if self.proxy_spn is None:
+            return resolve_spn(self.proxy_host, self.proxy_port, principal=bool(self.current_user()))
+        return self.proxy_spn
+
+    def is_proxied(self):
+        """whether requests go through the proxy as absolute urls, not through a tunnel"""
+        return bool(self.proxy_host) and self.scheme == 'http'
+
+    def current_user(self):
+        """the user the request running in this thread authenticates as"""
+        as_user = getattr(self._local, "as_user", _Default)
+        if as_user is _Default:
+            return self.as_user
+        return as_user
+
+    def current_identity(self):
+        return (self.current_user(), self.get_spn())
+
+    def current_proxy_identity(self):
+        """the identity to authenticate to the proxy as, None without a proxy"""
+        if not self.proxy_host:
+            return None
+        return (self.current_user(), self.get_proxy_spn())
+
+    def auth_parameters(self, proxy=False):
+        """identity, gssflags, challenge header, status and authorization header for the host or the proxy"""
+        if proxy:
+            return (self.current_proxy_identity(), self.proxy_gssflags, self.proxy_auth_header,
+                    self.proxy_auth_status, self.proxy_authz_header)
+        return (self.current_identity(), self.gssflags, self.auth_header, self.auth_status, self.authz_header)
+
+    def _count(self, name):
+        self._stats_lock.acquire()
+        try:
+            self._stats[name] += 1
+        finally:
+            self._stats_lock.release()
+
+    def auth_stats(self):
+        """
+        Returns a dict with the number of requests, the hits (requests sent over a connection
+        already authenticated for their user, that didn't need a handshake), the handshakes made
+        and the switches (connections closed because they were authenticated for another user),
+        the probes (HEAD requests sent to find out if the host asks for Negotiate) and the
+        requests sent with a preemptive Authorization header. With a proxy also the handshakes
+        made after a 407, the requests and tunnels sent with a preemptive Proxy-Authorization
+        header and the tunnels opened.
+        """
+        self._stats_lock.acquire()
+        try:
+            stats = dict(self._stats)
+        finally:
+            self._stats_lock.release()
+        stats["hit_rate"] = stats["requests"] and float(stats["hits"]) / stats["requests"]
+        return stats
+
+    def urlopen(self, method, url, *args, **kwargs):
+        """like HTTPConnectionPool.urlopen, takes an additional as_user argument"""
+        as_user = kwargs.pop("as_user", _Default)
+        if as_user is _Default: # keep the user of an enclosing call, i.e. on redirects
+            return super(KerberosConnectionPool, self).urlopen(method, url, *args, **kwargs)
+
+        previous = getattr(self._local, "as_user", _Default)
+        self._local.as_user = as_user
+        try:
+            return super(KerberosConnectionPool, self).urlopen(method, url, *args, **kwargs)
+        finally:
+            self._local.as_user = previous
+
+    def _fitness(self, conn, identity, proxy_identity):
+        """
+        2 if conn is authenticated (to the host or the proxy) for the current identity, 1 if it
+        isn't authenticated, 0 if it is authenticated for someone else. Once the host is known
+        not to keep connections authenticated its tags don't count, any connection will do then.
+        As long as that isn't known they do, the host might serve a request as the previous user.
+        """
+        tag = getattr(conn, "kerberos_identity", None)
+        if self.persistent is False:
+            tag = None
+        proxy_tag = getattr(conn, "kerberos_proxy_identity", None)
+        if tag not in (None, identity) or proxy_tag not in (None, proxy_identity):
+            return 0
+        if tag is None and proxy_tag is None:
+            return 1
+        return 2
+
+    def _reset(self, conn):
+        conn.kerberos_identity = None
+        conn.kerberos_proxy_identity = None
+
+    def _get_conn(self, timeout=None):
+        """
+        Get a connection, preferring one that is authenticated for the current identity,
+        then an unauthenticated one. A connection authenticated for someone else is closed,
+        so it can't be used with the wrong identity.
+        """
+        identity = self.current_identity()
+        proxy_identity = self.current_proxy_identity()
+        conn = super(KerberosConnectionPool, self)._get_conn(timeout)
+        fitness = self._fitness(conn, identity, proxy_identity)
+        if fitness == 2:
+            return conn
+
+        # look through the idle connections for a better match
+        idle = []
+        while True:
+            try:
+                idle.append(self.pool.get(block=False))
+            except (Empty, AttributeError):
+                break
+
+        best = None
+        for i, candidate in enumerate(idle):
+            candidate_fitness = self._fitness(candidate, identity, proxy_identity)
+            if candidate_fitness > fitness:
+                best, fitness = i, candidate_fitness
+                if fitness == 2:
+                    break
+
+        if best is not None:
+            idle[best], conn = conn, idle[best]
+            if conn is None:
+                conn = self._new_conn()
+            elif is_connection_dropped(conn):
+                log.info("Resetting dropped connection: %s" % self.host)
+                conn.close()
+                self._reset(conn)
+
+        for candidate in idle:
+            self._put_conn(candidate)
+
+        if self._fitness(conn, identity, proxy_identity) == 0:
+            log.debug("closing connection authenticated as %s/%s for %s" % (getattr(conn, "kerberos_identity", None),
+                                                                            getattr(conn, "kerberos_proxy_identity", None), identity))
+            conn.close()
+            self._reset(conn)
+            self._count("switches")
+        return conn
+
+    def _new_conn(self):
+        """a connection to the proxy if there is one, else to the host"""
+        if not self.proxy_host:
+            return super(KerberosConnectionPool, self)._new_conn()
+        self.num_connections += 1
+        log.info("Starting new HTTP connection (%d): %s through %s" % (self.num_connections, self.host, self.proxy_host))
+        return HTTPConnection(host=self.proxy_host, port=self.proxy_port)
+
     def _make_request(self, conn, method, url, timeout=_Default,
                       **httplib_request_kw):
         """
@@ -91,6 +300,22 @@ class KerberosConnectionPool(HTTPConnectionPool):
             timeout = self.timeout
 
         conn.timeout = timeout # This only does anything in Py26+
+        proxied = self.is_proxied()
+        if proxied and url.startswith("/"):
+            url = "%s://%s:%d%s" % (self.scheme, self.host, self.port, url)
+        body = httplib_request_kw.get("body")
+        position = body_position(body)
+        preemptive = proxy_preemptive = None
+        # a body that can't be sent again always goes out with a token if the host asks for one,
+        # even on an authenticated connection, the host might still answer with a 401
+        if body and (position is None or not (self.persistent and getattr(conn, "kerberos_identity", None) == self.current_identity())):
+            if self.negotiate is None:
+                self.probe(conn, url, httplib_request_kw.get("headers"))
+            if self.negotiate:
+                preemptive = self.preemptiveContext(httplib_request_kw)
+        if proxied and self.proxy_negotiate and getattr(conn, "kerberos_proxy_identity", None) != self.current_proxy_identity():
+            proxy_preemptive = self.preemptiveContext(httplib_request_kw, proxy=True)
+        conn.kerberos_body_position = position
         conn.request(method, url, **httplib_request_kw)
 
         # Set timeout
@@ -100,7 +325,12 @@ class KerberosConnectionPool(HTTPConnectionPool):
 
         try: # Python 2.7+, use buffering of HTTP responses
             httplib_response = conn.getresponse(buffering=True)
-            httplib_response = self.authenticateConnection(conn, httplib_response, method, url, **httplib_request_kw)
+            if proxied:
+                httplib_response = self.authenticateProxy(conn, httplib_response, proxy_preemptive, method, url, **httplib_request_kw)
+            if preemptive is not None:
+                httplib_response = self.finishPreemptive(conn, httplib_response, preemptive, method, url, **httplib_request_kw)
+            else:
+                httplib_response = self.authenticateConnection(conn, httplib_response, method, url, **httplib_request_kw)
         except TypeError: # Python 2.6 and older
             httplib_response = conn.getresponse()
 
@@ -112,64 +342,404 @@ class KerberosConnectionPool(HTTPConnectionPool):
 
         return httplib_response
     
-    def authenticateConnection(self, conn, resp, method, url, **httplib_request_kw):
-        if resp.status == 401 and "Negotiate" in resp.getheader("WWW-Authenticate").split(", "):
-            log.debug("WWW-Authenticate requested")
-            count=0
-            status=k.AUTH_GSS_CONTINUE
-            if self.spn is None:
-                spn = "HTTP@%s" % self.host
-            else:
-                spn = self.spn    
-            result, context = self.gss_init(spn, self.gssflags)
+    def probe(self, conn, url, headers):
+        """
+        finds out whether the host asks for Negotiate with a HEAD request on conn. If the probe
+        fails (reset, timeout, ...) conn is closed and the host stays unknown, the request is
+        then sent the normal way.
+        """
+        self._count("probes")
+        skip = ("authorization", "proxy-authorization", "content-length", "content-type", "transfer-encoding", "expect")
+        headers = dict((name, value) for name, value in (headers or {}).items() if name.lower() not in skip)
+        conn.kerberos_body_position = 0
+        try:
+            conn.request("HEAD", url, headers=headers)
+            resp = conn.getresponse()
+            if self.is_proxied():
+                resp = self.authenticateProxy(conn, resp, None, "HEAD", url, headers=headers)
+            resp.read()
+        except Exception as e:
+            log.debug("probing %s failed: %s" % (self.host, e))
+            conn.close()
+            self._reset(conn)
+            return
+        self.negotiate = resp.status == self.auth_status and self.negotiate_value(resp) is not None
+        log.debug("%s %s Negotiate" % (self.host, self.negotiate and "asks for" or "doesn't ask for"))
 
+    def preemptiveContext(self, httplib_request_kw, proxy=False):
+        """
+        Starts a handshake for the current identity with the host (or the proxy) and puts its
+        token into the request's headers (a copy of them). Returns (identity, context), None if
+        that didn't work.
+        """
+        identity, gssflags, challenge_header, auth_status, authz_header = self.auth_parameters(proxy)
+        as_user, spn = identity
+        gss_init, gss_step, gss_response, gss_clean, GSSError = self.gss_functions(as_user)
+        context = None
+        try:
+            result, context = gss_init(spn, gssflags)
             if result < 1:
-                log.warning("authGSSClientInit returned result %d" % result)
                 return None
+            gss_step(context, "")
+            token = gss_response(context)
+        except GSSError as e:
+            log.warning("preemptive handshake failed: %s" % (e,))
+            if context is not None:
+                if as_user:
+                    remember_step_error(as_user, spn, e)
+                gss_clean(context)
+            return None
+        headers = httplib_request_kw["headers"] = dict(httplib_request_kw.get("headers") or {})
+        headers[authz_header] = "Negotiate %s" % token
+        self._count(proxy and "proxy_preemptive" or "preemptive")
+        return identity, context
 
-            log.debug("authGSSClientInit() succeeded")
-            
-            while count<10 and status==k.AUTH_GSS_CONTINUE:
-                
-                if resp.status == 401: resp.read() # read before attempt to make new request
-                #print "count", count
-                if count==0: servertoken=""
-                else:
-                  servertoken=(resp.getheader("WWW-Authenticate").split(" ") + [""])[1]
-                count = count+1
-                if servertoken == "" and count > 1:
-                  # we'd need a servertoken after we send our sessionticket
-                  print "breaking"
-                  break
-                      
-                status = self.gss_step(context, servertoken)
-                if status == k.AUTH_GSS_CONTINUE or (status == k.AUTH_GSS_COMPLETE and count==1): # if no mutual authentication flag is set the first call to step already results in a _COMPLETE, but we still have to send our session ticket
-                    clienttoken = self.gss_response(context)
-                    headers = httplib_request_kw.setdefault("headers", {})
-                    headers['Authorization'] = 'Negotiate %s' % clienttoken
-        
-                    conn.request(method, url, **httplib_request_kw)
-                    try: # Python 2.7+, use buffering of HTTP responses
-                        resp = conn.getresponse(buffering=True)
-                    except TypeError: # Python 2.6 and older
-                        resp = conn.getresponse()
-                    del headers['Authorization']
-                else:
-                    print "status",status
-            if context:
-                self.gss_clean(context)
-                            
+    def checkPreemptive(self, resp, preemptive, proxy=False):
+        """
+        Verifies the mutual authentication token of the host (or the proxy) in the answer to a
+        request sent with a preemptive header, if there is one, and cleans up the context.
+        Returns False if the token is bad.
+        """
+        identity, context = preemptive
+        gss_init, gss_step, gss_response, gss_clean, GSSError = self.gss_functions(identity[0])
+        try:
+            servertoken = self.negotiate_value(resp, proxy)
+            if servertoken:
+                try:
+                    gss_step(context, servertoken)
+                except GSSError as e:
+                    log.warning("mutual authentication with %s failed: %s" % (proxy and self.proxy_host or self.host, e))
+                    return False
+            return True
+        finally:
+            gss_clean(context)
+
+    def dropPreemptive(self, preemptive):
+        """cleans up the context of a rejected preemptive header"""
+        identity, context = preemptive
+        self.gss_functions(identity[0])[3](context)
+
+    def finishPreemptive(self, conn, resp, preemptive, method, url, **httplib_request_kw):
+        """checks the answer to a request sent with a preemptive Authorization header"""
+        del httplib_request_kw["headers"][self.authz_header]
+        if resp.status == self.auth_status:
+            # token rejected (or it's not Negotiate anymore), do the normal handshake
+            log.debug("preemptive Authorization header rejected by %s" % self.host)
+            self.dropPreemptive(preemptive)
+            return self.authenticateConnection(conn, resp, method, url, **httplib_request_kw)
+        self._count("requests")
+        if self.checkPreemptive(resp, preemptive) and resp.status != self.proxy_auth_status:
+            conn.kerberos_identity = preemptive[0]
+        return resp
+
+    def rewindBody(self, conn, httplib_request_kw):
+        """prepares the body to be sent again, returns False if it can't"""
+        return rewind_body(httplib_request_kw.get("body"), getattr(conn, "kerberos_body_position", 0))
+
+    def authenticateConnection(self, conn, resp, method, url, **httplib_request_kw):
+        identity = self.current_identity()
+        self._count("requests")
+        if not (resp.status == self.auth_status and self.negotiate_value(resp) is not None):
+            if resp.status not in (self.auth_status, self.proxy_auth_status) and getattr(conn, "kerberos_identity", None) == identity:
+                self._count("hits")
+                self.persistent = True
+            return resp
+
+        log.debug("%s requested" % self.auth_header)
+        self.negotiate = True
+        if getattr(conn, "kerberos_identity", None) == identity:
+            self.persistent = False
+        if not self.rewindBody(conn, httplib_request_kw):
+            log.warning("the request body can't be sent again, returning the %d" % resp.status)
+            return resp
+        self._count("handshakes")
+        conn.kerberos_identity = None
+        resp = self.handshake(conn, resp, method, url, **httplib_request_kw)
+        if resp.status not in (self.auth_status, self.proxy_auth_status):
+            conn.kerberos_identity = identity
         return resp
+
+    def authenticateProxy(self, conn, resp, preemptive, method, url, **httplib_request_kw):
+        """
+        Handles the proxy's part of the answer to a request sent through it: checks the answer
+        to a preemptive Proxy-Authorization header, makes the handshake if the proxy asks for
+        Negotiate. Returns the response to go on with.
+        """
+        identity = self.current_proxy_identity()
+        if preemptive is not None:
+            del httplib_request_kw["headers"][self.proxy_authz_header]
+            if resp.status != self.proxy_auth_status:
+                if self.checkPreemptive(resp, preemptive, proxy=True):
+                    conn.kerberos_proxy_identity = identity
+                return resp
+            log.debug("preemptive %s header rejected by %s" % (self.proxy_authz_header, self.proxy_host))
+            self.dropPreemptive(preemptive)
+        if not (resp.status == self.proxy_auth_status and self.negotiate_value(resp, proxy=True) is not None):
+            return resp
+
+        log.debug("%s requested" % self.proxy_auth_header)
+        self.proxy_negotiate = True
+        if not self.rewindBody(conn, httplib_request_kw):
+            log.warning("the request body can't be sent again, returning the %d" % resp.status)
+            return resp
+        self._count("proxy_handshakes")
+        conn.kerberos_proxy_identity = None
+        resp = self.handshake(conn, resp, method, url, proxy=True, **httplib_request_kw)
+        if resp.status != self.proxy_auth_status:
+            conn.kerberos_proxy_identity = identity
+        return resp
+
+    def handshake(self, conn, resp, method, url, proxy=False, **httplib_request_kw):
+        """
+        Negotiate handshake with the host (or the proxy) that answered resp with a challenge,
+        the request is sent again with each token. Returns the last response.
+        """
+        identity, gssflags, challenge_header, auth_status, authz_header = self.auth_parameters(proxy)
+        count=0
+        status=k.AUTH_GSS_CONTINUE
+        as_user, spn = identity
+        gss_init, gss_step, gss_response, gss_clean, GSSError = self.gss_functions(as_user)
+        result, context = gss_init(spn, gssflags)
+
+        if result < 1:
+            log.warning("authGSSClientInit returned result %d" % result)
+            return resp
+
+        log.debug("authGSSClientInit() succeeded")
+        
+        while count<10 and status==k.AUTH_GSS_CONTINUE:
+            
+            if resp.status == auth_status: resp.read() # read before attempt to make new request
+            log.debug("handshake round %d" % count)
+            if count==0: servertoken=""
+            else:
+              servertoken=self.negotiate_value(resp, proxy) or ""
+            count = count+1
+            if servertoken == "" and count > 1:
+              # we'd need a servertoken after we send our sessionticket
+              log.debug("no token from the server, giving up the handshake")
+              break
+                  
+            try:
+                status = gss_step(context, servertoken)
+            except GSSError as e:
+                if as_user:
+                    remember_step_error(as_user, spn, e)
+                gss_clean(context)
+                raise
+            if status == k.AUTH_GSS_CONTINUE or (status == k.AUTH_GSS_COMPLETE and count==1): # if no mutual authentication flag is set the first call to step already results in a _COMPLETE, but we still have to send our session ticket
+                if count > 1 and not self.rewindBody(conn, httplib_request_kw):
+                    break
+                clienttoken = gss_response(context)
+                headers = httplib_request_kw.setdefault("headers", {})
+                headers[authz_header] = 'Negotiate %s' % clienttoken
     
+                conn.request(method, url, **httplib_request_kw)
+                try: # Python 2.7+, use buffering of HTTP responses
+                    resp = conn.getresponse(buffering=True)
+                except TypeError: # Python 2.6 and older
+                    resp = conn.getresponse()
+                del headers[authz_header]
+            else:
+                log.debug("handshake ended with status %d" % status)
+        if context:
+            gss_clean(context)
+                        
+        return resp
+
+    def openTunnel(self, conn):
+        """
+        Connects to the proxy and asks it for a tunnel to the host, with a Proxy-Authorization
+        header if the proxy is known to ask for Negotiate, or after it answered with a 407.
+        Returns the socket of the tunnel, raises socket.error if there's none.
+        """
+        self._reset(conn)
+        target = "%s:%d" % (self.host, self.port)
+        identity = self.current_proxy_identity()
+        sock = preemptive = None
+        try:
+            for attempt in range(2):
+                if sock is None:
+                    sock = socket.create_connection((self.proxy_host, self.proxy_port), conn.timeout)
+                request_kw = dict(headers={"Host": target})
+                if self.proxy_negotiate:
+                    preemptive = self.preemptiveContext(request_kw, proxy=True)
+                sock.sendall("CONNECT %s HTTP/1.1\r\n%s\r\n" % (target, "".join(["%s: %s\r\n" % header for header in request_kw["headers"].items()])))
+                resp = HTTPLibResponse(sock, method="CONNECT")
+                resp.begin()
+
+                if resp.status == 200:
+                    if preemptive is not None:
+                        ok = self.checkPreemptive(resp, preemptive, proxy=True)
+                        preemptive = None
+                        if not ok:
+                            raise socket.error("mutual authentication with the proxy %s failed" % self.proxy_host)
+                        conn.kerberos_proxy_identity = identity
+                    self._count("tunnels")
+                    return sock
+
+                if preemptive is not None:
+                    self.dropPreemptive(preemptive)
+                    preemptive = None
+                    break # token rejected
+                if not (resp.status == self.proxy_auth_status and self.negotiate_value(resp, proxy=True) is not None):
+                    break
+                log.debug("%s requested for CONNECT %s" % (self.proxy_auth_header, target))
+                self.proxy_negotiate = True
+                self._count("proxy_handshakes")
+                resp.read()
+                if resp.will_close:
+                    sock.close()
+                    sock = None
+            raise socket.error("Tunnel connection failed: %d %s" % (resp.status, resp.reason))
+        except:
+            if preemptive is not None:
+                self.dropPreemptive(preemptive)
+            if sock is not None:
+                sock.close()
+            raise
+
+class TunnelHTTPSConnection(VerifiedHTTPSConnection):
+    """
+    A VerifiedHTTPSConnection to the host of pool through a CONNECT tunnel of the pool's proxy.
+    """
+
+    def __init__(self, pool, host, port):
+        VerifiedHTTPSConnection.__init__(self, host=host, port=port)
+        self.pool = pool
+
+    def connect(self):
+        sock = self.pool.openTunnel(self)
+        self.sock = ssl.wrap_socket(sock, self.key_file, self.cert_file,
+                                    cert_reqs=self.cert_reqs,
+                                    ca_certs=self.ca_certs)
+        if self.ca_certs:
+            match_hostname(self.sock.getpeercert(), self.host)
+
+class KerberosHTTPSConnectionPool(KerberosConnectionPool, HTTPSConnectionPool):
+    """
+    Same as KerberosConnectionPool, but HTTPS.
+    """
+
+    scheme = 'https'
+
+    def _new_conn(self):
+        """a connection through a tunnel of the proxy if there is one, else to the host"""
+        if not self.proxy_host:
+            return HTTPSConnectionPool._new_conn(self)
+        self.num_connections += 1
+        log.info("Starting new HTTPS connection (%d): %s through %s" % (self.num_connections, self.host, self.proxy_host))
+        connection = TunnelHTTPSConnection(self, self.host, self.port)
+        connection.set_cert(key_file=self.key_file, cert_file=self.cert_file,
+                            cert_reqs=self.cert_reqs, ca_certs=self.ca_certs)
+        return connection
+
+pool_classes_by_scheme = {
+    'http': KerberosConnectionPool,
+    'https': KerberosHTTPSConnectionPool,
+}
+
+class KerberosPoolManager(PoolManager):
+    """
+    Keeps one KerberosConnectionPool per (scheme, host, port, as_user, spn).
+
+    Pools are created on demand and the least recently used one is closed once there are
+    more than num_pools of them. max_connections only caps the number of idle connections kept
+    over all pools: it lowers num_pools to max_connections // maxsize if necessary. It doesn't
+    limit the connections open at a time, a pool opens more than maxsize of them unless it's
+    created with block=True.
+
+    The user to impersonate (and the spn) can be given per request to urlopen/request,
+    the ones given here are the defaults. The other keyword arguments, e.g. proxy_url and
+    proxy_spn, are passed on to the pools.
+    """
+
+    def __init__(self, num_pools=100, max_connections=None, as_user=None, spn=None, **connection_pool_kw):
+        maxsize = connection_pool_kw.get("maxsize", 1)
+        if max_connections is not None:
+            num_pools = max(1, min(num_pools, max_connections // maxsize))
+        PoolManager.__init__(self, num_pools, **connection_pool_kw)
+        self.as_user = as_user
+        self.spn = spn
+        self.pools = RecentlyUsedContainer(num_pools, dispose_func=self._dispose_pool)
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self.created = 0
+        self.evicted = 0
+
+    def _dispose_pool(self, pool):
+        log.debug("closing pool for %s as %s" % (pool.host, pool.as_user))
+        self.evicted += 1
+        pool.close()
+
+    def _current(self, name):
+        value = getattr(self._local, name, _Default)
+        if value is _Default:
+            return getattr(self, name)
+        return value
+
+    def connection_from_host(self, host, port=None, scheme='http'):
+        """
+        Get the KerberosConnectionPool for host, port and scheme that authenticates
+        as the user (and spn) of the request running in this thread.
+        """
+        port = port or port_by_scheme.get(scheme, 80)
+        as_user = self._current("as_user")
+        spn = self._current("spn")
+        pool_key = (scheme, host, port, as_user, spn)
+
+        self._lock.acquire()
+        try:
+            try:
+                return self.pools[pool_key]
+            except KeyError:
+                pass
+            pool_cls = pool_classes_by_scheme[scheme]
+            pool = pool_cls(host, port, as_user=as_user, spn=spn, **self.connection_pool_kw)
+            self.created += 1
+            self.pools[pool_key] = pool # may evict the least recently used pool
+            return pool
+        finally:
+            self._lock.release()
+
+    def urlopen(self, method, url, redirect=True, **kw):
+        """like PoolManager.urlopen, takes additional as_user and spn arguments"""
+        previous = {}
+        for name in ("as_user", "spn"):
+            if name in kw:
+                previous[name] = getattr(self._local, name, _Default)
+                setattr(self._local, name, kw.pop(name))
+        try:
+            return super(KerberosPoolManager, self).urlopen(method, url, redirect, **kw)
+        finally:
+            for name, value in previous.items():
+                setattr(self._local, name, value)
+
+    def stats(self):
+        """number of pools alive, created and evicted so far"""
+        return dict(pools=len(self.pools), created=self.created, evicted=self.evicted)
+
 def test(args):
     log.setLevel(logging.DEBUG)
     log.info("starting test")
     if args.keytab:
         s4u2p.authGSSKeytab(args.keytab)
     scheme, host, port = get_host(args.url)
-    p = KerberosConnectionPool(host=host, port=port, as_user=args.user, spn=args.spn)
-    r=p.request("GET", args.url)
-    print r.data    
+    p = pool_classes_by_scheme[scheme or 'http'](host=host, port=port, as_user=args.user, spn=args.spn, maxsize=args.connections,
+                                                 proxy_url=args.proxy, proxy_spn=args.proxy_spn)
+    for i in range(args.count):
+        for as_user in [args.user] + (args.other or []):
+            r=p.request("GET", args.url, as_user=as_user)
+            print i, as_user, r.data
+    print p.auth_stats()
+
+    if args.other:
+        m = KerberosPoolManager(num_pools=len(args.other), spn=args.spn, proxy_url=args.proxy, proxy_spn=args.proxy_spn)
+        for i in range(args.count):
+            for as_user in [args.user] + args.other:
+                r=m.request("GET", args.url, as_user=as_user)
+                print i, as_user, r.status
+        print m.stats()
     
 
 if __name__ == '__main__':
@@ -180,6 +750,11 @@ if __name__ == '__main__':
     parser.add_argument("--url", dest="url", help="kerberos protected site")
     parser.add_argument("--spn", dest="spn", help="spn to use, if not given HTTP@domain will be used")
     parser.add_argument("--keytab", dest="keytab", help="path to keytab if you won't use system's default one (only needed for impersonation)", default=None)
+    parser.add_argument("--other", dest="other", action="append", help="additional user to impersonate on the same pool, may be given several times")
+    parser.add_argument("--count", dest="count", type=int, help="number of rounds of requests", default=1)
+    parser.add_argument("--proxy", dest="proxy", help="proxy to send the requests through (http://proxy:port), it may ask for Negotiate too", default=None)
+    parser.add_argument("--proxy-spn", dest="proxy_spn", help="spn of the proxy, if not given it's worked out like the site's", default=None)
+    parser.add_argument("--connections", dest="connections", type=int, help="maximum number of idle connections kept by the pool", default=1)
     args = parser.parse_args()
     
     test(args)
@@ -0,0 +1,256 @@
+# -*- coding: utf8 -*-
+#!/usr/bin/python
+
+# Copyright 2012 Norman Krämer
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#     http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Parser for WWW-Authenticate and Proxy-Authenticate headers (RFC 7235 challenges), shared by
+the http adapters.
+
+The header is scanned once from left to right, every pattern is anchored at the current
+position and can't backtrack into text it already consumed, so the time taken is linear in
+the length of the header, whatever the header looks like. Malformed parts are skipped up to
+the next comma.
+
+    >>> parse_challenges('Basic realm="x", Negotiate YIIB==')
+    [('Basic', None, {'realm': 'x'}), ('Negotiate', 'YIIB==', {})]
+    >>> negotiate_value('Basic realm="x", Negotiate')
+    ''
+"""
+
+import re
+
+try:
+    string_types = basestring
+except NameError: # python 3
+    string_types = str
+
+_ws = re.compile(r"[ \t]*")
+_token = re.compile(r"[!#$%&'*+\-.^_`|~0-9A-Za-z]+")
+_token68 = re.compile(r"[A-Za-z0-9\-._~+/]+=*")
+_quoted = re.compile(r'"([^"\\]*(?:\\.[^"\\]*)*)"')
+_quoted_pair = re.compile(r"\\(.)")
+_skip = re.compile(r"[^,]*")
+
+def _param(header, pos):
+    """auth-param at pos: (name, value, end) or None"""
+    mo = _token.match(header, pos)
+    if mo is None:
+        return None
+    name = mo.group()
+    pos = _ws.match(header, mo.end()).end()
+    if header[pos:pos + 1] != "=":
+        return None
+    pos = _ws.match(header, pos + 1).end()
+    if header[pos:pos + 1] == '"':
+        mo = _quoted.match(header, pos)
+        if mo is None:
+            return None
+        value = mo.group(1)
+        if "\\" in value:
+            value = _quoted_pair.sub(r"\1", value)
+    else:
+        mo = _token.match(header, pos)
+        if mo is None:
+            return None
+        value = mo.group()
+    return name, value, mo.end()
+
+def _element_end(header, pos):
+    """position after the separating comma if pos is at the end of a list element, else None"""
+    pos = _ws.match(header, pos).end()
+    if pos == len(header):
+        return pos
+    if header[pos] == ",":
+        return pos + 1
+    return None
+
+def parse_challenges(header):
+    """
+    The challenges in header as a list of (scheme, token68, params) tuples. token68 is None if
+    the challenge has none, params a dict of the auth-params (names lowercased). header may also
+    be a list of header values, or None.
+    """
+    if header is None:
+        return []
+    if not isinstance(header, string_types):
+        header = ", ".join(header)
+
+    challenges = []
+    current = None
+    pos, end = 0, len(header)
+    while pos < end:
+        # skip empty list elements
+        pos = _ws.match(header, pos).end()
+        if pos < end and header[pos] == ",":
+            pos += 1
+            continue
+        if pos >= end:
+            break
+
+        # an auth-param continuing the current challenge?
+        if current is not None:
+            param = _param(header, pos)
+            if param is not None:
+                after = _element_end(header, param[2])
+                if after is not None:
+                    current[2][param[0].lower()] = param[1]
+                    pos = after
+                    continue
+
+        # a new challenge
+        mo = _token.match(header, pos)
+        if mo is None:
+            pos = _skip.match(header, pos).end()
+            current = None
+            continue
+        current = (mo.group(), None, {})
+        challenges.append(current)
+        pos = mo.end()
+        after = _element_end(header, pos)
+        if after is not None:
+            pos = after
+            continue
+        if header[pos] not in " \t":
+            pos = _skip.match(header, pos).end()
+            continue
+        pos = _ws.match(header, pos).end()
+
+        # token68 or the first auth-param
+        param = _param(header, pos)
+        if param is not None:
+            after = _element_end(header, param[2])
+            if after is not None:
+                current[2][param[0].lower()] = param[1]
+                pos = after
+                continue
+        mo = _token68.match(header, pos)
+        if mo is not None:
+            after = _element_end(header, mo.end())
+            if after is not None:
+                challenges[-1] = current = (current[0], mo.group(), current[2])
+                pos = after
+                continue
+        pos = _skip.match(header, pos).end()
+
+    return challenges
+
+def find_challenge(header, scheme):
+    """(token68, params) of the first challenge for scheme (case insensitive), None if there's none"""
+    scheme = scheme.lower()
+    for name, token68, params in parse_challenges(header):
+        if name.lower() == scheme:
+            return token68, params
+    return None
+
+def negotiate_value(header):
+    """
+    The token of the Negotiate challenge in header, "" if it comes without a token and None
+    if there is no Negotiate challenge.
+    """
+    challenge = find_challenge(header, "Negotiate")
+    if challenge is None:
+        return None
+    return challenge[0] or ""
+
+def _random_challenges(rnd):
+    """a random list of challenges and its serialization"""
+    import string
+    tchars = string.ascii_letters + string.digits + "!#$%&'*+-.^_`|~"
+    b64chars = string.ascii_letters + string.digits + "+/"
+
+    def token(alphabet=tchars, maxlen=8):
+        return "".join(rnd.choice(alphabet) for i in range(rnd.randint(1, maxlen)))
+
+    def sep():
+        return rnd.choice([",", ", ", " ,", ",,", " , , ", ",\t"])
+
+    challenges, parts = [], []
+    for i in range(rnd.randint(1, 4)):
+        scheme = token(string.ascii_letters)
+        kind = rnd.randint(0, 2)
+        if kind == 0:
+            challenges.append((scheme, None, {}))
+            parts.append(scheme)
+        elif kind == 1:
+            value = token(b64chars, 64) + "=" * rnd.randint(0, 2)
+            challenges.append((scheme, value, {}))
+            parts.append("%s %s" % (scheme, value))
+        else:
+            params, texts = {}, []
+            for j in range(rnd.randint(1, 3)):
+                name = token(string.ascii_lowercase)
+                if rnd.random() < 0.5:
+                    value = token()
+                    text = value
+                else:
+                    value = "".join(rnd.choice(string.printable[:94] + " ") for k in range(rnd.randint(0, 10)))
+                    text = '"%s"' % value.replace("\\", "\\\\").replace('"', '\\"')
+                params[name] = value
+                texts.append("%s%s=%s" % (name, rnd.choice(["", " "]), text))
+            challenges.append((scheme, None, params))
+            parts.append("%s %s" % (scheme, sep().join(texts)))
+    return challenges, sep().join(parts)
+
+def pathological_headers(size):
+    """headers that make backtracking parsers slow"""
+    return [
+        "," * size,
+        ", " * size + "Negotiate",
+        "a, " * size + "Negotiate x",
+        "Negotiate " + "A" * size,
+        "Negotiate " + "A" * size + "!",
+        'Basic realm="' + "\\a" * size,
+        'Basic realm="' + "x" * size,
+        "Basic " + "a=b, " * size,
+        "Basic " + "a=" * size,
+        "=" * size,
+        " " * size,
+        "\t" * size + "x",
+    ]
+
+def test(args):
+    import time
+    import random
+
+    rnd = random.Random(args.seed)
+    for i in range(args.count):
+        challenges, header = _random_challenges(rnd)
+        parsed = parse_challenges(header)
+        if parsed != challenges:
+            print("MISMATCH for %r:\n  expected %r\n  got      %r" % (header, challenges, parsed))
+            return 1
+        # arbitrary slices of valid headers must not raise
+        a, b = sorted(rnd.randint(0, len(header)) for j in range(2))
+        parse_challenges(header[a:b])
+    print("%d random headers parsed back" % args.count)
+
+    for size in (1000, 10000, 100000):
+        start = time.time()
+        for header in pathological_headers(size):
+            parse_challenges(header)
+        print("pathological headers of %6d characters: %8.3fms" % (size, (time.time() - start) * 1000))
+    return 0
+
+if __name__ == '__main__':
+    import sys
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Self check of the WWW-Authenticate parser with random and pathological headers.")
+    parser.add_argument("--count", dest="count", type=int, help="number of random headers", default=10000)
+    parser.add_argument("--seed", dest="seed", type=int, help="seed of the random headers", default=None)
+    args = parser.parse_args()
+
+    sys.exit(test(args))